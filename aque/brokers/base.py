@@ -1,6 +1,8 @@
 from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
 import functools
 import logging
+import threading
 import weakref
 
 from aque.eventloop import EventLoop
@@ -11,6 +13,32 @@ from aque.utils import encode_callable
 log = logging.getLogger(__name__)
 
 
+# Dependents stop waiting on a task once it reaches one of these.
+FINISHED_STATUSES = frozenset(('success', 'error', 'killed'))
+
+
+def _prepare_status_updates(updates):
+    by_tid = OrderedDict()
+    for tid, status, result in updates:
+        if status not in ('pending', 'killed', 'success', 'error'):
+            raise ValueError('bad status %r' % status)
+        by_tid.pop(tid, None)
+        by_tid[tid] = (tid, status, result)
+    return by_tid.values()
+
+
+def _group_status_updates(updates):
+    """Group ``(tid, status, result)`` into ``(status, tids)``, in order of appearance."""
+    by_status = OrderedDict()
+    for tid, status, _ in updates:
+        by_status.setdefault(status, []).append(tid)
+    return by_status.items()
+
+
+def _status_events(tids, status):
+    return ['task_status', 'task_status.%s' % status] + ['task_status.%d' % tid for tid in tids]
+
+
 class Broker(object):
     """Brokers handle all communication between clients and workers.
 
@@ -36,10 +64,18 @@ class Broker(object):
         """
         return cls()
 
+    # How long to gather up task completions before resolving their futures
+    # with a single fetch; zero resolves them immediately.
+    future_resolution_window = 0
+
     def __init__(self):
         self._futures = weakref.WeakValueDictionary()
         self._bound_callbacks = {}
 
+        self._resolution_lock = threading.Lock()
+        self._unresolved_tids = set()
+        self._resolution_timer = None
+
         # The event loop is set after the bind so that the bind does not
         # trigger the event loop to actually start. As of writing, that is
         # on the broker's themselves to manage.
@@ -75,6 +111,35 @@ class Broker(object):
         else:
             return self._create_many(prototypes)
 
+    def reserve_ids(self, count):
+        """Reserve IDs for tasks which are yet to be created.
+
+        Prototypes given to :meth:`create` or :meth:`create_pending` may then
+        carry one of these as their ``id``, which allows a whole graph of
+        tasks to refer to each other before any of them exist.
+
+        :param int count: how many IDs to reserve.
+        :returns: a list of increasing IDs, or ``None`` if this broker
+            does not support reserving them.
+
+        """
+        return None
+
+    def create_pending(self, prototypes):
+        """Create a list of tasks which are immediately pending.
+
+        This skips the ``creating`` status, so it is only appropriate when
+        all of the tasks' dependencies already exist. Workers are notified
+        as if by :meth:`set_status_and_notify`.
+
+        :returns: list of :class:`.Future`, in the same order.
+
+        """
+        futures = self._create_many([dict(proto, status='pending') for proto in prototypes])
+        if futures:
+            self._notify_status([f.id for f in futures], 'pending')
+        return futures
+
     @abstractmethod
     def _create_many(self, prototypes):
         pass
@@ -98,6 +163,46 @@ class Broker(object):
     def _fetch_many(self, tids, fields):
         pass
 
+    def fetch_graph(self, root_ids, fields=None):
+        """Get the given tasks, and all of those they (transitively) depend on.
+
+        :param list root_ids: task IDs to start from.
+        :param list fields: which fields the returned tasks should have.
+        :returns dict: mapping existing IDs to their tasks.
+
+        """
+        if fields is not None:
+            fields = list(set(fields).union(('id', 'dependencies')))
+        tasks = {}
+        seen = set(root_ids)
+        frontier = set(root_ids)
+        while frontier:
+            fetched = self.fetch(frontier, fields)
+            tasks.update(fetched)
+            frontier = set()
+            for task in fetched.itervalues():
+                for dep_id in task.get('dependencies') or ():
+                    if dep_id not in seen:
+                        seen.add(dep_id)
+                        frontier.add(dep_id)
+        return tasks
+
+    def fetch_dependents(self, tids, fields=None):
+        """Get the tasks which directly depend upon any of the given task IDs.
+
+        :param list tids: task IDs to find the dependents of.
+        :param list fields: which fields the return tasks should have.
+        :returns dict: mapping IDs to their tasks.
+        """
+        tids = set([tids] if isinstance(tids, int) else tids)
+        if not tids:
+            return {}
+        fields = list(set(fields).union(('id', 'dependencies'))) if fields else None
+        return dict(
+            (task['id'], task) for task in self.search(None, fields)
+            if tids.intersection(task.get('dependencies') or ())
+        )
+
     def delete(self, tids):
         if isinstance(tids, int):
             self._delete_many([tids])
@@ -115,6 +220,39 @@ class Broker(object):
         """Capture a single task, and keep a heartbeat running."""
         return True
 
+    def claim(self, count, requirements=None):
+        """Capture up to ``count`` pending tasks at once.
+
+        Only tasks whose dependencies have all finished are considered.
+
+        :param int count: the maximum number of tasks to capture.
+        :param dict requirements: restrictions on which tasks may be captured;
+            ``ids`` limits to the given task IDs, ``cpus`` and ``memory`` are
+            upper bounds on what a task may request, and ``platform`` must
+            match the task's platform (if it has one).
+        :returns list: the captured tasks, highest priority first.
+
+        """
+        requirements = requirements or {}
+        ids = requirements.get('ids')
+        if ids is not None:
+            candidates = self.fetch(list(ids)).values()
+        else:
+            candidates = self.search({'status': 'pending'})
+        candidates = [
+            t for t in candidates
+            if t.get('status') == 'pending' and not t.get('unfinished_dependencies') and _meets_requirements(t, requirements)
+        ]
+        candidates.sort(key=lambda t: (-t.get('priority', 1000), t['id']))
+
+        claimed = []
+        for task in candidates:
+            if len(claimed) >= count:
+                break
+            if self.acquire(task['id']):
+                claimed.append(task)
+        return claimed
+
     def release(self, tid):
         """Release a single task that we are done with."""
 
@@ -160,24 +298,64 @@ class Broker(object):
         return self._futures.setdefault(tid, Future(self, tid))
 
     def set_status_and_notify(self, tids, status, result=None):
-        if status not in ('pending', 'killed', 'success', 'error'):
-            raise ValueError('bad status %r' % status)
         tids = [tids] if isinstance(tids, int) else list(tids)
-        self._set_status(tids, status, result)
-        events = ['task_status', 'task_status.%s' % status] + ['task_status.%d' % tid for tid in tids]
-        self.trigger(events, tids, status)
+        self.set_statuses_and_notify([(tid, status, result) for tid in tids])
+
+    def set_statuses_and_notify(self, updates):
+        """Set the status and result of many tasks at once.
+
+        Each task may have its own status and result; one set of events is
+        triggered for each distinct status.
+
+        :param updates: ``(tid, status, result)`` tuples; if a task is given
+            more than once, the last one wins.
+
+        """
+        updates = _prepare_status_updates(updates)
+        if updates:
+            self._set_statuses(updates)
+            for status, tids in _group_status_updates(updates):
+                self._notify_status(tids, status)
+
+    def _notify_status(self, tids, status):
+        self.trigger(_status_events(tids, status), tids, status)
 
     def _on_task_status(self, tids, status):
 
         if status not in ('success', 'error'):
             return
 
+        # Only bother with those that somebody is still waiting on.
+        tids = [tid for tid in tids if tid in self._futures]
+        if not tids:
+            return
+
+        if not self.future_resolution_window or self._event_loop is None:
+            self._resolve_futures(tids)
+            return
+
+        with self._resolution_lock:
+            self._unresolved_tids.update(tids)
+            if self._resolution_timer is None:
+                self._resolution_timer = self._event_loop.add_timer(
+                    self.future_resolution_window, self._flush_resolutions, repeat=False
+                )
+
+    def _flush_resolutions(self):
+        with self._resolution_lock:
+            tids, self._unresolved_tids = self._unresolved_tids, set()
+            self._resolution_timer = None
+        self._resolve_futures(tids)
+
+    def _resolve_futures(self, tids):
+
+        # Futures may have been collected (or resolved) while we waited.
         futures = [self._futures.get(tid) for tid in tids]
-        futures = filter(None, futures)
+        futures = [f for f in futures if f is not None and not f.done()]
         if not futures:
             return
 
-        tasks = self._fetch_many(tids, ['id', 'status', 'result'])
+        tasks = self._fetch_many([f.id for f in futures], ['id', 'status', 'result'])
 
         for future in futures:
 
@@ -186,27 +364,53 @@ class Broker(object):
                 log.warning('could not find task %d during task_status' % future.id)
                 continue
 
-            if task['status'] != status:
-                log.warning('task %d status changed from %s to %s during event dispatch' % (task['id'], status, task['status']))
-
+            status = task['status']
             log.debug('dispatching %s to %s' % (status, future.id))
             if status == 'success':
                 future.set_result(task['result'])
-            else:
+            elif status == 'error':
                 future.set_exception(task['result'])
+            else:
+                log.warning('task %d status changed to %s during event dispatch' % (task['id'], status))
 
     @abstractmethod
-    def _set_status(self, tids, status, result):
+    def _set_statuses(self, updates):
         pass
 
     def log_output_and_notify(self, tid, fd, offset, content):
-        self._log_output(tid, fd, offset, content)
-        self.trigger(['output_log', 'output_log.%d' % tid], tid, fd, offset, content)
+        self.log_outputs_and_notify(tid, [(fd, offset, content)])
 
-    def _log_output(self, tid, fd, content):
+    def log_outputs_and_notify(self, tid, chunks):
+        """Log several chunks of a task's output, with a single notification.
+
+        The ``output_log`` events carry the task ID and ``(fd, offset, length)``
+        of each chunk; the content itself is retrieved via :meth:`get_output`.
+
+        :param int tid: the task which produced the output.
+        :param list chunks: ``(fd, offset, content)`` tuples, in the order
+            they were written.
+
+        """
+        chunks = list(chunks)
+        if chunks:
+            self._log_outputs(tid, chunks)
+            self.trigger(['output_log', 'output_log.%d' % tid], tid, [
+                (fd, offset, len(content)) for fd, offset, content in chunks
+            ])
+
+    def _log_outputs(self, tid, chunks):
         pass
 
-    def get_output(self, tids):
+    def get_output(self, tids, since_offsets=None):
+        """Get the logged output of the given tasks.
+
+        :param list tids: the tasks to get the output of.
+        :param dict since_offsets: ``{tid: {fd: offset}}`` to only get the
+            chunks at or after the given offsets.
+        :returns: iterator of ``(tid, ctime, fd, offset, content)``, in the
+            order they were logged.
+
+        """
         return []
 
     @abstractmethod
@@ -220,3 +424,14 @@ class Broker(object):
         """
 
 
+def _meets_requirements(task, requirements):
+    cpus = requirements.get('cpus')
+    if cpus is not None and (task.get('cpus') or 1) > cpus:
+        return False
+    memory = requirements.get('memory')
+    if memory is not None and (task.get('memory') or 0) > memory:
+        return False
+    platform = requirements.get('platform')
+    if platform is not None and task.get('platform') and task['platform'].lower() != platform.lower():
+        return False
+    return True
@@ -1,8 +1,9 @@
+import datetime
 import logging
 import threading
 
 import aque.utils as utils
-from aque.brokers.base import Broker
+from aque.brokers.base import Broker, FINISHED_STATUSES
 from aque.eventloop import SelectableEvent
 
 
@@ -16,7 +17,7 @@ class MemoryBroker(Broker):
     
     def __init__(self):
         super(MemoryBroker, self).__init__()
-        self._id_lock = threading.Lock()
+        self._lock = threading.RLock()
         self._init()
         self._binds = {}
         self._event = SelectableEvent()
@@ -24,6 +25,8 @@ class MemoryBroker(Broker):
 
     def _init(self):
         self._tasks = {}
+        self._dependents = {}
+        self._outputs = {}
         self._id_counter = 0
 
     def update_schema(self):
@@ -34,15 +37,29 @@ class MemoryBroker(Broker):
 
     def _create_many(self, prototypes):
         futures = []
-        with self._id_lock:
+        with self._lock:
             for proto in prototypes:
-                self._id_counter += 1
-                tid = self._id_counter
-                self._tasks[tid] = dict(proto or {})
-                self._tasks[tid]['id'] = tid
+                tid = (proto or {}).get('id')
+                if tid is None:
+                    self._id_counter += 1
+                    tid = self._id_counter
+                task = self._tasks[tid] = dict(proto or {})
+                task['id'] = tid
+                dependencies = set(task.get('dependencies') or ())
+                for dep_id in dependencies:
+                    self._dependents.setdefault(dep_id, set()).add(tid)
+                task['unfinished_dependencies'] = sum(1 for dep_id in dependencies
+                    if dep_id in self._tasks and self._tasks[dep_id].get('status') not in FINISHED_STATUSES
+                )
                 futures.append(self.get_future(tid))
         return futures
 
+    def reserve_ids(self, count):
+        with self._lock:
+            start = self._id_counter + 1
+            self._id_counter += count
+        return range(start, start + count)
+
     def _fetch_many(self, tids, fields):
         res = {}
         for tid in tids:
@@ -52,21 +69,58 @@ class MemoryBroker(Broker):
                 pass
         return res
 
-    def _delete_many(self, tids):
-        for tid in tids:
-            self._tasks.pop(tid, None)
+    def fetch_dependents(self, tids, fields=None):
+        tids = [tids] if isinstance(tids, int) else tids
+        with self._lock:
+            dependent_ids = set()
+            for tid in tids:
+                dependent_ids.update(self._dependents.get(tid, ()))
+            return self._fetch_many(dependent_ids, fields)
 
-    def _set_status(self, tids, status, result):
+    def _delete_many(self, tids):
+        with self._lock:
+            for tid in tids:
+                task = self._tasks.pop(tid, None)
+                self._outputs.pop(tid, None)
+                if task is not None and task.get('status') not in FINISHED_STATUSES:
+                    self._adjust_dependents(tid, -1)
+
+    def _log_outputs(self, tid, chunks):
+        ctime = datetime.datetime.now()
+        with self._lock:
+            self._outputs.setdefault(tid, []).extend((ctime, fd, offset, content) for fd, offset, content in chunks)
+
+    def get_output(self, tids, since_offsets=None):
+        since_offsets = since_offsets or {}
+        rows = []
         for tid in tids:
-            self._tasks.setdefault(tid, {}).update({'status': status, 'result': result})
+            since = since_offsets.get(tid, {})
+            for ctime, fd, offset, content in list(self._outputs.get(tid, ())):
+                if offset >= since.get(fd, 0):
+                    rows.append((tid, ctime, fd, offset, content))
+        rows.sort(key=lambda row: (row[1], row[0], row[2], row[3]))
+        return iter(rows)
+
+    def _adjust_dependents(self, tid, delta):
+        for dependent_id in self._dependents.get(tid, ()):
+            dependent = self._tasks.get(dependent_id)
+            if dependent is not None:
+                dependent['unfinished_dependencies'] = dependent.get('unfinished_dependencies', 0) + delta
+
+    def _set_statuses(self, updates):
+        with self._lock:
+            for tid, status, result in updates:
+                task = self._tasks.setdefault(tid, {})
+                was_finished = task.get('status') in FINISHED_STATUSES
+                task.update({'status': status, 'result': result})
+                if was_finished != (status in FINISHED_STATUSES):
+                    self._adjust_dependents(tid, 1 if was_finished else -1)
 
     def search(self, filter=None, fields=None):
         filter_ = filter or {}
-        for task in self._tasks.itervalues():
-            for k, v in filter_.iteritems():
-                if task.get(k) != v:
-                    continue
-            yield task.copy()
+        for task in self._tasks.values():
+            if all(task.get(k) == v for k, v in filter_.iteritems()):
+                yield task.copy()
 
     def _send_remote_events(self, *args):
         self._event.set()
@@ -77,5 +131,3 @@ class MemoryBroker(Broker):
     def on_select(self, r, w, x):
         if r:
             self._event.clear()
-
-
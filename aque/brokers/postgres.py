@@ -1,12 +1,17 @@
 from Queue import Queue, Empty
+from collections import MutableMapping, OrderedDict
+from cStringIO import StringIO
 import contextlib
+import copy
 import datetime
 import functools
+import hashlib
 import json
 import logging
 import os
 import pickle
 import select
+import struct
 import threading
 import time
 
@@ -16,14 +21,41 @@ import psycopg2.extras
 import psycopg2 as pg
 
 import aque.utils as utils
-from aque.brokers.base import Broker
+from aque.brokers.base import Broker, FINISHED_STATUSES, _prepare_status_updates, _group_status_updates, _status_events
 
 
 ACTIVE_TIMEOUT = 31
 HEARTBEAT_INTERVAL = 15
 
+# How many rows a search pulls from the server at a time.
+SEARCH_ITERSIZE = 1000
+
+# How long to gather task completions before resolving their futures.
+FUTURE_RESOLUTION_WINDOW = 0.01
+
+# How many rows are sent per COPY when creating tasks.
+COPY_CHUNK_SIZE = 10000
+
+# Large values of these fields are stored once in the task_blobs table, and
+# referenced by their hash (behind this marker) from the tasks themselves.
+BLOB_FIELDS = frozenset(('environ', 'kwargs'))
+BLOB_MIN_SIZE = 1024
+BLOB_MARKER = '\x00aque-blob:'
+
+# How many blobs to hold on to.
+BLOB_CACHE_SIZE = 32
+
+# How long a blob which nothing refers to is kept after it was last stored,
+# since it may belong to tasks which are still being created.
+BLOB_GRACE_PERIOD = 3600
+
+# Postgres refuses NOTIFY payloads of 8000 bytes or more.
+NOTIFY_MAX_PAYLOAD = 7999
+
 log = logging.getLogger(__name__)
 
+_missing = object()
+
 
 schema_migrations = []
 def patch(func=None, name=None):
@@ -96,11 +128,274 @@ def create_output_log_table(cur):
     cur.execute('CREATE INDEX output_logs_index ON output_logs (task_id)')
 
 
+@patch
+def add_dependency_counters(cur):
+    cur.execute('ALTER TABLE tasks ADD COLUMN unfinished_dependencies INTEGER NOT NULL DEFAULT 0')
+    cur.execute('''UPDATE tasks SET unfinished_dependencies = (
+        SELECT count(*) FROM tasks AS deps
+        WHERE deps.id = ANY(tasks.dependencies) AND deps.status NOT IN ('success', 'error', 'killed')
+    )''')
+    # Reverse dependency lookups.
+    cur.execute('CREATE INDEX tasks_dependencies_index ON tasks USING GIN (dependencies)')
+    # Ready task lookups.
+    cur.execute('''CREATE INDEX tasks_ready_index ON tasks (priority DESC, id)
+        WHERE status = 'pending' AND unfinished_dependencies = 0''')
+
+
+@patch
+def binary_output_logs(cur):
+
+    # Content was stored via Python's "string-escape", which Postgres can't
+    # undo by itself.
+    cur.execute('ALTER TABLE output_logs ADD COLUMN data BYTEA')
+    with cur.connection.cursor('binary_output_logs') as old:
+        old.itersize = 1000
+        old.execute('SELECT ctid, content FROM output_logs')
+        for ctid, content in old:
+            cur.execute('UPDATE output_logs SET data = %s WHERE ctid = %s', [
+                pg.Binary(content.decode('string-escape')), ctid,
+            ])
+    cur.execute('ALTER TABLE output_logs DROP COLUMN content')
+    cur.execute('ALTER TABLE output_logs RENAME COLUMN data TO content')
+    cur.execute('ALTER TABLE output_logs ALTER COLUMN content SET NOT NULL')
+
+    # Not unique, since retried tasks start their offsets again.
+    cur.execute('DROP INDEX output_logs_index')
+    cur.execute('CREATE INDEX output_logs_offset_index ON output_logs (task_id, fd, "offset")')
+
+
+@patch
+def create_task_blobs_table(cur):
+    cur.execute('''CREATE TABLE task_blobs (
+        hash TEXT PRIMARY KEY,
+        ctime TIMESTAMP NOT NULL DEFAULT localtimestamp,
+        content BYTEA NOT NULL
+    )''')
+
+
+# Events are sent on one channel per family (e.g. "task_status.123" goes via
+# "task_status"), and the per-task events are rebuilt by the receiver from the
+# task IDs in the payload rather than being sent one by one.
+
+def _event_channel(event):
+    return event.split('.', 1)[0]
+
+
+def _is_tid(x):
+    return isinstance(x, (int, long)) and not isinstance(x, bool)
+
+
+def _encode_notifications(events, args, kwargs):
+    """Pack events into as few ``(channel, payload)`` pairs as will fit.
+
+    When the first argument is the task ID (or IDs) that the events are about,
+    they are sent as compressed ranges, and any per-task events are implied by
+    them. Notifications which would be too large are split up by task, or
+    failing that by the items of their last argument if it is a list (e.g.
+    the chunks of an ``output_log``), so that each part is an event of its own.
+
+    :raises ValueError: if a notification is too large, but cannot be split.
+
+    """
+    families = OrderedDict()
+    for e in events:
+        families.setdefault(_event_channel(e), []).append(e)
+    for channel, names in families.iteritems():
+        for payload in _encode_family(channel, names, list(args), kwargs):
+            yield channel, payload
+
+
+def _encode_family(channel, names, args, kwargs):
+
+    all_names = names
+    all_args = args
+
+    tids = args[0] if args else None
+    if _is_tid(tids):
+        tids = [tids]
+        msg = {'id': args[0]}
+    elif isinstance(tids, (list, tuple)) and tids and all(_is_tid(x) for x in tids):
+        msg = {'ids': utils.compress_ranges(tids)}
+    else:
+        tids = None
+        msg = {}
+
+    each = False
+    if tids is not None:
+        per_task = set('%s.%d' % (channel, tid) for tid in tids)
+        if per_task.issubset(names):
+            names = [e for e in names if e not in per_task]
+            each = True
+        args = args[1:]
+
+    msg.update(e=names, a=args, k=kwargs)
+    if each:
+        msg['each'] = True
+    payload = json.dumps(msg, separators=(',', ':'))
+
+    if len(payload) <= NOTIFY_MAX_PAYLOAD:
+        return [payload]
+
+    if each and len(tids) > 1:
+        tids = sorted(tids)
+        half = len(tids) // 2
+        return (
+            _encode_family(channel, names + ['%s.%d' % (channel, tid) for tid in tids[:half]], [tids[:half]] + args, kwargs) +
+            _encode_family(channel, names + ['%s.%d' % (channel, tid) for tid in tids[half:]], [tids[half:]] + args, kwargs)
+        )
+
+    if args and isinstance(args[-1], (list, tuple)) and len(args[-1]) > 1:
+        head = all_args[:len(all_args) - 1]
+        items = list(args[-1])
+        half = len(items) // 2
+        return (
+            _encode_family(channel, all_names, head + [items[:half]], kwargs) +
+            _encode_family(channel, all_names, head + [items[half:]], kwargs)
+        )
+
+    raise ValueError('%s notification is too large (%d bytes)' % (channel, len(payload)))
+
+
+def _decode_notification(channel, payload, bound=None):
+    """The inverse of :func:`_encode_notifications`.
+
+    :param bound: if given, only per-task events in this collection are
+        returned, so that we don't build events nobody is listening to.
+    :returns: ``(events, args, kwargs)``.
+
+    """
+    msg = json.loads(payload)
+    events = msg.get('e', [])
+    args = msg.get('a', [])
+    if 'id' in msg:
+        tids = [msg['id']]
+        args.insert(0, msg['id'])
+    elif 'ids' in msg:
+        tids = utils.expand_ranges(msg['ids'])
+        args.insert(0, tids)
+    if msg.get('each'):
+        per_task = ('%s.%d' % (channel, tid) for tid in tids)
+        events.extend(e for e in per_task if bound is None or e in bound)
+    return events, args, msg.get('k', {})
+
+
+# Encoders for Postgres' binary COPY format, keyed by the column's udt_name.
+# See: http://www.postgresql.org/docs/9.5/static/sql-copy.html
+
+_COPY_HEADER = 'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+_COPY_TRAILER = struct.pack('>h', -1)
+_COPY_NULL = struct.pack('>i', -1)
+
+
+def _copy_text(value):
+    if isinstance(value, unicode):
+        return value.encode('utf8')
+    if isinstance(value, str):
+        return value
+    raise TypeError('cannot COPY %r as text' % (value, ))
+
+
+def _is_text(value):
+    return value is None or isinstance(value, basestring)
+
+
+def _copy_bytea(value):
+    # We tend to have already wrapped these in a psycopg2 Binary.
+    return str(getattr(value, 'adapted', value))
+
+
+def _copy_array(oid, encode_element):
+    def encode(values):
+        values = list(values)
+        if not values:
+            return struct.pack('>iii', 0, 0, oid)
+        parts = [struct.pack('>iiiii', 1, int(None in values), oid, len(values), 1)]
+        for value in values:
+            if value is None:
+                parts.append(_COPY_NULL)
+            else:
+                data = encode_element(value)
+                parts.append(struct.pack('>i', len(data)))
+                parts.append(data)
+        return ''.join(parts)
+    return encode
+
+
+_copy_encoders = {
+    'int4': lambda v: struct.pack('>i', int(v)),
+    'int8': lambda v: struct.pack('>q', int(v)),
+    'float4': lambda v: struct.pack('>f', float(v)),
+    'float8': lambda v: struct.pack('>d', float(v)),
+    'text': _copy_text,
+    'bytea': _copy_bytea,
+    '_int4': _copy_array(23, lambda v: struct.pack('>i', int(v))),
+    '_text': _copy_array(25, _copy_text),
+}
+
+
 def _unpickle(kwargs):
     return PostgresBroker(**kwargs)
 _unpickle.__safe_for_unpickling__ = True
 
 
+class LazyTask(MutableMapping):
+    """A task which only decodes its pickled fields when they are accessed.
+
+    Fields which are still encoded are held as the raw ``buffer`` from the
+    database, and replaced with their decoded value upon first access. Anything
+    which needs the whole task (e.g. :meth:`items`, :meth:`copy`, or pickling)
+    decodes everything first, and copies or pickles come out as plain dicts.
+
+    This is not a ``dict`` subclass, since ``dict(task)``, ``d.update(task)``,
+    and ``func(**task)`` would read the encoded values straight from the
+    underlying storage.
+
+    """
+
+    def __init__(self, decode_field, *args, **kwargs):
+        self._data = dict(*args, **kwargs)
+        self._decode_field = decode_field
+
+    def __getitem__(self, key):
+        value = self._data[key]
+        if isinstance(value, buffer):
+            value = self._decode_field(key, value)
+            self._data[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self._data[key] = value
+
+    def __delitem__(self, key):
+        del self._data[key]
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def keys(self):
+        return self._data.keys()
+
+    def decode_all(self):
+        for key in self._data.keys():
+            self[key]
+
+    def copy(self):
+        self.decode_all()
+        return self._data.copy()
+
+    def __repr__(self):
+        return repr(self.copy())
+
+    def __reduce__(self):
+        return dict, (self.copy(), )
+
+
 class PostgresBroker(Broker):
     """A :class:`.Broker` which uses Postgresql_ as a data store and event dispatcher.
 
@@ -111,9 +406,15 @@ class PostgresBroker(Broker):
     def from_url(cls, parts):
         return cls(host=parts.netloc, database=parts.path.strip('/').lower())
 
+    search_itersize = SEARCH_ITERSIZE
+    blob_grace_period = BLOB_GRACE_PERIOD
+    future_resolution_window = FUTURE_RESOLUTION_WINDOW
+
     def __init__(self, **kwargs):
 
         self._kwargs = kwargs
+        self._blob_cache = utils.LRUCache(BLOB_CACHE_SIZE)
+        self._blobs_swept_at = None
         self._open_pool()
         self._reflect()
 
@@ -168,9 +469,19 @@ class PostgresBroker(Broker):
             self._pool.putconn(conn)
 
     @contextlib.contextmanager
-    def _cursor(self):
+    def _cursor(self, name=None, itersize=None):
+        """A cursor within its own transaction.
+
+        :param str name: create a server-side cursor with this name, so that
+            results may be streamed instead of fetched all at once.
+        :param int itersize: how many rows a server-side cursor should fetch
+            at a time.
+
+        """
         with self._connect() as conn:
-            with conn.cursor() as cur:
+            with (conn.cursor(name) if name else conn.cursor()) as cur:
+                if itersize:
+                    cur.itersize = itersize
                 yield cur
 
     def update_schema(self):
@@ -191,37 +502,180 @@ class PostgresBroker(Broker):
                     func(cur)
                     cur.execute('INSERT INTO schema_migrations (name) VALUES (%s)', [name])
 
+        self._reflect()
+
     def _reflect(self):
         with self._cursor() as cur:
-            cur.execute('''SELECT column_name, data_type FROM information_schema.columns WHERE table_name = 'tasks' ORDER BY ordinal_position''')
-            self._task_field_types = dict(cur)
+            cur.execute('''SELECT column_name, data_type, udt_name FROM information_schema.columns WHERE table_name = 'tasks' ORDER BY ordinal_position''')
+            columns = list(cur)
+        self._task_field_types = dict((name, type_) for name, type_, _ in columns)
+        self._task_field_udts = dict((name, udt) for name, _, udt in columns)
 
     def destroy_schema(self):
         with self._cursor() as cur:
             cur.execute('''DROP TABLE IF EXISTS schema_migrations''')
             cur.execute('''DROP TABLE IF EXISTS tasks''')
             cur.execute('''DROP TABLE IF EXISTS output_logs''')
+            cur.execute('''DROP TABLE IF EXISTS task_blobs''')
 
     def get_future(self, tid):
         self._event_loop.start_thread()
         return super(PostgresBroker, self).get_future(tid)
 
     def _create_many(self, prototypes):
-        fields, encoded = self._encode_many(prototypes)
+        prototypes = list(prototypes)
+        if not prototypes:
+            return []
+        blobs = {}
+        fields, encoded = self._encode_many(prototypes, blobs)
         with self._cursor() as cur:
-            params = [[e[f] for f in fields] for e in encoded]
-            fields = ', '.join('"%s"' % f for f in fields)
-            params_pattern = ','.join(["%s"] * len(params[0]))
-            params = [cur.mogrify(params_pattern, p) for p in params]
-            params = ', '.join('(%s)' % m for m in params)
-            try:
-                cur.execute('''INSERT INTO tasks (%s) VALUES %s RETURNING id''' % (fields, params))
-            except:
-                log.exception(repr(prototypes))
-                raise
-            tids = [row[0] for row in cur]
+            self._store_blobs(cur, blobs)
+            if self._can_copy(fields, encoded):
+                tids = self._copy_tasks(cur, encoded)
+            else:
+                tids = self._insert_tasks(cur, fields, encoded)
+            self._count_unfinished_dependencies(cur, tids)
         return [self.get_future(tid) for tid in tids]
 
+    def _can_copy(self, fields, encoded):
+        """Can these tasks be sent via COPY?
+
+        Unlike INSERT, COPY does not adapt values to their column's type, so
+        every column must have a binary encoding, and text must be strings.
+
+        """
+        udts = dict((f, self._task_field_udts.get(f)) for f in fields)
+        if not all(udt in _copy_encoders for udt in udts.itervalues()):
+            return False
+        for f, udt in udts.iteritems():
+            if udt == 'text':
+                if not all(_is_text(e.get(f)) for e in encoded):
+                    return False
+            elif udt == '_text':
+                if not all(e.get(f) is None or (isinstance(e[f], (list, tuple)) and all(_is_text(x) for x in e[f])) for e in encoded):
+                    return False
+        return True
+
+    def _insert_tasks(self, cur, fields, encoded):
+        # Columns which a task does not have take their defaults.
+        rows = []
+        for e in encoded:
+            pattern = ', '.join('%s' if f in e else 'DEFAULT' for f in fields)
+            rows.append('(%s)' % cur.mogrify(pattern, [e[f] for f in fields if f in e]))
+        fields = ', '.join('"%s"' % f for f in fields)
+        try:
+            cur.execute('''INSERT INTO tasks (%s) VALUES %s RETURNING id''' % (fields, ', '.join(rows)))
+        except:
+            log.exception(repr(encoded))
+            raise
+        return [row[0] for row in cur]
+
+    def _copy_tasks(self, cur, encoded):
+
+        # Allocate any IDs which weren't reserved, so that we know which is which.
+        missing = [row for row in encoded if 'id' not in row]
+        if missing:
+            for row, tid in zip(missing, self._reserve_ids(cur, len(missing))):
+                row['id'] = tid
+
+        # COPY has no notion of defaults for missing columns, so tasks are
+        # sent in groups which share the same ones.
+        groups = {}
+        for row in encoded:
+            groups.setdefault(tuple(sorted(row)), []).append(row)
+        for fields, rows in sorted(groups.iteritems(), key=lambda x: x[1][0]['id']):
+            self._copy_task_group(cur, fields, rows)
+
+        return [row['id'] for row in encoded]
+
+    def _copy_task_group(self, cur, fields, rows):
+
+        encoders = [_copy_encoders[self._task_field_udts[f]] for f in fields]
+        query = 'COPY tasks (%s) FROM STDIN WITH (FORMAT binary)' % ', '.join('"%s"' % f for f in fields)
+        row_header = struct.pack('>h', len(fields))
+
+        for start in xrange(0, len(rows), COPY_CHUNK_SIZE):
+            buf = StringIO()
+            buf.write(_COPY_HEADER)
+            for row in rows[start:start + COPY_CHUNK_SIZE]:
+                buf.write(row_header)
+                for field, encode in zip(fields, encoders):
+                    value = row[field]
+                    if value is None:
+                        buf.write(_COPY_NULL)
+                    else:
+                        data = encode(value)
+                        buf.write(struct.pack('>i', len(data)))
+                        buf.write(data)
+            buf.write(_COPY_TRAILER)
+            buf.seek(0)
+            cur.copy_expert(query, buf)
+
+    def reserve_ids(self, count):
+        with self._cursor() as cur:
+            return self._reserve_ids(cur, count)
+
+    def _reserve_ids(self, cur, count):
+        cur.execute('''SELECT nextval(pg_get_serial_sequence('tasks', 'id')) FROM generate_series(1, %s)''', [count])
+        return sorted(row[0] for row in cur)
+
+    def _count_unfinished_dependencies(self, cur, tids):
+
+        # Hold the dependencies still until we commit, so that any which are
+        # finishing concurrently will see us when adjusting their dependents.
+        cur.execute('''SELECT id FROM tasks WHERE id IN (
+            SELECT unnest(dependencies) FROM tasks WHERE id = ANY(%s)
+        ) ORDER BY id FOR SHARE''', [tids])
+
+        cur.execute('''UPDATE tasks SET unfinished_dependencies = (
+            SELECT count(*) FROM tasks AS deps
+            WHERE deps.id = ANY(tasks.dependencies) AND deps.status NOT IN %s
+        ) WHERE id = ANY(%s) AND array_length(dependencies, 1) > 0''', [tuple(FINISHED_STATUSES), tids])
+
+    def _adjust_dependents(self, cur, tids, delta):
+        if tids:
+            cur.execute('''UPDATE tasks SET unfinished_dependencies = unfinished_dependencies + %s * (
+                SELECT count(DISTINCT dep_id) FROM unnest(tasks.dependencies) AS dep_id WHERE dep_id = ANY(%s)
+            ) WHERE dependencies && %s::integer[]''', [delta, tids, tids])
+
+    def fetch_graph(self, root_ids, fields=None):
+        root_ids = list(root_ids)
+        if not root_ids:
+            return {}
+        if fields is not None:
+            fields = set(fields).union(('id', 'dependencies'))
+        fields = ', '.join('"%s"' % f for f in fields) if fields else '*'
+        with self._cursor() as cur:
+            # UNION (rather than UNION ALL) stops at nodes we have already seen.
+            cur.execute('''
+                WITH RECURSIVE graph(id) AS (
+                    SELECT unnest(%%s::integer[])
+                    UNION
+                    SELECT unnest(tasks.dependencies) FROM tasks JOIN graph ON tasks.id = graph.id
+                )
+                SELECT %s FROM tasks WHERE id IN (SELECT id FROM graph)
+            ''' % fields, [root_ids])
+            rows = list(cur)
+        tasks = {}
+        for row in rows:
+            task = self._decode_task(cur, row)
+            tasks[task['id']] = task
+        return tasks
+
+    def fetch_dependents(self, tids, fields=None):
+        tids = [tids] if isinstance(tids, int) else list(tids)
+        if not tids:
+            return {}
+        fields = ', '.join('"%s"' % f for f in fields) if fields else '*'
+        with self._cursor() as cur:
+            cur.execute('''SELECT %s FROM tasks WHERE dependencies && %%s::integer[]''' % fields, [tids])
+            rows = list(cur)
+        tasks = {}
+        for row in rows:
+            task = self._decode_task(cur, row)
+            tasks[task['id']] = task
+        return tasks
+
     def _fetch_many(self, tids, fields):
         if not tids:
             return {}
@@ -235,90 +689,262 @@ class PostgresBroker(Broker):
             tasks[task['id']] = task
         return tasks
 
-    def _encode(self, field, x):
-        if self._task_field_types.get(field) == 'bytea':
-            return pg.Binary(pickle.dumps(x, protocol=-1))
-        else:
+    def _encode(self, field, x, blobs=None):
+        """Encode a value for the given field.
+
+        :param dict blobs: if given, large values of :data:`BLOB_FIELDS` are
+            added to this (keyed by their hash), and only referenced from
+            the encoded value; equal values share the same reference.
+
+        """
+        if self._task_field_types.get(field) != 'bytea':
             return x
+        encoded = pickle.dumps(x, protocol=-1)
+        if blobs is not None and field in BLOB_FIELDS and len(encoded) >= BLOB_MIN_SIZE:
+            digest = hashlib.sha1(encoded).hexdigest()
+            try:
+                return blobs[digest][1]
+            except KeyError:
+                reference = pg.Binary(BLOB_MARKER + digest)
+                blobs[digest] = (encoded, reference)
+                return reference
+        return pg.Binary(encoded)
 
     def _decode(self, field, x):
         if isinstance(x, buffer):
+            if x[:len(BLOB_MARKER)] == BLOB_MARKER:
+                return self._load_blob(x[len(BLOB_MARKER):])
             return utils.safe_unpickle(x)
         else:
             return x
 
-    def _encode_task(self, task):
+    def _store_blobs(self, cur, blobs):
+        if blobs:
+            values = ', '.join(cur.mogrify('(%s, %s)', [digest, pg.Binary(content)]) for digest, (content, _) in blobs.iteritems())
+            # Existing blobs are touched so that they are not reclaimed out
+            # from under the tasks we are about to create.
+            cur.execute('''INSERT INTO task_blobs (hash, content) VALUES %s
+                ON CONFLICT (hash) DO UPDATE SET ctime = localtimestamp''' % values)
+
+    def _delete_unused_blobs(self, cur):
+        """Delete blobs which no task refers to, once they are old enough.
+
+        This scans every task, so it is only done as tasks are deleted, and at
+        most once per :attr:`blob_grace_period`.
+
+        """
+        references = ' UNION ALL '.join('SELECT "%s" AS value FROM tasks' % f for f in sorted(BLOB_FIELDS))
+        cur.execute('''DELETE FROM task_blobs
+            WHERE ctime < localtimestamp - %%s * interval '1 second'
+            AND hash NOT IN (
+                SELECT encode(substring(value FROM %%s), 'escape') FROM (%s) AS refs
+                WHERE substring(value FROM 1 FOR %%s) = %%s
+            )''' % references, [self.blob_grace_period, len(BLOB_MARKER) + 1, len(BLOB_MARKER), pg.Binary(BLOB_MARKER)])
+
+    def _load_blob(self, digest):
+        # The pickle is cached rather than the value, so that every caller
+        # gets their own copy to do with as they please.
+        content = self._blob_cache.get(digest, _missing)
+        if content is _missing:
+            with self._cursor() as cur:
+                cur.execute('SELECT content FROM task_blobs WHERE hash = %s', [digest])
+                row = cur.fetchone()
+            if row is None:
+                raise KeyError('missing task blob %s' % digest)
+            content = str(row[0])
+            self._blob_cache.put(digest, content)
+        return utils.safe_unpickle(content)
+
+    def _encode_task(self, task, blobs=None):
         extra = {}
         res = {}
         for k, v in task.iteritems():
             if k in self._task_field_types:
-                res[k] = self._encode(k, v)
+                res[k] = self._encode(k, v, blobs)
             else:
                 extra[k] = v
 
         if extra:
             res['extra'] = self._encode('extra', extra)
 
-        res.pop('id', None)
+        # Only keep IDs which were reserved ahead of time.
+        if res.get('id') is None:
+            res.pop('id', None)
 
         return res
 
-    def _encode_many(self, tasks):
-        keys = set(tasks[0])
-        fields = sorted(keys)
+    def _encode_many(self, tasks, blobs=None):
+        """Encode many tasks, which need not share the same keys.
+
+        :returns: ``(fields, encoded)``, where ``fields`` are all of the
+            columns used by any of the tasks.
+
+        """
         encoded = []
+        fields = set()
         for t in tasks:
-            if set(t) != keys:
-                raise ValueError('prototypes do not share keys')
-            e = self._encode_task(t)
+            e = self._encode_task(t, blobs)
+            fields.update(e)
             encoded.append(e)
-        return fields, encoded
+        return sorted(fields), encoded
 
     def _decode_task(self, cur, row):
-        task = dict((field[0], self._decode(field[0], value)) for field, value in zip(cur.description, row))
+        # Pickled fields are only decoded when they are used, except for
+        # "extra" which must be merged in now.
+        task = LazyTask(self._decode, ((field[0], value) for field, value in zip(cur.description, row)))
         task.update(task.pop('extra', None) or {})
         return task
 
     def _delete_many(self, tids):
         tids = list(tids)
         with self._cursor() as cur:
+            cur.execute('DELETE FROM tasks WHERE id = ANY(%s) AND status NOT IN %s RETURNING id', [tids, tuple(FINISHED_STATUSES)])
+            unfinished = [row[0] for row in cur]
             cur.execute('DELETE FROM tasks WHERE id = ANY(%s)', [tids])
             cur.execute('DELETE FROM output_logs WHERE task_id = ANY(%s)', [tids])
+            # Dependents of these will never see them finish.
+            self._adjust_dependents(cur, unfinished, -1)
+            now = time.time()
+            if self._blobs_swept_at is None or now - self._blobs_swept_at >= self.blob_grace_period:
+                self._delete_unused_blobs(cur)
+                self._blobs_swept_at = now
     
     def bind(self, events, callback=None):
         if self._event_loop:
             self._event_loop.start_thread()
-        return super(PostgresBroker, self).bind(events, callback)
+        res = super(PostgresBroker, self).bind(events, callback)
+        self._update_listening()
+        return res
+
+    def unbind(self, events, callback):
+        super(PostgresBroker, self).unbind(events, callback)
+        self._update_listening()
+
+    def _update_listening(self):
+        # The channels are LISTENed to from `to_select`.
+        if self._event_loop:
+            self._event_loop.update(self)
 
     def _send_remote_events(self, events, args, kwargs):
-        payload = json.dumps([args, kwargs])
         with self._cursor() as cur:
-            for e in events:
-                cur.execute('NOTIFY "%s", %%s' % e, [payload])
+            self._notify(cur, events, args, kwargs)
 
-    def _set_status(self, tids, status, result):
-        tids = [tids] if isinstance(tids, int) else list(tids)
+    def _notify(self, cur, events, args, kwargs):
+        # Failing to notify other processes should not undo what we are
+        # notifying them of.
         try:
-            encoded = self._encode('result', result)
-        except:
-            raise
-        # THIS IS WHERE IT APPEARS TO STICK
-        log.debug('setting status of %r to %r' % (tids, status))
+            notifications = list(_encode_notifications(events, args, kwargs))
+        except ValueError:
+            log.exception('could not notify other processes of %s' % ', '.join(events[:5]))
+            return
+        for channel, payload in notifications:
+            cur.execute('NOTIFY "%s", %%s' % channel, [payload])
+
+    def set_statuses_and_notify(self, updates):
+        # The update and its notifications go out in one transaction.
+        updates = _prepare_status_updates(updates)
+        if not updates:
+            return
+        notifications = [(_status_events(tids, status), (tids, status)) for status, tids in _group_status_updates(updates)]
         with self._cursor() as cur:
-            cur.execute('''UPDATE tasks SET status = %s, result = %s WHERE id = ANY(%s)''', [status, encoded, tids])
+            self._update_statuses(cur, updates)
+            for events, args in notifications:
+                self._notify(cur, events, args, {})
+        for events, args in notifications:
+            self._dispatch_local_events(events, args, {})
 
-    def _log_output(self, tid, fd, offset, content):
+    def _set_statuses(self, updates):
         with self._cursor() as cur:
-            cur.execute('INSERT INTO output_logs (task_id, fd, "offset", content) VALUES (%s, %s, %s, %s)', [
-                tid, fd, offset, content.encode('string-escape'),
-            ])
+            self._update_statuses(cur, updates)
+
+    def _update_statuses(self, cur, updates):
+
+        # Many tasks tend to share a result (e.g. None), so only encode each once.
+        encoded = {}
+        values = []
+        new_statuses = {}
+        for tid, status, result in updates:
+            try:
+                data = encoded[id(result)]
+            except KeyError:
+                data = encoded[id(result)] = self._encode('result', result)
+            values.append(cur.mogrify('(%s, %s, %s::bytea)', [tid, status, data]))
+            new_statuses[tid] = status
+
+        log.debug('setting status of %d tasks' % len(values))
+
+        cur.execute('''SELECT id, status FROM tasks WHERE id = ANY(%s) ORDER BY id FOR UPDATE''', [sorted(new_statuses)])
+        previous = dict(cur)
+
+        cur.execute('''UPDATE tasks SET status = v.status, result = v.result
+            FROM (VALUES %s) AS v (id, status, result)
+            WHERE tasks.id = v.id''' % ', '.join(values))
+
+        # Keep the dependents' counters in step with this.
+        finishing = []
+        unfinishing = []
+        for tid, old in previous.iteritems():
+            was_finished = old in FINISHED_STATUSES
+            if was_finished != (new_statuses[tid] in FINISHED_STATUSES):
+                (unfinishing if was_finished else finishing).append(tid)
+        self._adjust_dependents(cur, finishing, -1)
+        self._adjust_dependents(cur, unfinishing, 1)
+
+    def log_outputs_and_notify(self, tid, chunks):
+        # The rows and the notification go out in one transaction.
+        chunks = [tuple(c) for c in chunks]
+        if not chunks:
+            return
+        events = ['output_log', 'output_log.%d' % tid]
+        args = (tid, [(fd, offset, len(content)) for fd, offset, content in chunks])
+        with self._cursor() as cur:
+            self._insert_outputs(cur, tid, chunks)
+            self._notify(cur, events, args, {})
+        self._dispatch_local_events(events, args, {})
 
-    def get_output(self, tids):
+    def _log_outputs(self, tid, chunks):
         with self._cursor() as cur:
-            cur.execute('SELECT task_id, ctime, fd, "offset", content FROM output_logs WHERE task_id = ANY(%s) ORDER BY ctime', [tids])
-            return [(task_id, ctime, fd, offset, content.decode('string-escape')) for task_id, ctime, fd, offset, content in cur]
+            self._insert_outputs(cur, tid, chunks)
+
+    def _insert_outputs(self, cur, tid, chunks):
+        values = ', '.join(
+            cur.mogrify('(%s, %s, %s, %s)', [tid, fd, offset, pg.Binary(content)])
+            for fd, offset, content in chunks
+        )
+        cur.execute('INSERT INTO output_logs (task_id, fd, "offset", content) VALUES ' + values)
+
+    def get_output(self, tids, since_offsets=None):
+
+        since = [
+            (tid, fd, offset)
+            for tid, offsets in (since_offsets or {}).iteritems()
+            for fd, offset in offsets.iteritems()
+        ]
+
+        with self._cursor('get_output', itersize=1000) as cur:
+            # Rows written together share a ctime, so the offsets break ties.
+            cur.execute('''
+                SELECT logs.task_id, logs.ctime, logs.fd, logs."offset", logs.content
+                FROM output_logs AS logs
+                LEFT JOIN unnest(%s::integer[], %s::integer[], %s::integer[]) AS since(task_id, fd, "offset")
+                    ON since.task_id = logs.task_id AND since.fd = logs.fd
+                WHERE logs.task_id = ANY(%s) AND (since."offset" IS NULL OR logs."offset" >= since."offset")
+                ORDER BY logs.ctime, logs.task_id, logs.fd, logs."offset"
+            ''', [
+                [x[0] for x in since], [x[1] for x in since], [x[2] for x in since],
+                list(tids),
+            ])
+            for task_id, ctime, fd, offset, content in cur:
+                yield task_id, ctime, fd, offset, str(content)
 
     def search(self, filter=None, fields=None):
+        """Stream tasks from a server-side cursor.
+
+        The cursor holds a connection (and a transaction) until the iterator
+        is exhausted, so callers which stop early should ``close()`` it
+        rather than leave that to garbage collection.
+
+        """
 
         fields = ', '.join('"%s"' % f for f in fields) if fields else '*'
 
@@ -332,13 +958,23 @@ class PostgresBroker(Broker):
 
         query = '''SELECT %s FROM tasks %s''' % (fields, clause)
 
-        with self._cursor() as cur:
-
+        # Stream from a server-side cursor so that memory use does not grow
+        # with the size of the table; each row is decoded as it is reached.
+        conn = self._pool.getconn()
+        cur = conn.cursor('search')
+        try:
+            cur.itersize = self.search_itersize
             cur.execute(query, params)
-            rows = list(cur)
-
-        for row in rows:
-            yield self._decode_task(cur, row)
+            for row in cur:
+                yield self._decode_task(cur, row)
+        finally:
+            # We also get here if the caller abandons us part way through.
+            try:
+                cur.close()
+                conn.rollback()
+            except pg.Error:
+                log.exception('error while closing search cursor')
+            self._pool.putconn(conn)
 
     def acquire(self, tid):
 
@@ -366,6 +1002,58 @@ class PostgresBroker(Broker):
 
         return True
 
+    def claim(self, count, requirements=None):
+
+        requirements = requirements or {}
+
+        # Tasks are only claimable if nobody has asserted ownership recently.
+        clauses = [
+            "status = 'pending'",
+            'unfinished_dependencies = 0',
+            "(last_active IS NULL OR last_active < localtimestamp - %s * interval '1 second')",
+        ]
+        params = [ACTIVE_TIMEOUT]
+
+        if requirements.get('ids') is not None:
+            clauses.append('id = ANY(%s)')
+            params.append(list(requirements['ids']))
+        if requirements.get('cpus') is not None:
+            clauses.append('coalesce(cpus, 1) <= %s')
+            params.append(requirements['cpus'])
+        if requirements.get('memory') is not None:
+            clauses.append('coalesce(memory, 0) <= %s')
+            params.append(requirements['memory'])
+        if requirements.get('platform') is not None:
+            clauses.append('(platform IS NULL OR lower(platform) = lower(%s))')
+            params.append(requirements['platform'])
+
+        params.append(count)
+
+        # Rows that another worker is in the middle of claiming are skipped
+        # instead of waited on, so concurrent workers don't serialize on the
+        # same hot rows.
+        with self._cursor() as cur:
+            cur.execute('''
+                WITH claimable AS (
+                    SELECT id FROM tasks WHERE %s
+                    ORDER BY priority DESC, id
+                    LIMIT %%s
+                    FOR UPDATE SKIP LOCKED
+                )
+                UPDATE tasks SET first_active = localtimestamp, last_active = localtimestamp
+                FROM claimable WHERE tasks.id = claimable.id
+                RETURNING tasks.*
+            ''' % ' AND '.join(clauses), params)
+            tasks = [self._decode_task(cur, row) for row in cur]
+
+        if tasks:
+            with self._heartbeat_lock:
+                self._acquired_tids.update(t['id'] for t in tasks)
+            log.debug('claimed tasks %s' % ', '.join(str(t['id']) for t in tasks))
+
+        tasks.sort(key=lambda t: (-t['priority'], t['id']))
+        return tasks
+
     def release(self, tid):
         self._acquired_tids.remove(tid)
         with self._cursor() as cur:
@@ -384,16 +1072,17 @@ class PostgresBroker(Broker):
         if not self._notify_conn:
             self._notify_conn = self._pool.getconn()
 
-        to_listen = [e for e in self._bound_callbacks if e not in self._listening_to]
-        to_unlisten = self._listening_to.difference(self._bound_callbacks)
+        channels = set(_event_channel(e) for e, callbacks in self._bound_callbacks.items() if callbacks)
+        to_listen = channels.difference(self._listening_to)
+        to_unlisten = self._listening_to.difference(channels)
         if to_listen or to_unlisten:
             cur = self._notify_conn.cursor()
-            for e in to_listen:
-                cur.execute('LISTEN "%s"' % e)
-                self._listening_to.add(e)
-            for e in to_unlisten:
-                cur.execute('UNLISTEN "%s"' % e)
-                self._listening_to.remove(e)
+            for channel in to_listen:
+                cur.execute('LISTEN "%s"' % channel)
+                self._listening_to.add(channel)
+            for channel in to_unlisten:
+                cur.execute('UNLISTEN "%s"' % channel)
+                self._listening_to.remove(channel)
             self._notify_conn.commit()
 
         return [self._notify_conn.fileno()], (), ()
@@ -405,9 +1094,9 @@ class PostgresBroker(Broker):
 
         self._notify_conn.poll()
         while self._notify_conn.notifies:
-            message = self._notify_conn.notifies.pop()
+            message = self._notify_conn.notifies.pop(0)
             if message.pid == os.getpid():
                 continue
-            args, kwargs = json.loads(message.payload)
-            self._dispatch_local_events([message.channel], args, kwargs)
+            events, args, kwargs = _decode_notification(message.channel, message.payload, self._bound_callbacks)
+            self._dispatch_local_events(events, args, kwargs)
 
@@ -27,54 +27,40 @@ def output(args):
         watching = set(args.tids)
         queue = Queue()
 
+        # Notifications only say that there is more output; we go and get it.
         @args.broker.bind(['output_log.%d' % x for x in args.tids])
-        def on_log(tid, fd, offset, data):
-            queue.put((tid, fd, offset, data))
+        def on_log(tid, chunks):
+            queue.put((tid, False))
 
         @args.broker.bind(['task_status.%s' % x for x in args.tids])
         def on_status(tids, status):
             if status in ('success', 'error', 'killed'):
                 for tid in tids:
-                    queue.put((tid, None, None, None))
+                    queue.put((tid, True))
 
         found = args.broker.fetch(args.tids)
         watching.intersection_update(found)
         for task in found.itervalues():
             if task['status'] != 'pending':
-                queue.put((task['id'], None, None, None))
+                queue.put((task['id'], True))
 
-        queue.put((None, None, None, None))
-
-    max_offsets = dict((tid, {1: -1, 2: -1}) for tid in args.tids)
-
-    for tid, ctime, fd, offset, data in args.broker.get_output(args.tids):
-        stream = {1: sys.stdout, 2: sys.stderr}.get(fd)
-        if stream:
-            max_offsets[tid][fd] = max(max_offsets[tid][fd], offset)
-            stream.write(args.format.format(**locals()))
-            stream.flush()
-
-    if args.watch:
-        while watching:
-
-            tid, fd, offset, data = queue.get()
-            if fd is None:
-                try:
-                    watching.remove(tid)
-                except KeyError:
-                    pass
-                continue
+    # The next offset we expect for each fd.
+    next_offsets = dict((tid, {1: 0, 2: 0}) for tid in args.tids)
 
+    def dump(tids):
+        for tid, ctime, fd, offset, data in args.broker.get_output(tids, next_offsets):
             stream = {1: sys.stdout, 2: sys.stderr}.get(fd)
             if stream:
-
-                if offset <= max_offsets[tid][fd]:
-                    continue
-                else:
-                    max_offsets[tid][fd] = offset
-
+                next_offsets[tid][fd] = max(next_offsets[tid][fd], offset + len(data))
                 stream.write(args.format.format(**locals()))
                 stream.flush()
 
+    dump(args.tids)
 
-
+    if args.watch:
+        while watching:
+            tid, finished = queue.get()
+            if tid in watching:
+                dump([tid])
+            if finished:
+                watching.discard(tid)
@@ -15,8 +15,10 @@ All of the fields of the standard task prototype are availible to `--filter`,
 
 """
 
+from collections import Mapping
 import csv
 import os
+import string
 import sys
 
 from aque.commands.main import command, argument
@@ -26,7 +28,7 @@ def walk_tasks(tasks, max_depth=0, depth_first=False, _depth=1):
     """Return an iterator of (depth, task, dependencies)."""
 
     for task in tasks:
-        dependencies = filter(lambda t: isinstance(t, dict), task.get('dependencies', ()))
+        dependencies = filter(lambda t: isinstance(t, Mapping), task.get('dependencies', ()))
         if not depth_first:
             yield _depth, task, dependencies
         if not max_depth or _depth < max_depth:
@@ -123,5 +125,7 @@ def status(args):
             data = [str(task.get(f)) for f in fields]
             writer.writerow(data)
         else:
-            print '\t' * (depth-1) + args.pattern.format(**task)
+            # Look fields up one at a time so that only those in the pattern
+            # need to be decoded.
+            print '\t' * (depth-1) + string.Formatter().vformat(args.pattern, (), task)
 
@@ -48,7 +48,7 @@ def submit(args):
         cmd.insert(1, '-c')
         cmd.insert(3, 'aque-submit')
 
-    options = {'environ': os.environ}
+    options = {'environ': dict(os.environ)}
 
     for k in ('cpus', 'cwd', 'host', 'platform', 'priority'):
         v = getattr(args, k, None)
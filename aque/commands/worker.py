@@ -17,6 +17,8 @@ from aque.worker import Worker
     argument('-1', '--one', action='store_true', help='run only a single task'),
     argument('-2', '--to-end', action='store_true', help='run only until there is nothing pending on the queue'),
     argument('-c', '--cpus', type=int, metavar='CPU_COUNT', help='how many CPUs to use'),
+    argument('-p', '--preload', action='append', default=[], metavar='MODULE', help='module to import once before forking tasks; may be given multiple times'),
+    argument('--max-tasks-per-child', type=int, metavar='COUNT', help='how many tasks an interpreter sandbox runs before it is replaced'),
     help='run a worker',
     description=__doc__,
 )
@@ -27,7 +29,8 @@ def worker(args):
         worker.stop()
     signal.signal(signal.SIGHUP, on_hup)
 
-    worker = Worker(args.broker, max_cpus=args.cpus)
+    worker = Worker(args.broker, max_cpus=args.cpus, preload=args.preload,
+        max_tasks_per_child=args.max_tasks_per_child)
     try:
         if args.one:
             worker.run_one()
@@ -37,3 +40,5 @@ def worker(args):
             worker.run_forever()
     except KeyboardInterrupt:
         pass
+    finally:
+        worker.close()
@@ -10,8 +10,11 @@ from __future__ import division
 import argparse
 import itertools
 import os
+import Queue
 import sys
 import shlex
+import threading
+import time
 
 import psutil
 
@@ -19,24 +22,71 @@ from aque.commands.main import main, command, argument, group
 from aque import utils
 
 
+# Tasks are submitted in chunks of this many, or after this many seconds.
+SUBMIT_CHUNK_SIZE = 1000
+SUBMIT_CHUNK_INTERVAL = 1.0
+
+
+def iter_lines():
+    # Iterating over the file directly reads ahead, which would hold up
+    # submission until a whole buffer's worth of lines has arrived.
+    return iter(sys.stdin.readline, '')
+
 def grouper(iterable, n, fillvalue=None):
     "Collect data into fixed-length chunks or blocks"
     args = [iter(iterable)] * n
     return itertools.izip_longest(fillvalue=fillvalue, *args)
 
 def tokenize_lines(count):
-    for lines in grouper(sys.stdin, count):
+    for lines in grouper(iter_lines(), count):
         tokens = []
         for line in lines:
-            tokens.extend(shlex.split(line))
+            if line is not None:
+                tokens.extend(shlex.split(line))
         yield tokens
 
 def tokenize_all():
-    return [itertools.chain.from_iterable(shlex.split(line) for line in sys.stdin)]
+    return [itertools.chain.from_iterable(shlex.split(line) for line in iter_lines())]
 
 def tokenize_words(count):
     return grouper(tokenize_all()[0], count)
 
+def iter_with_timeouts(iterable, get_timeout):
+    """Iterate in a background thread, so that we can stop waiting for it.
+
+    :param get_timeout: called before each wait, to get how long to wait for.
+    :returns: iterator of items, with ``None`` whenever a wait times out.
+
+    """
+
+    items = Queue.Queue(SUBMIT_CHUNK_SIZE)
+
+    def target():
+        try:
+            for item in iterable:
+                items.put((True, item))
+        except:
+            items.put((False, sys.exc_info()))
+        else:
+            items.put((False, None))
+
+    thread = threading.Thread(target=target)
+    thread.daemon = True
+    thread.start()
+
+    while True:
+        try:
+            ok, value = items.get(timeout=get_timeout())
+        except Queue.Empty:
+            yield None
+            continue
+        if ok:
+            yield value
+        elif value is None:
+            return
+        else:
+            raise value[0], value[1], value[2]
+
 
 @command(
 
@@ -85,14 +135,40 @@ def xargs(args):
         cpus = None
 
 
-    options = {'environ': os.environ}
+    options = {'environ': dict(os.environ)}
     for k in ('cwd', 'host', 'platform', 'priority'):
         v = getattr(args, k, None)
         if v is not None:
             options[k] = getattr(args, k)
 
-    prototypes = []
-    for tokens in token_iter:
+    # Only the IDs are held on to, so memory stays flat however much input
+    # there is, and workers can get going while stdin is still being read.
+    tids = []
+    chunk = []
+    chunk_start = None
+
+    def submit_chunk():
+        future_map = args.queue.submit_many(chunk)
+        chunk_tids = sorted(f.id for f in future_map.itervalues())
+        tids.extend(chunk_tids)
+        if args.verbose:
+            print '\n'.join(str(tid) for tid in chunk_tids)
+            sys.stdout.flush()
+        del chunk[:]
+
+    # Input may stall (e.g. `tail -f | aque xargs ...`), so we don't only
+    # check on the chunk as lines arrive.
+    def time_left():
+        if not chunk:
+            return SUBMIT_CHUNK_INTERVAL
+        return max(0, chunk_start + SUBMIT_CHUNK_INTERVAL - time.time())
+
+    for tokens in iter_with_timeouts(token_iter, time_left):
+
+        if tokens is None:
+            if chunk and not time_left():
+                submit_chunk()
+            continue
 
         cmd = list(args.command)
         if args.shell:
@@ -113,21 +189,24 @@ def xargs(args):
             io_paths=utils.paths_from_args(cmd),
         )
 
-        prototypes.append(prototype)
+        if not chunk:
+            chunk_start = time.time()
+        chunk.append(prototype)
+        if len(chunk) >= SUBMIT_CHUNK_SIZE or not time_left():
+            submit_chunk()
 
-    future_map = args.queue.submit_many(prototypes)
-    if args.verbose:
-        print '\n'.join(str(tid) for tid in sorted(f.id for f in future_map.itervalues()))
+    if chunk:
+        submit_chunk()
 
     future = args.queue.submit_ex(
         pattern=None,
         name=args.name or 'xargs ' + ' '.join(args.command),
-        dependencies=future_map.values(),
+        dependencies=tids,
     )
 
     if args.watch:
         args = ['output', '--watch']
-        args.extend(str(f.id) for f in future_map.itervalues())
+        args.extend(str(tid) for tid in tids)
         args.append(str(future.id))
         return main(args)
 
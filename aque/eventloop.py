@@ -1,6 +1,10 @@
 import errno
+import heapq
+import itertools
 import logging
+import math
 import os
+import select as _select
 import threading
 import time
 from select import select, error as SelectError
@@ -10,10 +14,228 @@ from Queue import Empty
 log = logging.getLogger(__name__)
 
 
+# Bits of a poller mask; in the same order as the lists from `to_select`.
+READ = 1
+WRITE = 2
+EXCEPT = 4
+
+
+# What a repeating timer does when it falls behind schedule.
+CATCH_UP_SKIP = 'skip' # fire once, and then carry on with the schedule
+CATCH_UP_ALL = 'all' # fire for every tick that was missed
+CATCH_UP_DELAY = 'delay' # fire once, and restart the interval from then
+
+
 class StopSelection(Exception):
     pass
 
 
+class Timer(object):
+    """A handle for a function scheduled via :meth:`EventLoop.add_timer`."""
+
+    def __init__(self, interval, func, repeat, catch_up):
+        if catch_up not in (CATCH_UP_SKIP, CATCH_UP_ALL, CATCH_UP_DELAY):
+            raise ValueError('bad catch_up %r' % catch_up)
+        if interval < 0 or (repeat and not interval):
+            raise ValueError('bad interval %r for %s timer' % (interval, 'repeating' if repeat else 'one-shot'))
+        self.interval = interval
+        self.func = func
+        self.repeat = repeat
+        self.catch_up = catch_up
+        self.deadline = None
+        self.cancelled = False
+
+    def __repr__(self):
+        return '<Timer %s every %ss at 0x%x>' % (self.func, self.interval, id(self))
+
+
+def _errno(e):
+    return e.args[0] if e.args else getattr(e, 'errno', None)
+
+
+def _is_eintr(e):
+    return _errno(e) == errno.EINTR
+
+
+def wait_readable(fd, timeout=None):
+    """Wait for a single fd to be readable; not subject to ``FD_SETSIZE``."""
+    if hasattr(_select, 'poll'):
+        poller = _select.poll()
+        poller.register(fd, _select.POLLIN)
+        return bool(poller.poll(None if timeout is None else timeout * 1000))
+    r, _, _ = select([fd], [], [], timeout)
+    return bool(r)
+
+
+class SelectPoller(object):
+    """Poller on top of ``select.select``; the fallback for all platforms."""
+
+    def __init__(self):
+        self._masks = {}
+
+    def close(self):
+        self._masks.clear()
+
+    def register(self, fd, mask):
+        self._masks[fd] = mask
+
+    def modify(self, fd, mask):
+        self._masks[fd] = mask
+
+    def unregister(self, fd):
+        self._masks.pop(fd, None)
+
+    def poll(self, timeout):
+        lists = [], [], []
+        for fd, mask in self._masks.iteritems():
+            for bit, fds in zip((READ, WRITE, EXCEPT), lists):
+                if mask & bit:
+                    fds.append(fd)
+        return select(lists[0], lists[1], lists[2], timeout)
+
+
+class _KernelPoller(object):
+    """Shared implementation of the ``poll``-like pollers.
+
+    Registrations persist between calls, so only changes need to be passed
+    to the kernel.
+
+    """
+
+    _default_timeout = None
+    _timeout_scale = 1
+
+    def __init__(self):
+        self._poller = self._create()
+
+    def close(self):
+        close = getattr(self._poller, 'close', None)
+        if close:
+            close()
+        self._poller = None
+
+    def _encode(self, mask):
+        return (
+            (self._read_in if mask & READ else 0) |
+            (self._write_in if mask & WRITE else 0) |
+            (self._except_in if mask & EXCEPT else 0)
+        )
+
+    def register(self, fd, mask):
+        self._poller.register(fd, self._encode(mask))
+
+    def modify(self, fd, mask):
+        self._poller.modify(fd, self._encode(mask))
+
+    def unregister(self, fd):
+        try:
+            self._poller.unregister(fd)
+        except KeyError:
+            pass
+
+    def poll(self, timeout):
+        if timeout is None:
+            timeout = self._default_timeout
+        else:
+            # The kernel works in whole milliseconds; round up so that we
+            # don't wake up just before a timer is due.
+            timeout = math.ceil(timeout * 1000) / 1000.0 * self._timeout_scale
+        r, w, x = [], [], []
+        for fd, events in self._poller.poll(timeout):
+            if events & self._read_out:
+                r.append(fd)
+            if events & self._write_out:
+                w.append(fd)
+            if events & self._except_out:
+                x.append(fd)
+        return r, w, x
+
+
+if hasattr(_select, 'poll'):
+
+    class PollPoller(_KernelPoller):
+        """Poller on top of ``select.poll``."""
+
+        _create = staticmethod(_select.poll)
+        _timeout_scale = 1000
+
+        _read_in = _select.POLLIN
+        _write_in = _select.POLLOUT
+        _except_in = _select.POLLPRI
+
+        # Hangups and errors are reported as readable (like select does), as
+        # are closed fds so that their owner is asked about them again.
+        _read_out = _select.POLLIN | _select.POLLHUP | _select.POLLERR | _select.POLLNVAL
+        _write_out = _select.POLLOUT | _select.POLLERR
+        _except_out = _select.POLLPRI
+
+
+if hasattr(_select, 'epoll'):
+
+    class EpollPoller(_KernelPoller):
+        """Poller on top of ``select.epoll`` (Linux).
+
+        Epoll tracks the underlying open file, not the fd number, and so a
+        registration outlives the fd if it is closed while shared with
+        another process (e.g. a child). We therefore register our own
+        duplicate of every fd, which we can always cleanly unregister.
+
+        """
+
+        _create = staticmethod(_select.epoll)
+        _default_timeout = -1
+
+        _read_in = _select.EPOLLIN
+        _write_in = _select.EPOLLOUT
+        _except_in = _select.EPOLLPRI
+
+        _read_out = _select.EPOLLIN | _select.EPOLLHUP | _select.EPOLLERR
+        _write_out = _select.EPOLLOUT | _select.EPOLLERR
+        _except_out = _select.EPOLLPRI
+
+        def __init__(self):
+            super(EpollPoller, self).__init__()
+            self._dups = {}
+            self._originals = {}
+
+        def close(self):
+            for dup in self._dups.itervalues():
+                os.close(dup)
+            self._dups.clear()
+            self._originals.clear()
+            super(EpollPoller, self).close()
+
+        def register(self, fd, mask):
+            dup = os.dup(fd)
+            self._dups[fd] = dup
+            self._originals[dup] = fd
+            super(EpollPoller, self).register(dup, mask)
+
+        def modify(self, fd, mask):
+            super(EpollPoller, self).modify(self._dups[fd], mask)
+
+        def unregister(self, fd):
+            dup = self._dups.pop(fd, None)
+            if dup is not None:
+                del self._originals[dup]
+                super(EpollPoller, self).unregister(dup)
+                os.close(dup)
+
+        def poll(self, timeout):
+            return [
+                [self._originals[fd] for fd in fds if fd in self._originals]
+                for fds in super(EpollPoller, self).poll(timeout)
+            ]
+
+
+if hasattr(_select, 'epoll'):
+    DefaultPoller = EpollPoller
+elif hasattr(_select, 'poll'):
+    DefaultPoller = PollPoller
+else:
+    DefaultPoller = SelectPoller
+
+
 class SelectableEvent(object):
     """Like ``threading.Event``, but ``select``able."""
 
@@ -30,8 +252,7 @@ class SelectableEvent(object):
             self._rfd = None
 
     def wait(self, timeout=None):
-        r, _, _ = select([self._rfd], [], [], timeout)
-        return bool(r)
+        return wait_readable(self._rfd, timeout)
 
     def is_set(self):
         return self.wait(0)
@@ -49,15 +270,54 @@ class SelectableEvent(object):
 
 
 class EventLoop(object):
+    """Dispatches fd readiness and timers to a set of objects.
 
-    def __init__(self):
+    Objects declare the fds they are interested in via ``to_select()``, which
+    returns lists of fds to read, write, and check for exceptional conditions
+    (as ``select.select`` takes). It is asked when the object is added, after
+    each call to its ``on_select(rfds, wfds, xfds)``, and whenever
+    :meth:`update` is called for it; the fds are registered with the poller
+    until then. Each pass only dispatches to the owners of the fds which the
+    poller returns, so idle objects cost nothing.
+
+    ``to_select()`` may instead return lists which are all empty, to have
+    ``on_select`` called on every pass (so that the object may poll), or
+    ``None`` if it is waiting on something other than an fd (and will call
+    :meth:`update` once that changes). Either method may raise
+    :class:`StopSelection` to stop the object.
+
+    :param poller_class: the poller to use; defaults to the best availible,
+        e.g. :class:`EpollPoller` on Linux.
+
+    """
+
+    def __init__(self, poller_class=None):
 
         self.active = []
         self.stopped = []
 
-        self.timers = []
+        self._poller_class = poller_class or DefaultPoller
+        self._poller = None
+        self._poller_pid = None
+
+        # What each active object (keyed by ID) last said it selects on, as
+        # {fd: mask}; the objects interested in each fd; the objects to call
+        # on every pass; and what is registered with the poller for each fd.
+        self._active_ids = set()
+        self._selections = {}
+        self._owners = {}
+        self._polling = {}
+        self._registered = {}
+
+        # Objects to ask for their fds before the next poll.
+        self._changed = {}
+
+        # A heap of (deadline, sequence, timer); cancelled timers are left in
+        # place until they are popped.
+        self._timers = []
+        self._timer_sequence = itertools.count()
+        self._timers_by_func = {}
         self._zero_time = time.time()
-        self._last_time = 0
 
         # This is used to signal of the thread has been suspended or not.
         self._interrupt = SelectableEvent()
@@ -66,25 +326,135 @@ class EventLoop(object):
         self._thread_stopped = threading.Event()
         self._thread = None
 
-    def add_timer(self, timeout, func):
+    @property
+    def timers(self):
+        return [t for timers in self._timers_by_func.itervalues() for t in timers]
+
+    def _now(self):
+        return time.time() - self._zero_time
+
+    def add_timer(self, interval, func, repeat=True, catch_up=CATCH_UP_SKIP):
+        """Schedule a function to be called from :meth:`process`.
+
+        :param float interval: seconds between calls. Repeating timers tick on
+            multiples of this (since the loop was created), so it must be
+            positive, while one-shot timers fire this long from now (or on the
+            next pass if zero).
+        :param func: the function to call; it may raise :class:`StopSelection`
+            to cancel itself.
+        :param bool repeat: keep calling the function, or only call it once.
+        :param str catch_up: what a repeating timer should do when it falls
+            behind; one of ``CATCH_UP_SKIP`` (the default), ``CATCH_UP_ALL``, or
+            ``CATCH_UP_DELAY``.
+        :returns: a :class:`Timer`, which may be passed to :meth:`remove_timer`.
+
+        """
+        timer = Timer(interval, func, repeat, catch_up)
+        now = self._now()
+        deadline = now - (now % interval) + interval if repeat else now + interval
         with self._state_lock:
-            self.timers.append((timeout, func))
+            self._timers_by_func.setdefault(func, []).append(timer)
+            self._schedule_timer(timer, deadline)
             self._interrupt.set()
+        return timer
+
+    def _schedule_timer(self, timer, deadline):
+        timer.deadline = deadline
+        heapq.heappush(self._timers, (deadline, next(self._timer_sequence), timer))
 
-    def remove_timer(self, func_to_remove):
+    def remove_timer(self, func_or_timer):
+        """Cancel a :class:`Timer`, or all timers for the given function."""
         with self._state_lock:
-            self.timers = [(timeout, func) for timeout, func in self.timers if func != func_to_remove]
+            if isinstance(func_or_timer, Timer):
+                timers = [func_or_timer]
+                siblings = self._timers_by_func.get(func_or_timer.func, [])
+                if func_or_timer in siblings:
+                    siblings.remove(func_or_timer)
+                if not siblings:
+                    self._timers_by_func.pop(func_or_timer.func, None)
+            else:
+                timers = self._timers_by_func.pop(func_or_timer, ())
+            for timer in timers:
+                timer.cancelled = True
+
+            # Don't let the cancelled ones pile up.
+            if len(self._timers) > 2 * sum(map(len, self._timers_by_func.itervalues())) + 64:
+                self._timers = [x for x in self._timers if not x[2].cancelled]
+                heapq.heapify(self._timers)
+
             self._interrupt.set()
 
+    def _next_deadline(self):
+        with self._state_lock:
+            while self._timers and self._timers[0][2].cancelled:
+                heapq.heappop(self._timers)
+            return self._timers[0][0] if self._timers else None
+
+    def _pop_due_timers(self, now):
+        due = []
+        with self._state_lock:
+            while self._timers and self._timers[0][0] <= now:
+                _, _, timer = heapq.heappop(self._timers)
+                if not timer.cancelled:
+                    due.append(timer)
+        return due
+
+    def _fire_timers(self):
+
+        # Every timer is triggered at most once per pass; how they catch up
+        # after falling behind is up to their catch-up policy.
+        now = self._now()
+        for timer in self._pop_due_timers(now):
+
+            # An earlier one may have cancelled it.
+            if timer.cancelled:
+                continue
+
+            try:
+                timer.func()
+            except StopSelection:
+                self.remove_timer(timer)
+                continue
+
+            with self._state_lock:
+                if timer.cancelled:
+                    continue
+                if not timer.repeat:
+                    self.remove_timer(timer)
+                    continue
+                if timer.catch_up == CATCH_UP_ALL:
+                    deadline = timer.deadline + timer.interval
+                elif timer.catch_up == CATCH_UP_DELAY:
+                    deadline = now + timer.interval
+                else:
+                    deadline = now - (now % timer.interval) + timer.interval
+                self._schedule_timer(timer, deadline)
+
     def add(self, obj):
         with self._state_lock:
             self.active.append(obj)
+            self._active_ids.add(id(obj))
+            self._changed[id(obj)] = obj
+            self._interrupt.set()
+
+    def update(self, obj):
+        """Ask an object for its fds again before the next poll.
+
+        This must be called whenever an object's fds change (or it would
+        raise :class:`StopSelection`) other than during its own ``on_select``.
+        It is safe to call from any thread.
+
+        """
+        with self._state_lock:
+            self._changed[id(obj)] = obj
             self._interrupt.set()
 
     def stop(self, obj):
         with self._state_lock:
             self.active.remove(obj)
+            self._active_ids.discard(id(obj))
             self.stopped.append(obj)
+            self._changed[id(obj)] = obj
             self._interrupt.set()
 
     def remove(self, obj):
@@ -97,72 +467,158 @@ class EventLoop(object):
                 self.stopped.remove(obj)
             except ValueError:
                 pass
+            self._active_ids.discard(id(obj))
+            self._changed[id(obj)] = obj
             self._interrupt.set()
 
+    def _get_poller(self):
+
+        # A forked child shares the kernel's poller with its parent, so it
+        # must not touch those registrations (but closing is fine).
+        if self._poller_pid != os.getpid():
+            if self._poller is not None:
+                self._poller.close()
+            self._poller = self._poller_class()
+            self._poller_pid = os.getpid()
+            self._poller.register(self._interrupt.fileno(), READ)
+            self._selections = {}
+            self._owners = {}
+            self._polling = {}
+            self._registered = {}
+            self._refresh_all()
+
+        return self._poller
+
+    def _refresh_all(self):
+        with self._state_lock:
+            for obj in self.active:
+                self._changed[id(obj)] = obj
+
+    def _apply_changes(self):
+
+        with self._state_lock:
+            changed = self._changed
+            self._changed = {}
+
+        touched = set()
+        for key, obj in changed.iteritems():
+
+            old = self._selections.pop(key, {})
+            new = {}
+            self._polling.pop(key, None)
+
+            if key in self._active_ids:
+                try:
+                    fds = obj.to_select()
+                except StopSelection:
+                    self.stop(obj)
+                    with self._state_lock:
+                        self._changed.pop(key, None)
+                    fds = None
+                if fds is not None and not any(fds):
+                    self._polling[key] = obj
+                elif fds is not None:
+                    for bit, fd_list in zip((READ, WRITE, EXCEPT), fds):
+                        for fd in fd_list:
+                            new[fd] = new.get(fd, 0) | bit
+                    self._selections[key] = new
+
+            for fd in old:
+                if fd not in new:
+                    owners = self._owners[fd]
+                    del owners[key]
+                    if not owners:
+                        del self._owners[fd]
+                    touched.add(fd)
+            for fd, mask in new.iteritems():
+                self._owners.setdefault(fd, {})[key] = obj
+                if old.get(fd) != mask:
+                    touched.add(fd)
+
+        poller = self._get_poller()
+        for fd in touched:
+
+            # The owners are part of the key so that an fd number which is
+            # reused by another object is re-registered.
+            owners = self._owners.get(fd)
+            key = None
+            if owners:
+                mask = 0
+                for owner in owners:
+                    mask |= self._selections[owner][fd]
+                key = (mask, frozenset(owners))
+
+            registered = self._registered.get(fd)
+            if registered == key:
+                continue
+            if registered is not None:
+                poller.unregister(fd)
+                del self._registered[fd]
+            if key is not None:
+                poller.register(fd, key[0])
+                self._registered[fd] = key
+
     def process(self, timeout=None):
 
         self._interrupt.clear()
-        to_select = [self._interrupt.fileno()], [], []
-
-        objs_and_fds = []
-        for obj in self.active[:]:
-            try:
-                fds = obj.to_select()
-            except StopSelection:
-                self.stop(obj)
-            else:
-                objs_and_fds.append((obj, fds))
-                for all_, new in zip(to_select, fds):
-                    all_.extend(new)
 
+        # Only objects which were added, dispatched, or updated since the last
+        # pass are asked for their fds.
+        self._get_poller()
+        self._apply_changes()
 
         # Establish when the next timer will tick, and adjust timeout accordingly.
-        current_time = time.time() - self._zero_time
-        timers = []
-        for interval, func in self.timers:
-            next_tick = self._last_time + interval - (self._last_time % interval)
-            time_to_next_tick = next_tick - current_time
-            timers.append((next_tick, func))
+        next_deadline = self._next_deadline()
+        if next_deadline is not None:
+            time_to_next_tick = next_deadline - self._now()
             timeout = time_to_next_tick if timeout is None else min(timeout, time_to_next_tick)
         timeout = None if timeout is None else max(0, timeout)
 
-        log.log(5, '%d fds to select from %d objects and %d timers over %ss' % (sum(map(len, to_select)), len(self.active), len(self.timers), timeout))
+        log.log(5, '%d fds to select from %d objects and %d timers over %ss' % (len(self._registered), len(self.active), len(self._timers), timeout))
         
         # Bail if it is only the interrupt we are listening to.
-        if sum(map(len, to_select)) == 1 and not self.timers:
+        if not self._registered and not self._polling and next_deadline is None:
             return
 
         try:
-            selected = select(to_select[0], to_select[1], to_select[2], timeout)
+            selected = self._poller.poll(timeout)
 
         # This tends to happen a LOT.
-        except SelectError as e:
-            if e.args[0] != errno.EINTR:
+        except (SelectError, IOError, OSError) as e:
+            if _is_eintr(e):
+                log.debug('select was interupted')
+            elif _errno(e) == errno.EBADF:
+                log.warning('an fd was closed without updating the event loop')
+                self._refresh_all()
+            else:
                 raise
-            log.debug('select was interupted')
             selected = ((), (), ())
 
-        selected = [set(x) for x in selected]
+        self._fire_timers()
 
+        # Only dispatch to objects with something to do (or which are polling).
+        ready = dict((key, (obj, (set(), set(), set()))) for key, obj in self._polling.iteritems())
+        for i, fds in enumerate(selected):
+            for fd in fds:
+                for key, obj in self._owners.get(fd, {}).iteritems():
+                    ready.setdefault(key, (obj, (set(), set(), set())))[1][i].add(fd)
 
-        # Trigger some timers!
-        # Notice that we will only trigger the timer once even if it would have
-        # triggered several times since it was run last.
-        self._last_time = current_time = time.time() - self._zero_time
-        for next_tick, func in timers:
-            if current_time >= next_tick:
-                try:
-                    func()
-                except StopSelection:
-                    self.remove_timer(func)
+        # Anything we dispatch to may have changed its fds.
+        with self._state_lock:
+            for key, (obj, _) in ready.iteritems():
+                self._changed[key] = obj
 
-        for obj, fds in objs_and_fds:
-            fds = [s.intersection(x) for x, s in zip(fds, selected)]
+        for key, (obj, fds) in ready.iteritems():
+            # An earlier one may have stopped it.
+            if key not in self._active_ids:
+                continue
             try:
                 obj.on_select(*fds)
             except StopSelection:
                 self.stop(obj)
 
+        self._apply_changes()
+
         return sum(len(x) for x in selected)
 
     def start_thread(self):
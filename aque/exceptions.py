@@ -13,3 +13,7 @@ class PatternMissingError(RuntimeError):
 
 class DependencyFailedError(RuntimeError):
     """Raises by :meth:`.Task.result` when a dependency of the task failed."""
+
+class ServiceError(RuntimeError):
+    """Raised by :meth:`.Task.result` when the service of a task using the
+    :ref:`service pattern <patterns>` reports an error (or exits)."""
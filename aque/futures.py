@@ -1,3 +1,5 @@
+import collections
+
 from concurrent.futures import _base
 
 
@@ -13,19 +15,22 @@ class Future(_base.Future):
         return '<Future at 0x%x for task %d>' % (id(self), self.id)
     
     def iter(self):
-        return self._iter(set())
-
-    def _iter(self, visited):
-
-        if self.id in visited:
-            return
-        visited.add(self.id)
-        yield self
-
-        for dep_id in self.broker.fetch(self.id).get('dependencies', ()):
-            dep = self.broker.get_future(dep_id)
-            for x in dep._iter(visited):
-                yield x
+        """Iterate over this future and those of all its dependencies.
+
+        The whole graph is fetched up front via :meth:`.Broker.fetch_graph`,
+        and then walked breadth-first.
+
+        """
+        tasks = self.broker.fetch_graph([self.id], ['id', 'dependencies'])
+        visited = set([self.id])
+        queue = collections.deque([self.id])
+        while queue:
+            tid = queue.popleft()
+            yield self.broker.get_future(tid)
+            for dep_id in (tasks.get(tid) or {}).get('dependencies') or ():
+                if dep_id not in visited:
+                    visited.add(dep_id)
+                    queue.append(dep_id)
 
     def task(self):
         return self.broker.fetch(self.id)
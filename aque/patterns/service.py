@@ -0,0 +1,96 @@
+"""The ``service`` pattern, for tools with a heavy startup.
+
+A task declares a ``service`` command which reads requests one line at a
+time on its stdin, and answers each with a line on its stdout of either
+``ok`` or ``error``, optionally followed by a space and a result or message.
+Any other output is passed through as output of the task.
+
+Workers keep these services running between tasks (see
+:class:`aque.workersandbox.service.ServicePool`), so the startup is only
+paid for once; this pattern is the fallback, which runs the service for a
+single request.
+
+"""
+
+import json
+import logging
+import os
+import subprocess
+import sys
+
+from aque.exceptions import ServiceError
+
+
+log = logging.getLogger(__name__)
+
+
+def service_key(task):
+    """Tasks with the same key may be sent to the same service."""
+    return (
+        tuple(task['service']),
+        task.get('user'),
+        task.get('group'),
+        task.get('cwd'),
+        tuple(sorted((task.get('environ') or {}).iteritems())),
+    )
+
+
+def start_service(task, **kwargs):
+    """Start the service for the given task.
+
+    :param kwargs: passed to :class:`subprocess.Popen`.
+    :returns: the :class:`subprocess.Popen`.
+
+    """
+    env = os.environ.copy()
+    env.update(task.get('environ') or {})
+    return subprocess.Popen(task['service'],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        cwd=task.get('cwd'),
+        env=env,
+        **kwargs
+    )
+
+
+def format_request(task):
+    """The request line for a task; its ``args`` as JSON."""
+    return json.dumps(list(task.get('args') or ())) + '\n'
+
+
+def parse_response(line):
+    """Parse a line from a service.
+
+    :returns: ``(ok, value)`` if it is a response, or ``None`` if it is
+        other output.
+
+    """
+    line = line.rstrip('\r\n')
+    status, _, value = line.partition(' ')
+    if status == 'ok':
+        return True, value or None
+    if status == 'error':
+        return False, value or None
+
+
+def do_service_task(task):
+
+    proc = start_service(task)
+    proc.stdin.write(format_request(task))
+    proc.stdin.close()
+
+    response = None
+    for line in iter(proc.stdout.readline, ''):
+        response = parse_response(line)
+        if response is not None:
+            break
+        sys.stdout.write(line)
+    proc.stdout.close()
+    code = proc.wait()
+
+    if response is None:
+        raise ServiceError('service exited with code %d before responding' % code)
+    ok, value = response
+    if not ok:
+        raise ServiceError(value or 'service reported an error')
+    return value
@@ -0,0 +1,193 @@
+import heapq
+import logging
+import threading
+import time
+
+
+log = logging.getLogger(__name__)
+
+
+RECONCILE_INTERVAL = 60
+
+INDEX_FIELDS = ['id', 'status', 'priority', 'dependencies', 'unfinished_dependencies', 'io_paths', 'duration']
+
+
+def is_ready(task):
+    """Is the task pending, and are all of its dependencies finished?"""
+    return task.get('status') == 'pending' and not task.get('unfinished_dependencies')
+
+
+class PendingIndex(object):
+    """A priority ordered view of the ready tasks on a :class:`.Broker`.
+
+    Only pending tasks whose dependencies have all finished are held. The
+    index is kept up to date incrementally from ``task_status`` events (which
+    may also make the dependents of the changed tasks ready), and is rebuilt
+    from a full scan every ``reconcile_interval`` seconds in case any events
+    were missed.
+
+    Events are only queued up as they arrive (as they may be dispatched from
+    any thread); they are applied by :meth:`sync`, which should be called
+    by the owner before iterating.
+
+    Tasks which the owner will never be able to run may be :meth:`reject`-ed,
+    after which they are ignored until their status changes.
+
+    """
+
+    def __init__(self, broker, priority_func, fields=None, reconcile_interval=RECONCILE_INTERVAL):
+
+        self.broker = broker
+        self.priority_func = priority_func
+        self.fields = list(fields or INDEX_FIELDS)
+        self.reconcile_interval = reconcile_interval
+
+        self._tasks = {}
+        self._priorities = {}
+        self._heap = []
+        self._rejected = set()
+        self._last_reconcile = None
+
+        self._changes_lock = threading.Lock()
+        self._changes = []
+
+        self.broker.bind('task_status', self._on_task_status)
+
+    def close(self):
+        self.broker.unbind('task_status', self._on_task_status)
+
+    def __len__(self):
+        return len(self._tasks)
+
+    def __contains__(self, tid):
+        return tid in self._tasks
+
+    def get(self, tid):
+        return self._tasks.get(tid)
+
+    def _on_task_status(self, tids, status):
+        with self._changes_lock:
+            self._changes.append((tids, status))
+
+    def sync(self):
+        """Apply all status changes since the last sync (or rebuild if due)."""
+
+        if self._last_reconcile is None or time.time() - self._last_reconcile >= self.reconcile_interval:
+            self.reconcile()
+            return
+
+        with self._changes_lock:
+            changes, self._changes = self._changes, []
+
+        changed = set()
+        to_fetch = set()
+        for tids, status in changes:
+            changed.update(tids)
+            if status == 'pending':
+                to_fetch.update(tids)
+            else:
+                to_fetch.difference_update(tids)
+                for tid in tids:
+                    self.discard(tid)
+
+        if not changed:
+            return
+
+        self._rejected.difference_update(changed)
+
+        # Dependents' counters will have moved along with these.
+        tasks = self.broker.fetch_dependents(changed, self.fields)
+        if to_fetch:
+            tasks.update(self.broker.fetch(to_fetch, self.fields))
+
+        for task in tasks.itervalues():
+            if is_ready(task):
+                self._push(task)
+            else:
+                self.discard(task['id'])
+
+    def reconcile(self):
+        """Rebuild the index from a full scan of the broker."""
+
+        # Anything which arrives during the scan will be applied at the next
+        # sync, so we only discard what came before it.
+        with self._changes_lock:
+            self._changes = []
+        self._last_reconcile = time.time()
+
+        self._tasks = {}
+        self._priorities = {}
+        self._heap = []
+
+        # Rejections only last for as long as the task stays ready, just as
+        # they would have if we had seen it change.
+        rejected = set()
+        for task in self.broker.search({'status': 'pending', 'unfinished_dependencies': 0}, self.fields):
+            if not is_ready(task):
+                continue
+            if task['id'] in self._rejected:
+                rejected.add(task['id'])
+                continue
+            self._tasks[task['id']] = task
+            self._priorities[task['id']] = priority = self.priority_func(task)
+            self._heap.append((priority, task['id']))
+        heapq.heapify(self._heap)
+        self._rejected = rejected
+
+        log.debug('reconciled %d ready tasks' % len(self._tasks))
+
+    def discard(self, tid):
+        """Remove a task from the index; this is safe to call while iterating."""
+        # The heap entry is left behind, and skipped when encountered.
+        self._tasks.pop(tid, None)
+        self._priorities.pop(tid, None)
+
+    def reject(self, tid):
+        """Remove a task, and ignore it until its status changes."""
+        self._rejected.add(tid)
+        self.discard(tid)
+
+    def clear_rejections(self):
+        """Stop ignoring rejected tasks; they will return at the next sync."""
+        if self._rejected:
+            self._rejected.clear()
+            self._last_reconcile = None
+
+    def _push(self, task):
+
+        tid = task['id']
+        if tid in self._rejected:
+            return
+        priority = self.priority_func(task)
+        self._tasks[tid] = task
+        if self._priorities.get(tid) == priority:
+            return
+        self._priorities[tid] = priority
+        heapq.heappush(self._heap, (priority, tid))
+
+        # Don't let discarded entries pile up forever.
+        if len(self._heap) > 2 * len(self._tasks) + 64:
+            self._heap = [(p, t) for t, p in self._priorities.iteritems()]
+            heapq.heapify(self._heap)
+
+    def __iter__(self):
+        """Iterate over the ready tasks, highest priority first.
+
+        This walks the heap without modifying it, so considering the first
+        ``k`` tasks is ``O(k log k)``, regardless of how many are ready.
+
+        """
+        heap = self._heap
+        if not heap:
+            return
+        # A task which was discarded and then re-added may have two entries.
+        seen = set()
+        frontier = [(heap[0], 0)]
+        while frontier:
+            (priority, tid), i = heapq.heappop(frontier)
+            if tid not in seen and self._priorities.get(tid) == priority:
+                seen.add(tid)
+                yield self._tasks[tid]
+            for child in (2 * i + 1, 2 * i + 2):
+                if child < len(heap):
+                    heapq.heappush(frontier, (heap[child], child))
@@ -52,77 +52,112 @@ class Queue(object):
         return self.submit_many([prototype])[id(prototype)]
 
     def submit_many(self, prototypes):
+        """Submit many prototypes (and any prototypes they depend upon).
+
+        The prototypes themselves are not modified.
+
+        :returns: dict mapping the ``id()`` of every prototype to its :class:`.Future`.
+
+        """
 
         # First, we must flatten out the list of prototypes, stripping
-        # dependencies but keeping track of them.
-        to_process = list(self._flatten_prototypes(prototypes))
+        # dependencies but keeping track of them. They come out as copies in
+        # topological order, with dependencies on other prototypes in this
+        # batch as their Python ID and all others as Futures.
+        flattened = list(self._flatten_prototypes(prototypes))
+        if not flattened:
+            return {}
+        pids = [pid for pid, _ in flattened]
+        to_process = [task for _, task in flattened]
+
+        # If we can know the IDs ahead of time, then the whole graph can go
+        # in at once, and be pending immediately.
+        tids = self.broker.reserve_ids(len(to_process))
+        if tids is not None:
+            tids_by_pid = dict(zip(pids, tids))
+            for task, tid in zip(to_process, tids):
+                task['id'] = tid
+                task['dependencies'] = [x.id if isinstance(x, Future) else tids_by_pid[x] for x in task['dependencies']]
+            futures = self.broker.create_pending(to_process)
+            return dict(zip(pids, futures))
+
+        # Otherwise, we create them a level at a time.
+        levels = []
+        levels_by_pid = {}
+        for pid, task in flattened:
+            level = max([levels_by_pid[x] + 1 for x in task['dependencies'] if not isinstance(x, Future)] or [0])
+            levels_by_pid[pid] = level
+            if level == len(levels):
+                levels.append([])
+            levels[level].append((pid, task))
 
         futures_by_id = {}
-        while to_process:
-
-            # Resolve as many futures as possible.
-            for proto in to_process:
-                proto['dependencies'] = [x if isinstance(x, Future) else futures_by_id.get(x, x) for x in proto['dependencies']]
-
-            # Sort it into those which are submittable, and those which are not.
-            satisfied = []
-            unsatisfied = []
-            for proto in to_process:
-                if all(isinstance(x, Future) for x in proto['dependencies']):
-                    satisfied.append(proto)
-                else:
-                    unsatisfied.append(proto)
-            to_process = unsatisfied
+        for level in levels:
+            for _, task in level:
+                task['dependencies'] = [x.id if isinstance(x, Future) else futures_by_id[x].id for x in task['dependencies']]
+            # If everything can go in at once, then there is no need for the
+            # intermediate "creating" status.
+            if len(levels) == 1:
+                futures = self.broker.create_pending([task for _, task in level])
+            else:
+                futures = self.broker.create([task for _, task in level])
+            for (pid, _), f in zip(level, futures):
+                futures_by_id[pid] = f
+
+        if len(levels) > 1:
+            self.broker.set_status_and_notify([f.id for f in futures_by_id.itervalues()], 'pending')
 
-            if not satisfied:
-                for i, proto in enumerate(to_process):
-                    log.debug('%d/%d %r' % (i + 1, len(to_process), proto))
-                for id_, future in sorted(futures_by_id.iteritems()):
-                    log.debug('%d -> %d' % (id_, future.id))
-                raise RuntimeError('could not satisfy any prototypes')
-
-            for proto in satisfied:
-                proto['dependencies'] = [f.id for f in proto['dependencies']]
+        return futures_by_id
 
-            futures = self.broker.create(satisfied)
-            for p, f in zip(satisfied, futures):
-                futures_by_id[id(p)] = f
+    def _flatten_prototypes(self, prototypes, parent={}):
+        """Walk the graph of prototypes (depth first, without recursion).
 
-        self.broker.set_status_and_notify([f.id for f in futures_by_id.itervalues()], 'pending')
+        :returns: iterator of ``(pid, task)`` in topological order, where
+            ``pid`` is the ``id()`` of a prototype and ``task`` is a copy of it
+            with defaults set, and dependencies as the ``pid`` of other
+            prototypes or :class:`.Future`.
 
-        return futures_by_id
+        """
 
-    def _flatten_prototypes(self, prototypes, parent={}, recursion_tracker=None):
+        # Need to track for dependency cycles (via a None signalling that
+        # we are still processing this prototype, or the task signalling
+        # that we are done with it.
+        tracker = {}
 
-        recursion_tracker = {} if recursion_tracker is None else recursion_tracker
+        # Each frame is (pid, task, remaining dependencies, resolved dependencies).
+        stack = []
 
-        for proto in prototypes:
+        def push(proto, parent):
             if not isinstance(proto, dict):
                 raise TypeError('task prototypes must be dicts')
-
-            self._set_defaults(proto, parent)
             pid = id(proto)
-
-            # Need to track for dependency cycles (via a None signalling that
-            # we are still processing this prototype, or a list signalling
-            # that we are done with it.
-            if pid in recursion_tracker:
-                if recursion_tracker[pid]:
+            if pid in tracker:
+                if tracker[pid] is None:
                     raise DependencyResolutionError('dependency cycle')
-                else:
-                    continue
-            recursion_tracker[pid] = True
-
-            deps = []
-            for dep in proto.get('dependencies', ()):
-                if isinstance(dep, dict):
-                    deps.append(id(dep))
-                    for x in self._flatten_prototypes([dep], proto, recursion_tracker):
-                        yield x
-                else:
-                    deps.append(dep if isinstance(dep, Future) else self.broker.get_future(dep))
+                return False
+            tracker[pid] = None
+            task = dict(proto)
+            self._set_defaults(task, parent)
+            stack.append((pid, task, iter(proto.get('dependencies') or ()), []))
+            return True
 
-            recursion_tracker[pid] = False
-            proto['dependencies'] = deps
-            yield proto
+        for proto in prototypes:
+
+            push(proto, parent)
+
+            while stack:
+                pid, task, remaining, deps = stack[-1]
+                for dep in remaining:
+                    if isinstance(dep, dict):
+                        deps.append(id(dep))
+                        # Finish that one before carrying on with this one.
+                        if push(dep, task):
+                            break
+                    else:
+                        deps.append(dep if isinstance(dep, Future) else self.broker.get_future(dep))
+                else:
+                    stack.pop()
+                    task['dependencies'] = deps
+                    tracker[pid] = task
+                    yield pid, task
 
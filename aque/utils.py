@@ -1,6 +1,6 @@
 from __future__ import division
 
-from collections import Callable, namedtuple
+from collections import Callable, OrderedDict, namedtuple
 from cStringIO import StringIO
 import cPickle
 import pickle
@@ -10,6 +10,8 @@ import logging
 import os
 import pkg_resources
 import re
+import socket
+import struct
 import subprocess
 import sys
 import threading
@@ -126,6 +128,94 @@ def decode_callable(input_, entry_point_group=None):
 
 
 
+class LRUCache(object):
+    """A thread-safe mapping which forgets its least recently used items."""
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                return default
+            self._items[key] = value
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+
+def compress_ranges(values):
+    """Compress integers into a sorted list of inclusive ``[start, end]`` ranges.
+
+    >>> compress_ranges([5, 1, 2, 3, 7, 6])
+    [[1, 3], [5, 7]]
+
+    """
+    ranges = []
+    for x in sorted(set(values)):
+        if ranges and ranges[-1][1] == x - 1:
+            ranges[-1][1] = x
+        else:
+            ranges.append([x, x])
+    return ranges
+
+
+def expand_ranges(ranges):
+    """The inverse of :func:`compress_ranges`."""
+    return [x for start, end in ranges for x in xrange(start, end + 1)]
+
+
+# Simple framing of pickled messages over (blocking) sockets.
+
+def send_message(sock, msg):
+    """Send a pickled object, prefixed with its length."""
+    encoded = cPickle.dumps(msg, protocol=-1)
+    sock.sendall(struct.pack('>I', len(encoded)) + encoded)
+
+
+def recv_exactly(sock, size):
+    """Read exactly ``size`` bytes, or return ``None`` if the socket closes first."""
+    chunks = []
+    while size:
+        try:
+            chunk = sock.recv(size)
+        except socket.error as e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+
+def recv_message(sock):
+    """Receive an object sent via :func:`send_message`, or ``None`` on EOF."""
+    header = recv_exactly(sock, 4)
+    if header is None:
+        return None
+    encoded = recv_exactly(sock, struct.unpack('>I', header)[0])
+    if encoded is None:
+        return None
+    return cPickle.loads(encoded)
+
+
 SI_PREFIXES = ('', 'k', 'M', 'G', 'T', 'P', 'E', 'Z', 'Y')
 def format_bytes(bytes):
     for prefix in SI_PREFIXES:
@@ -3,6 +3,7 @@ import fnmatch
 import grp
 import itertools
 import logging
+import math
 import multiprocessing
 import os
 import pickle
@@ -16,15 +17,21 @@ import threading
 import time
 import traceback
 import signal
+from Queue import Queue, Empty
 
 import psutil
 
 from aque.brokers import get_broker
 from aque.eventloop import SelectableEvent, EventLoop, StopSelection
-from aque.exceptions import DependencyFailedError, DependencyResolutionError, PatternMissingError
+from aque.exceptions import DependencyFailedError, DependencyResolutionError, PatternMissingError, ServiceError
 from aque.futures import Future
 from aque.local import _local
+from aque.patterns.service import format_request, parse_response
+from aque.pending import PendingIndex, is_ready
 from aque.utils import decode_callable, parse_bytes, debug, get_mount
+from aque.workersandbox.pool import InterpreterPool, interpreter_command
+from aque.workersandbox.service import ServicePool
+from aque.workersandbox.zygote import Zygote
 
 
 log = logging.getLogger(__name__)
@@ -36,16 +43,86 @@ IS_ROOT = not os.getuid()
 LOGIN = pwd.getpwuid(os.getuid()).pw_name
 HOSTNAME = socket.gethostname().lower()
 
+# How often to look for work in the absence of any events.
+POLL_INTERVAL = 60.0
+
+# How often to check on running jobs in the absence of any events.
+JOB_POLL_INTERVAL = 15.0
+
+# How much output to hold on to before logging it, and for how long.
+OUTPUT_FLUSH_SIZE = 256 * 1024
+OUTPUT_FLUSH_INTERVAL = 0.25
+
+# How many tasks with the same `batch_key` run in one job, unless they set
+# their own `max_batch`.
+MAX_BATCH = 100
+
+
+
+class OutputBuffer(object):
+    """Collects a job's output so that it may be logged in batches.
+
+    Adjacent writes to the same fd are coalesced. The buffer is flushed (as a
+    single :meth:`.Broker.log_outputs_and_notify`) once it holds ``max_size``
+    bytes, ``max_delay`` seconds after the first unlogged write (if given an
+    event loop to time that with), or when explicitly asked to.
+
+    """
+
+    def __init__(self, broker, tid, event_loop=None, max_size=OUTPUT_FLUSH_SIZE, max_delay=OUTPUT_FLUSH_INTERVAL):
+        self.broker = broker
+        self.tid = tid
+        self.event_loop = event_loop
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self._chunks = []
+        self._size = 0
+        self._timer = None
+
+    def __len__(self):
+        return self._size
+
+    def write(self, fd, offset, content):
+        if self._chunks and self._chunks[-1][0] == fd and self._chunks[-1][1] + self._chunks[-1][2] == offset:
+            self._chunks[-1][2] += len(content)
+            self._chunks[-1][3].append(content)
+        else:
+            self._chunks.append([fd, offset, len(content), [content]])
+        self._size += len(content)
+
+        if self._size >= self.max_size:
+            self.flush()
+        elif self._timer is None and self.event_loop is not None:
+            self._timer = self.event_loop.add_timer(self.max_delay, self.flush, repeat=False)
+
+    def flush(self):
+        if self._timer is not None:
+            self.event_loop.remove_timer(self._timer)
+            self._timer = None
+        if not self._chunks:
+            return
+        chunks = [(fd, offset, ''.join(pieces)) for fd, offset, _, pieces in self._chunks]
+        self._chunks = []
+        self._size = 0
+        self.broker.log_outputs_and_notify(self.tid, chunks)
 
 
 class BaseJob(object):
 
-    def __init__(self, broker, task):
+    def __init__(self, broker, task, batch=()):
 
         self.broker = broker
         self.task = task
         self.id = task['id']
 
+        # Other tasks to run (one after the other) in this same job; their
+        # output is logged along with the first's.
+        self.batch = list(batch)
+
+    @property
+    def ids(self):
+        return [self.id] + [task['id'] for task in self.batch]
+
     def close(self):
         pass
 
@@ -53,9 +130,19 @@ class BaseJob(object):
         pass
 
     def execute(self):
+        # All of the results are written together.
+        updates = []
+        try:
+            for task in [self.task] + self.batch:
+                updates.append(self._execute_task(task))
+        finally:
+            if updates:
+                self.broker.set_statuses_and_notify(updates)
+
+    def _execute_task(self, task):
         try:
 
-            encoded_pattern = self.task.get('pattern', 'generic')
+            encoded_pattern = task.get('pattern', 'generic')
             try:
                 pattern_func = decode_callable(encoded_pattern, 'aque_patterns')
             except ValueError:
@@ -63,66 +150,133 @@ class BaseJob(object):
             if pattern_func is None:
                 raise PatternMissingError('cannot decode pattern from %r' % encoded_pattern)
 
-            _local.task = self.task
+            _local.task = task
             _local.broker = self.broker
 
-            res = pattern_func(self.task)
+            res = pattern_func(task)
 
         except KeyboardInterrupt:
             raise
         
         except Exception as e:
-            self.broker.set_status_and_notify(self.id, 'error', e)
             log.exception('error during execution')
+            return task['id'], 'error', e
 
         else:
-            self.broker.set_status_and_notify(self.id, 'success', res)
+            return task['id'], 'success', res
 
 
-class ThreadJob(BaseJob):
+class ThreadPool(object):
+    """A fixed number of threads to execute :class:`ThreadJob` on.
 
-    def start(self):
+    Completed jobs are put on a queue and announced via a single
+    :class:`.SelectableEvent`, so that there is one fd for the event loop to
+    select on no matter how many jobs there are.
+
+    This is added to the worker's event loop so that it can mark jobs
+    finished (and have the ``event_loop`` stop them).
+
+    :param int size: how many threads to run; they are started as needed.
+
+    """
+
+    def __init__(self, size, event_loop=None):
+        self.size = max(1, size)
+        self.event_loop = event_loop
         self.finished = SelectableEvent()
-        self.thread = threading.Thread(target=self.execute)
-        self.thread.start()
+        self._jobs = Queue()
+        self._done = Queue()
+        self._threads = []
+
+    def submit(self, job):
+        if len(self._threads) < self.size:
+            thread = threading.Thread(target=self._target)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        self._jobs.put(job)
+
+    def _target(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            try:
+                job.execute()
+            except:
+                log.exception('error in thread job %d' % job.id)
+            finally:
+                self._done.put(job)
+                self.finished.set()
 
     def close(self):
-        self.finished.close()
+        """Stop the threads once they have finished any jobs already submitted."""
+        for thread in self._threads:
+            self._jobs.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
 
     def to_select(self):
         return [self.finished.fileno()], [], []
 
     def on_select(self, rfds, wfds, xfds):
-        if not self.thread.is_alive() or self.finished.is_set():
-            raise StopSelection()
+        # Clear before draining, so that anything which finishes in the
+        # meantime wakes us again.
+        self.finished.clear()
+        while True:
+            try:
+                job = self._done.get_nowait()
+            except Empty:
+                return
+            job.finished = True
+            if self.event_loop is not None:
+                self.event_loop.update(job)
 
-    def execute(self):
-        try:
-            super(ThreadJob, self).execute()
-        finally:
-            self.finished.set()
+
+class ThreadJob(BaseJob):
+
+    def __init__(self, broker, task, pool, batch=()):
+        super(ThreadJob, self).__init__(broker, task, batch)
+        self.pool = pool
+        self.finished = False
+
+    def start(self):
+        self.pool.submit(self)
+
+    # There is nothing to select on; the pool updates the loop once we are
+    # finished.
+    def to_select(self):
+        if self.finished:
+            raise StopSelection()
 
 
 class ProcJob(BaseJob):
 
+    def __init__(self, broker, task, zygote=None, pool=None, batch=()):
+        super(ProcJob, self).__init__(broker, task, batch)
+        self.zygote = zygote
+        self.pool = pool
+
     def start(self):
 
-        self.broker.bind('signal_task.%d' % self.id, self.on_signaled)
+        # Signalling any task of a batch signals the process running them all.
+        self.broker.bind(['signal_task.%d' % tid for tid in self.ids], self.on_signaled)
 
         o_rfd, o_wfd = os.pipe()
         e_rfd, e_wfd = os.pipe()
 
         # Start the actuall subprocess.
-        if self.task.get('interpreter'):
+        if self.task.get('interpreter') and self.pool is not None:
+            self.proc = self.pool.run(self.task, o_wfd, e_wfd)
+            self.is_alive = self.proc.is_alive
+
+        elif self.task.get('interpreter'):
 
-            cmd = []
-            if 'KS_DEV_ARGS' in os.environ:
-                cmd.extend(('dev', '--bootstrap'))
-            cmd.extend((
+            cmd = interpreter_command(
                 self.task['interpreter'],
-                '-m', 'aque.workersandbox.thecorner',
                 str(self.id), # so that `top` and `ps` show something more interesting
-            ))
+            )
 
             encoded_package = pickle.dumps((self.broker, self.task))
             self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=o_wfd, stderr=e_wfd, close_fds=True)
@@ -130,6 +284,10 @@ class ProcJob(BaseJob):
             self.proc.stdin.close()
             self.is_alive = lambda: not (self.proc.poll() or self.proc.returncode is not None)
 
+        elif self.zygote is not None:
+            self.proc = self.zygote.spawn(self.task, o_wfd, e_wfd, self.batch)
+            self.is_alive = self.proc.is_alive
+
         else:
             i_rfd, i_wfd = os.pipe()
             self.proc = multiprocessing.Process(target=self._target, args=(i_rfd, o_wfd, e_wfd))
@@ -150,12 +308,22 @@ class ProcJob(BaseJob):
             o_rfd: 0,
             e_rfd: 0,
         }
+        self.output = OutputBuffer(self.broker, self.id, self.broker._event_loop)
 
         log.log(5, 'proc %d for task %d started' % (self.proc.pid, self.id))
 
     def to_select(self):
+        # Whatever reports the process exiting (e.g. the zygote) may have done
+        # so after our last on_select.
+        if not self.fd_map and not self.is_alive():
+            self._joined()
         return self.fd_map.keys(), [], []
 
+    def _joined(self):
+        log.log(5, 'proc %d for task %d joined' % (self.proc.pid, self.id))
+        self.output.flush()
+        raise StopSelection()
+
     def on_select(self, rfds, wfds, xfds):
 
         for rfd in rfds:
@@ -164,7 +332,7 @@ class ProcJob(BaseJob):
                 x = os.read(rfd, 65536)
                 if x:
                     log.log(5, '%d piped %s' % (self.id, x.encode('string-escape')))
-                    self.broker.log_output_and_notify(self.id, to_fd, self.fd_offsets[rfd], x)
+                    self.output.write(to_fd, self.fd_offsets[rfd], x)
                     self.fd_offsets[rfd] += len(x)
                 else:
                     os.close(rfd)
@@ -174,8 +342,7 @@ class ProcJob(BaseJob):
         has_life = self.is_alive()
 
         if not has_fds and not has_life:
-            log.log(5, 'proc %d for task %d joined' % (self.proc.pid, self.id))
-            raise StopSelection()
+            self._joined()
 
         elif not (has_fds and has_life) and (has_fds or has_life):
             log.log(5, 'proc %d for task %d is about to die; only %s' % (self.proc.pid, self.id, 'has fds' if has_fds else 'has life'))
@@ -203,17 +370,7 @@ class ProcJob(BaseJob):
         # child processes (many of which come from the "shell" pattern).
         os.setsid()
 
-        if IS_ROOT:
-
-            # Drop permissions.
-            uid = pwd.getpwnam(self.task['user']).pw_uid
-            try:
-                gid = grp.getgrnam(self.task['group']).gr_gid
-            except KeyError:
-                gid = grp.getgrgid(uid).gr_gid
-
-            os.setregid(gid, gid)
-            os.setreuid(uid, uid)
+        drop_privileges(self.task['user'], self.task.get('group'))
 
         os.chdir(self.task['cwd'])
 
@@ -223,9 +380,92 @@ class ProcJob(BaseJob):
             log.info('task %d was sent signal %d' % (self.id, signal))
 
     def close(self):
+        self.output.flush()
+        self.broker.unbind(['signal_task.%d' % tid for tid in self.ids], self.on_signaled)
+        if self.zygote is not None:
+            self.zygote.forget(self.proc.pid)
+
+
+class ServiceJob(BaseJob):
+    """Runs a ``service`` task by sending it to a running instance of its service."""
+
+    def __init__(self, broker, task, services):
+        super(ServiceJob, self).__init__(broker, task)
+        self.services = services
+        self.instance = None
+        self.ok = False
+        self.signaled = False
+
+    def start(self):
+        self.broker.bind('signal_task.%d' % self.id, self.on_signaled)
+        self.output = OutputBuffer(self.broker, self.id, self.broker._event_loop)
+        self.offsets = {1: 0, 2: 0}
+        try:
+            self.instance = self.services.acquire(self.task)
+        except OSError as e:
+            log.exception('could not start service for task %d' % self.id)
+            self.broker.set_status_and_notify(self.id, 'error', ServiceError('could not start service: %s' % e))
+            return
+        self.instance.send(format_request(self.task))
+
+    def to_select(self):
+        if self.instance is None:
+            raise StopSelection()
+        return self.instance.fds.keys(), [], []
+
+    def on_select(self, rfds, wfds, xfds):
+
+        for fd, line in self.instance.read_lines(rfds):
+            response = parse_response(line) if fd == 1 else None
+            if response is None:
+                self.output.write(fd, self.offsets[fd], line)
+                self.offsets[fd] += len(line)
+                continue
+            self.ok, value = response
+            if self.ok:
+                self.broker.set_status_and_notify(self.id, 'success', value)
+            else:
+                self.broker.set_status_and_notify(self.id, 'error', ServiceError(value or 'service reported an error'))
+            raise StopSelection()
+
+        if not self.instance.alive:
+            if not self.signaled:
+                code = self.instance.proc.wait()
+                self.broker.set_status_and_notify(self.id, 'error',
+                    ServiceError('service exited with code %d before responding' % code)
+                )
+            raise StopSelection()
+
+    def on_signaled(self, tids, signal):
+        if self.instance is not None and self.instance.alive:
+            self.signaled = True
+            self.instance.kill(signal)
+            log.info('task %d was sent signal %d' % (self.id, signal))
+
+    def close(self):
+        self.output.flush()
         self.broker.unbind('signal_task.%d' % self.id, self.on_signaled)
+        if self.instance is not None:
+            self.services.release(self.instance, self.ok)
+            self.instance = None
+
+
+
 
+def drop_privileges(user, group=None):
+    """Become the given user (and group), if we are root."""
 
+    if not IS_ROOT:
+        return
+
+    uid = pwd.getpwnam(user).pw_uid
+    try:
+        gid = grp.getgrnam(group).gr_gid
+    except (KeyError, TypeError):
+        gid = grp.getgrgid(uid).gr_gid
+
+    os.setregid(gid, gid)
+    os.setreuid(uid, uid)
 
 
 def procjob_execute():
@@ -255,19 +495,68 @@ def task_memory(task):
     memory = task.get('memory')
     return memory or 0
 
+def task_batch_key(task):
+    """Tasks with the same (non-None) key may be run together in a single job.
+
+    Tasks opt into this by setting a ``batch_key``; they must also share
+    their pattern, user, group, and cwd.
+
+    """
+    key = task.get('batch_key')
+    if key is None or task.get('interpreter') or task.get('pattern') == 'service':
+        return None
+    return (key, task.get('pattern'), task.get('user'), task.get('group'), task.get('cwd'))
+
+def task_max_batch(task):
+    return task.get('max_batch') or MAX_BATCH
+
 
 class Worker(object):
 
-    def __init__(self, broker=None, max_cpus=None):
+    def __init__(self, broker=None, max_cpus=None, preload=(), max_tasks_per_child=None):
         self.broker = get_broker(broker)
         self._event_loop = self.broker._event_loop
+        self.max_cpus = max_cpus or CPU_COUNT
+
+        # Tasks are forked from a lean process rather than from us, and those
+        # with their own interpreter are run in long-lived sandboxes.
+        self._zygote = Zygote(self.broker, preload) if self.broker.can_fork else None
+        self._pool = InterpreterPool(self.broker, max_tasks_per_child, event_loop=self._event_loop) if self.broker.can_fork else None
+        self._pool_running = False
+        self._services = ServicePool(event_loop=self._event_loop)
+        self._services_running = False
+        self._threads = ThreadPool(int(math.ceil(self.max_cpus)), event_loop=self._event_loop)
+        self._threads_running = False
         self._stopper = threading.Event()
-        self.broker.bind('task_status.pending', lambda *args, **kwargs: None)
         self.use_io_hints = False
 
+        # Scheduling passes are triggered by events which may make new work
+        # available, or when a job finishes.
+        self._schedule_needed = True
+        self._last_schedule = 0
+        self.broker.bind([
+            'task_status.pending',
+            'task_status.success',
+            'task_status.error',
+            'task_status.killed',
+        ], self._on_schedulable_event)
+        self._pending = PendingIndex(self.broker, self.calculate_priority)
+
+        # Verdicts of `_can_ever_satisfy_requirements`, which are only valid
+        # for as long as the worker's own configuration does not change.
+        self._requirement_verdicts = {}
+        self._requirement_signature = None
+
     def stop(self):
         self._stopper.set()
 
+    def close(self):
+        """Shut down the processes (zygote, sandboxes, services) and threads that we keep around between runs."""
+        self._close_zygote()
+        self._close_pool()
+        self._close_services()
+        self._close_threads()
+
     def __del__(self):
         self.stop()
 
@@ -281,7 +570,7 @@ class Worker(object):
         self._run(count=None, wait_for_more=True)
 
     def _resources_left(self):
-        cpus = CPU_COUNT
+        cpus = self.max_cpus
         memory = MEM_TOTAL
         for obj in self._event_loop.active:
             if isinstance(obj, BaseJob):
@@ -309,8 +598,41 @@ class Worker(object):
 
         return True
 
+    def _check_requirement_signature(self):
+        """Forget all requirement verdicts if the worker's configuration has changed."""
+
+        signature = (
+            HOSTNAME,
+            LOGIN,
+            IS_ROOT,
+            sys.platform,
+            self.broker.can_fork,
+            None if self.broker.can_fork else os.getcwd(),
+        )
+
+        if signature != self._requirement_signature:
+            if self._requirement_signature is not None:
+                log.info('worker configuration changed; reconsidering all tasks')
+            self._requirement_signature = signature
+            self._requirement_verdicts.clear()
+            self._pending.clear_rejections()
+
     def _can_ever_satisfy_requirements(self, task):
 
+        host = task.get('host')
+        key = (
+            tuple(host) if isinstance(host, list) else host,
+            task.get('user'),
+            task.get('platform'),
+            None if self.broker.can_fork else task.get('cwd'),
+        )
+
+        if key not in self._requirement_verdicts:
+            self._requirement_verdicts[key] = self._check_requirements(task)
+        return self._requirement_verdicts[key]
+
+    def _check_requirements(self, task):
+
         # Check the host globs.
         host_patterns = task.get('host')
         if host_patterns:
@@ -354,49 +676,145 @@ class Worker(object):
 
     def _spawn_jobs(self, count):
 
-        cpus, memory = self._resources_left()
-
-        # Check that we haven't spawned too many yet AND there are enough
-        # resources to spare.
-        # TODO: wait until a reasonable amount of time has passed or we have
-        #       notification that there are new jobs.
-        task_iter = None
-        while (count is None or count > 0) and cpus > 0 and memory > 0:
+        self._check_requirement_signature()
 
-            task_iter = task_iter or self.iter_open_tasks()
-            try:
-                task = next(task_iter)
-            except StopIteration:
+        cpus, memory = self._resources_left()
+        active_ids = set(tid for job in self._event_loop.active if isinstance(job, BaseJob) for tid in job.ids)
+
+        # Collect everything that we could start right now (given the
+        # resources we have to spare), and then capture them all at once.
+        candidates = []
+        batches = {}
+        open_batches = {}
+        task_count = 0
+        finished = []
+        batch_search = None
+        for task in self.iter_open_tasks():
+
+            if count is not None and task_count >= count:
                 break
 
-            # Shortcut for grouping tasks.
+            # Even without resources to spare, tasks may still join a batch,
+            # but every one we look at costs a fetch, so only so many are.
+            if cpus <= 0 or memory <= 0:
+                if not open_batches:
+                    break
+                if batch_search is None:
+                    batch_search = max(task_max_batch(b[0]) - len(b) for b in open_batches.itervalues())
+                if batch_search <= 0:
+                    break
+                batch_search -= 1
+
+            # Shortcut for grouping tasks; they are all finished together.
             if task.get('pattern', 'xxx') is None:
-                self.broker.set_status_and_notify(task['id'], 'success', None)
+                finished.append((task['id'], 'success', None))
                 continue
 
             # Don't consider anything we are already working on.
-            if any(task['id'] == job.id for job in self._event_loop.active if isinstance(job, BaseJob)):
+            if task['id'] in active_ids:
                 continue
 
-            # TODO: track these so that we don't bother looking at the same
-            # tasks over and over.
+            # Never look at this one again (unless its status changes).
             if not self._can_ever_satisfy_requirements(task):
+                self._pending.reject(task['id'])
+                continue
+
+            # Tasks which join a batch run in its job, so they don't need
+            # any more resources.
+            batch_key = task_batch_key(task)
+            batch = open_batches.get(batch_key) if batch_key is not None else None
+            if batch is not None:
+                batch.append(task)
+                task_count += 1
+                if len(batch) >= task_max_batch(batch[0]):
+                    del open_batches[batch_key]
                 continue
+
             if not self._can_currently_satisfy_requirements(task, cpus, memory):
                 continue
 
-            if not self.broker.acquire(task['id']):
+            candidates.append(task)
+            task_count += 1
+            cpus -= task_cpus(task)
+            memory -= task_memory(task)
+            if batch_key is not None and task_max_batch(task) > 1:
+                open_batches[batch_key] = batches[task['id']] = [task]
+
+        if finished:
+            self.broker.set_statuses_and_notify(finished)
+
+        if not candidates:
+            return count
+
+        candidate_ids = [tid for task in candidates for tid in [t['id'] for t in batches.get(task['id'], [task])]]
+        claimed = self.broker.claim(len(candidate_ids), {'ids': candidate_ids})
+        claimed = dict((task['id'], task) for task in claimed)
+
+        for candidate in candidates:
+
+            # We may not have gotten all of a batch.
+            tasks = [claimed[t['id']] for t in batches.get(candidate['id'], [candidate]) if t['id'] in claimed]
+            if not tasks:
                 continue
+            task, batch = tasks[0], tasks[1:]
 
-            job = (ProcJob if self.broker.can_fork else ThreadJob)(self.broker, task)
+            if task.get('pattern') == 'service':
+                job = ServiceJob(self.broker, task, self._get_services())
+            elif self.broker.can_fork:
+                job = ProcJob(self.broker, task, zygote=self._get_zygote(), pool=self._get_pool(), batch=batch)
+            else:
+                job = ThreadJob(self.broker, task, self._get_threads(), batch)
             job.start()
             self._event_loop.add(job)
 
-            cpus, memory = self._resources_left()
-
-            count = count - 1 if count is not None else None
-
-        return count
+        return count - len(claimed) if count is not None else None
+
+    def _get_zygote(self):
+        if not self._zygote.running:
+            self._zygote.start()
+            self._event_loop.add(self._zygote)
+        return self._zygote
+
+    def _close_zygote(self):
+        if self._zygote is not None and self._zygote.running:
+            self._event_loop.remove(self._zygote)
+            self._zygote.close()
+
+    def _get_pool(self):
+        if not self._pool_running:
+            self._event_loop.add(self._pool)
+            self._pool_running = True
+        return self._pool
+
+    def _close_pool(self):
+        if self._pool_running:
+            self._event_loop.remove(self._pool)
+            self._pool.close()
+            self._pool_running = False
+
+    def _get_services(self):
+        if not self._services_running:
+            self._event_loop.add(self._services)
+            self._services_running = True
+        return self._services
+
+    def _close_services(self):
+        if self._services_running:
+            self._event_loop.remove(self._services)
+            self._services.close()
+            self._services_running = False
+
+    def _get_threads(self):
+        if not self._threads_running:
+            self._event_loop.add(self._threads)
+            self._threads_running = True
+        return self._threads
+
+    def _close_threads(self):
+        if self._threads_running:
+            self._event_loop.remove(self._threads)
+            self._threads.close()
+            self._threads_running = False
 
     def _run(self, count, wait_for_more):
         try:
@@ -404,6 +822,9 @@ class Worker(object):
             self._stopper.clear()
             self._event_loop.stop_thread()
 
+            # We may have missed events while the loop wasn't ours.
+            self._schedule_needed = True
+
             # The main loop.
             while not self._stopper.is_set():
                 count = self._run_inner(count, wait_for_more)
@@ -418,33 +839,48 @@ class Worker(object):
             log.debug('worker is stopping')
             self._event_loop.resume_thread()
 
+    def _on_schedulable_event(self, tids, status):
+        # Either there is new work, or some existing work may now be ready.
+        self._schedule_needed = True
+
     def _run_inner(self, count, wait_for_more):
 
-            count = self._spawn_jobs(count)
+            if self._schedule_needed or time.time() - self._last_schedule >= POLL_INTERVAL:
+                self._schedule_needed = False
+                self._last_schedule = time.time()
+                count = self._spawn_jobs(count)
 
-            # TODO: longer timeout once we listen to pending task events
             active_jobs = [x for x in self._event_loop.active if isinstance(x, BaseJob)]
             log.info("%d active jobs: %s" % (len(active_jobs), ', '.join(str(job.id) for job in active_jobs)))
-            if active_jobs:
-                self._event_loop.process(timeout=15.0)
+
+            if active_jobs or wait_for_more:
+
+                # Sleep until something happens; polling is only a safety net
+                # in case we miss an event.
+                timeout = max(0, self._last_schedule + POLL_INTERVAL - time.time())
+                if active_jobs:
+                    timeout = min(timeout, JOB_POLL_INTERVAL)
+                else:
+                    log.info('waiting for more work...')
+                self._event_loop.process(timeout=timeout)
 
             # Deal with any jobs that just stopped.
             job_just_finished = False
             for obj in self._event_loop.stopped:
                 if isinstance(obj, BaseJob):
                     obj.close()
-                    self.broker.release(obj.id)
+                    for tid in obj.ids:
+                        self.broker.release(tid)
                     job_just_finished = True
 
             self._event_loop.stopped[:] = []
 
-            if not job_just_finished and not any(isinstance(x, BaseJob) for x in self._event_loop.active):
-                if wait_for_more:
-                    # XXX: don't need this once the above timeout is higher
-                    log.info('waiting for more work...')
-                    self._event_loop.process(timeout=60.0)
-                else:
-                    raise StopIteration()
+            # There are resources to spare now.
+            if job_just_finished:
+                self._schedule_needed = True
+
+            elif not wait_for_more and not any(isinstance(x, BaseJob) for x in self._event_loop.active):
+                raise StopIteration()
 
             return count
 
@@ -498,69 +934,61 @@ class Worker(object):
 
     def iter_open_tasks(self):
 
-        pending_tasks = list(self.broker.search({'status': 'pending'}, ['id', 'status', 'dependencies', 'io_paths', 'duration']))
+        self._pending.sync()
 
-        task_cache = dict((t['id'], t) for t in pending_tasks)
-        task_priorities = {}
+        # Everything in the index has had all of its dependencies finish, but
+        # we still need to know if they were successful.
+        dependency_cache = {}
 
-        considered = set()
-        while True:
+        # Tasks which can never run are failed in batches; they are written
+        # before anything else is handed out, and when we run out of tasks.
+        failed = []
 
-            # Make sure we are only looking at pending tasks that we have not
-            # already considered. (The pending check is required for the
-            # MemoryBroker, which sometimes modifies tasks.)
-            pending_tasks = [
-                task for task in pending_tasks
-                if task['status'] == 'pending' and task['id'] not in considered
-            ]
-            if not pending_tasks:
-                break
+        for task in self._pending:
 
-            # Create dynamic priorities for every task, and sort by them.
-            for task in pending_tasks:
-                if task['id'] not in task_priorities:
-                    task_priorities[task['id']] = self.calculate_priority(task)
-
-            pending_tasks.sort(key=lambda task: task_priorities[task['id']])
-            task = pending_tasks.pop(0)
+            # The MemoryBroker sometimes modifies tasks in place.
+            if not is_ready(task):
+                continue
 
             dependency_ids = task.get('dependencies') or []
 
             # Cache the ones we haven't seen before.
-            uncached_ids = [tid for tid in dependency_ids if tid not in task_cache]
+            uncached_ids = [tid for tid in dependency_ids if tid not in dependency_cache]
             if uncached_ids:
-                task_cache.update(self.broker.fetch(uncached_ids, fields=['id', 'status', 'dependencies']))
+                dependency_cache.update(self.broker.fetch(uncached_ids, fields=['id', 'status']))
 
             skip_task = False
 
             for tid in dependency_ids:
 
-                dep = task_cache.get(tid)
+                dep = dependency_cache.get(tid)
 
                 if not dep:
                     log.warning('task %r is missing dependency %r' % (task['id'], tid))
-                    self.broker.set_status_and_notify(task['id'], 'error',
-                        DependencyResolutionError('task %r does not exist' % tid),
-                    )
-                    skip_task = True
-                    continue
-
-                if dep['status'] == 'pending':
+                    failed.append((task['id'], 'error', DependencyResolutionError('task %r does not exist' % tid)))
+                    self._pending.discard(task['id'])
                     skip_task = True
-                    pending_tasks.append(dep)
+                    break
 
-                elif dep['status'] == 'paused':
+                # Only possible if the dependency was reset since our last sync.
+                if dep['status'] in ('creating', 'pending', 'paused'):
                     skip_task = True
 
                 elif dep['status'] != 'success':
-                    skip_task = True
                     log.info('task %r has failed dependency %r' % (task['id'], tid))
-                    self.broker.set_status_and_notify(task['id'], 'error',
-                        DependencyFailedError('task %r has status %r' % (tid, dep['status']))
-                    )
+                    failed.append((task['id'], 'error', DependencyFailedError('task %r has status %r' % (tid, dep['status']))))
+                    self._pending.discard(task['id'])
+                    skip_task = True
+                    break
 
             if skip_task:
                 continue
 
+            if failed:
+                self.broker.set_statuses_and_notify(failed)
+                failed = []
+
             yield self.broker.fetch(task['id'])
 
+        if failed:
+            self.broker.set_statuses_and_notify(failed)
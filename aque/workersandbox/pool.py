@@ -0,0 +1,296 @@
+"""Long-lived sandbox processes for tasks which set an ``interpreter``.
+
+Some interpreters (e.g. Maya's) take a very long time to start, so rather
+than starting a fresh :mod:`~aque.workersandbox.thecorner` for every task, an
+:class:`InterpreterPool` keeps them running (via ``thecorner --serve``) and
+feeds them one task at a time. Since they drop privileges when they start,
+they are pooled by interpreter, user, and group.
+
+The protocol is a stream of :func:`~aque.utils.send_message` frames over
+the sandbox's stdin:
+
+- the worker first sends ``(broker, user, group)``;
+- ``('run', token, task)``, followed by the task's stdout and stderr (passed
+  as file descriptors), to which the sandbox replies ``('done', token)``
+  once the task has finished.
+
+"""
+
+import functools
+import logging
+import os
+import signal
+import socket
+import subprocess
+import sys
+
+from _multiprocessing import sendfd, recvfd
+
+from aque.utils import send_message, recv_message
+
+
+log = logging.getLogger(__name__)
+
+
+# How long a sandbox has to exit once its socket is closed.
+CLOSE_TIMEOUT = 5.0
+
+# How often to check on a retiring sandbox.
+REAP_INTERVAL = 0.05
+
+
+def interpreter_command(interpreter, *args):
+    """Build the command to run :mod:`~aque.workersandbox.thecorner` in the given interpreter."""
+    cmd = []
+    if 'KS_DEV_ARGS' in os.environ:
+        cmd.extend(('dev', '--bootstrap'))
+    cmd.extend((interpreter, '-m', 'aque.workersandbox.thecorner'))
+    cmd.extend(args)
+    return cmd
+
+
+class PooledProcess(object):
+    """A handle on a task running in a sandbox.
+
+    Quacks enough like :class:`multiprocessing.Process` for :class:`.ProcJob`;
+    it is "alive" until the sandbox is done with the task.
+
+    """
+
+    def __init__(self, sandbox):
+        self.sandbox = sandbox
+        self.pid = sandbox.proc.pid
+        self.finished = False
+
+    def is_alive(self):
+        return not self.finished
+
+
+class Sandbox(object):
+    """The worker's side of a single sandbox process."""
+
+    def __init__(self, key, broker):
+
+        self.key = key
+        interpreter, user, group = key
+
+        ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        cmd = interpreter_command(interpreter, '--serve')
+        self.proc = subprocess.Popen(cmd, stdin=theirs, close_fds=True)
+        theirs.close()
+
+        self.sock = ours
+        self.tasks_run = 0
+        self.current = None
+        self._next_token = 0
+
+        send_message(self.sock, (broker, user, group))
+        log.debug('sandbox %d started for %r' % (self.proc.pid, key))
+
+    def run(self, task, stdout, stderr):
+        self._next_token += 1
+        self.current = (self._next_token, PooledProcess(self))
+        send_message(self.sock, ('run', self._next_token, task))
+        sendfd(self.sock.fileno(), stdout)
+        sendfd(self.sock.fileno(), stderr)
+        return self.current[1]
+
+    def on_readable(self):
+        """Handle a message from the sandbox.
+
+        :returns: ``False`` if the sandbox has gone away.
+
+        """
+        msg = recv_message(self.sock)
+        if msg is None:
+            self._finish_current()
+            return False
+        if msg[0] == 'done' and self.current and msg[1] == self.current[0]:
+            self.tasks_run += 1
+            self._finish_current()
+        return True
+
+    def _finish_current(self):
+        if self.current:
+            self.current[1].finished = True
+            self.current = None
+
+    def retire(self):
+        """Ask the sandbox to exit, by closing its socket."""
+        self._finish_current()
+        # The sandbox exits once it sees the socket close.
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+
+    def close(self):
+        """Wait for the sandbox to exit."""
+        self.retire()
+        self.proc.wait()
+
+
+class InterpreterPool(object):
+    """Runs tasks in long-lived sandboxes, keyed by ``(interpreter, user, group)``.
+
+    This is added to the worker's event loop so that it hears about tasks
+    finishing (and sandboxes dying). Retired sandboxes are given
+    ``CLOSE_TIMEOUT`` to exit on their own (timed via the ``event_loop``, so
+    nothing waits on them) before they are killed.
+
+    :param broker: the broker that tasks will use; it is pickled once per
+        sandbox rather than once per task.
+    :param int max_tasks_per_child: how many tasks a sandbox runs before it is
+        replaced by a fresh one; ``None`` for no limit.
+    :param event_loop: the loop this is added to, which is updated as
+        sandboxes are started.
+
+    """
+
+    def __init__(self, broker, max_tasks_per_child=None, event_loop=None):
+        self.broker = broker
+        self.max_tasks_per_child = max_tasks_per_child
+        self.event_loop = event_loop
+        self._idle = {}
+        self._busy = []
+        self._retiring = {}
+
+    def run(self, task, stdout, stderr):
+        """Run the given task in a (possibly new) sandbox.
+
+        :param dict task: the task to execute; its ``interpreter``, ``user``,
+            and ``group`` pick the sandbox.
+        :param int stdout: file descriptor for the task's stdout.
+        :param int stderr: file descriptor for the task's stderr.
+        :returns: a :class:`PooledProcess`.
+
+        """
+        key = (task['interpreter'], task['user'], task.get('group'))
+        idle = self._idle.get(key)
+        if idle:
+            sandbox = idle.pop()
+        else:
+            sandbox = Sandbox(key, self.broker)
+            if self.event_loop is not None:
+                self.event_loop.update(self)
+        self._busy.append(sandbox)
+        return sandbox.run(task, stdout, stderr)
+
+    @property
+    def sandboxes(self):
+        return self._busy + [s for idle in self._idle.itervalues() for s in idle]
+
+    def _retire(self, sandbox):
+        if self.event_loop is None:
+            sandbox.close()
+            return
+        sandbox.retire()
+        self._retiring[sandbox] = self.event_loop.add_timer(CLOSE_TIMEOUT, functools.partial(self._kill, sandbox), repeat=False)
+        self._reap(sandbox)
+
+    def _reap(self, sandbox):
+        if sandbox not in self._retiring:
+            return
+        if sandbox.proc.poll() is None:
+            self.event_loop.add_timer(REAP_INTERVAL, functools.partial(self._reap, sandbox), repeat=False)
+            return
+        self.event_loop.remove_timer(self._retiring.pop(sandbox))
+
+    def _kill(self, sandbox):
+        if self._retiring.pop(sandbox, None) is None:
+            return
+        if sandbox.proc.poll() is None:
+            log.warning('sandbox %d did not exit; killing it' % sandbox.proc.pid)
+            sandbox.proc.send_signal(signal.SIGKILL)
+        sandbox.proc.wait()
+
+    def close(self):
+        # Let them all start exiting before we wait on any of them.
+        for sandbox in self.sandboxes:
+            sandbox.retire()
+        for sandbox in self.sandboxes + list(self._retiring):
+            sandbox.proc.wait()
+        for timer in self._retiring.itervalues():
+            self.event_loop.remove_timer(timer)
+        self._idle.clear()
+        self._busy = []
+        self._retiring.clear()
+
+    def to_select(self):
+        return [s.sock.fileno() for s in self.sandboxes], [], []
+
+    def on_select(self, rfds, wfds, xfds):
+        for sandbox in self.sandboxes:
+            if sandbox.sock.fileno() not in rfds:
+                continue
+            alive = sandbox.on_readable()
+            if sandbox.current:
+                continue
+            if sandbox in self._busy:
+                self._busy.remove(sandbox)
+            else:
+                self._idle[sandbox.key].remove(sandbox)
+            if not alive:
+                log.warning('sandbox %d died' % sandbox.proc.pid)
+                self._retire(sandbox)
+            elif self.max_tasks_per_child and sandbox.tasks_run >= self.max_tasks_per_child:
+                log.debug('retiring sandbox %d after %d tasks' % (sandbox.proc.pid, sandbox.tasks_run))
+                self._retire(sandbox)
+            else:
+                self._idle.setdefault(sandbox.key, []).append(sandbox)
+
+
+def serve():
+    """Run tasks as they are sent to us until the control socket closes.
+
+    This is run within the sandbox (via ``thecorner --serve``).
+
+    """
+
+    from aque.local import _local
+    from aque.worker import ProcJob, drop_privileges
+
+    sock = socket.fromfd(0, socket.AF_UNIX, socket.SOCK_STREAM)
+    null = os.open(os.devnull, os.O_RDWR)
+    os.dup2(null, 0)
+
+    setup = recv_message(sock)
+    if setup is None:
+        return
+    broker, user, group = setup
+
+    # So that signals from `aque kill` will be passed down to any child
+    # processes; sadly that includes us.
+    os.setsid()
+    drop_privileges(user, group)
+
+    while True:
+
+        msg = recv_message(sock)
+        if msg is None:
+            return
+        _, token, task = msg
+        stdout = recvfd(sock.fileno())
+        stderr = recvfd(sock.fileno())
+
+        os.dup2(stdout, 1)
+        os.close(stdout)
+        os.dup2(stderr, 2)
+        os.close(stderr)
+
+        try:
+            os.chdir(task['cwd'])
+            ProcJob(broker, task).execute()
+        finally:
+
+            # Let go of the task's output so that the worker sees it end.
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(null, 1)
+            os.dup2(null, 2)
+
+            # Nothing of one task should leak into the next.
+            _local.__dict__.clear()
+
+        send_message(sock, ('done', token))
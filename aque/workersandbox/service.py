@@ -0,0 +1,254 @@
+"""Long-lived instances of services for the ``service`` pattern.
+
+See :mod:`aque.patterns.service` for the protocol.
+
+"""
+
+import errno
+import fcntl
+import functools
+import logging
+import os
+import signal
+import subprocess
+import time
+
+from aque.patterns.service import service_key, start_service
+
+
+log = logging.getLogger(__name__)
+
+
+# How long a service has to exit once its stdin is closed.
+CLOSE_TIMEOUT = 5.0
+
+# How often to check on a retiring service which has closed its output.
+REAP_INTERVAL = 0.05
+
+
+def _set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+class ServiceInstance(object):
+    """A running service, which handles one request at a time."""
+
+    def __init__(self, key, task):
+
+        from aque.worker import drop_privileges
+
+        def preexec():
+            # So that signals reach anything the service starts.
+            os.setsid()
+            drop_privileges(task['user'], task.get('group'))
+
+        self.key = key
+        self.proc = start_service(task, stderr=subprocess.PIPE, preexec_fn=preexec, close_fds=True)
+        self.fds = {
+            self.proc.stdout.fileno(): 1,
+            self.proc.stderr.fileno(): 2,
+        }
+        for fd in self.fds:
+            _set_nonblocking(fd)
+        self._partial = dict((fd, '') for fd in self.fds)
+
+        self.requests = 0
+        self.max_requests = None
+
+        log.debug('service %d started for %r' % (self.proc.pid, task['service']))
+
+    @property
+    def alive(self):
+        return bool(self.fds)
+
+    def send(self, line):
+        self.requests += 1
+        try:
+            self.proc.stdin.write(line)
+            self.proc.stdin.flush()
+        except IOError as e:
+            if e.errno != errno.EPIPE:
+                raise
+            log.warning('service %d is not reading requests' % self.proc.pid)
+
+    def read_lines(self, rfds):
+        """Read whatever is available from the given fds.
+
+        :returns: list of ``(fd, line)``, where ``fd`` is 1 or 2; a partial
+            last line is only returned once the service closes that fd.
+
+        """
+        lines = []
+        for rfd in rfds:
+            to_fd = self.fds.get(rfd)
+            if to_fd is None:
+                continue
+            try:
+                data = os.read(rfd, 65536)
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    continue
+                raise
+            buffered = self._partial[rfd] + data
+            parts = buffered.split('\n')
+            self._partial[rfd] = parts.pop()
+            lines.extend((to_fd, part + '\n') for part in parts)
+            if not data:
+                if self._partial[rfd]:
+                    lines.append((to_fd, self._partial[rfd]))
+                del self.fds[rfd]
+                del self._partial[rfd]
+        return lines
+
+    def kill(self, sig=signal.SIGTERM):
+        try:
+            os.killpg(self.proc.pid, sig)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def retire(self):
+        """Ask the service to exit, by closing its stdin."""
+        if not self.proc.stdin.closed:
+            self.proc.stdin.close()
+
+    def close(self):
+        """Wait for the service to exit (killing it if need be)."""
+        self.retire()
+        deadline = time.time() + CLOSE_TIMEOUT
+        while self.proc.poll() is None and time.time() < deadline:
+            time.sleep(0.01)
+        if self.proc.returncode is None:
+            log.warning('service %d did not exit; killing it' % self.proc.pid)
+            self.kill(signal.SIGKILL)
+            self.proc.wait()
+        self.proc.stdout.close()
+        self.proc.stderr.close()
+        self.fds = {}
+
+
+class ServicePool(object):
+    """Keeps services running between the tasks which use them.
+
+    Tasks are routed to an idle instance with the same
+    :func:`~aque.patterns.service.service_key`, and instances are retired
+    after an error, or after ``service_max_requests`` (from the task) or
+    ``max_requests`` requests.
+
+    This is added to the worker's event loop so that it can drain idle
+    services' output (and notice them exiting), and so the ``event_loop`` is
+    updated whenever instances come or go. Retired instances are given
+    ``CLOSE_TIMEOUT`` to exit on their own (timed via the ``event_loop``, so
+    nothing waits on them) before they are killed.
+
+    """
+
+    def __init__(self, max_requests=None, event_loop=None):
+        self.max_requests = max_requests
+        self.event_loop = event_loop
+        self._idle = {}
+        self._retiring = {}
+
+    def acquire(self, task):
+        """Get an instance for the task, which is ours until :meth:`release`."""
+        key = service_key(task)
+        idle = self._idle.get(key)
+        if idle:
+            instance = idle.pop()
+            self._update()
+        else:
+            instance = ServiceInstance(key, task)
+        instance.max_requests = task.get('service_max_requests') or self.max_requests
+        return instance
+
+    def release(self, instance, ok=True):
+        """Return an instance once it has responded.
+
+        :param bool ok: if false, the instance is retired.
+
+        """
+        if not ok or not instance.alive:
+            self._retire(instance)
+        elif instance.max_requests and instance.requests >= instance.max_requests:
+            log.debug('retiring service %d after %d requests' % (instance.proc.pid, instance.requests))
+            self._retire(instance)
+        else:
+            self._idle.setdefault(instance.key, []).append(instance)
+            self._update()
+
+    def _update(self):
+        if self.event_loop is not None:
+            self.event_loop.update(self)
+
+    def _retire(self, instance):
+        if self.event_loop is None:
+            instance.close()
+            return
+        instance.retire()
+        self._retiring[instance] = (
+            self.event_loop.add_timer(CLOSE_TIMEOUT, functools.partial(self._kill, instance), repeat=False),
+            self.event_loop.add_timer(REAP_INTERVAL, functools.partial(self._reap, instance)),
+        )
+        self._update()
+        self._reap(instance)
+
+    def _reap(self, instance):
+        if instance not in self._retiring:
+            return
+        if instance.alive:
+            # We will hear about it via its output closing.
+            return
+        if instance.proc.poll() is None:
+            return
+        self._forget(instance)
+        instance.close()
+
+    def _kill(self, instance):
+        if instance not in self._retiring:
+            return
+        self._forget(instance)
+        if instance.proc.poll() is None:
+            log.warning('service %d did not exit; killing it' % instance.proc.pid)
+            instance.kill(signal.SIGKILL)
+        instance.close()
+
+    def _forget(self, instance):
+        for timer in self._retiring.pop(instance):
+            self.event_loop.remove_timer(timer)
+        self._update()
+
+    @property
+    def idle(self):
+        return [x for instances in self._idle.itervalues() for x in instances]
+
+    def close(self):
+        # Let them all start exiting before we wait on any of them.
+        instances = self.idle + list(self._retiring)
+        for instance in instances:
+            instance.retire()
+        for instance in instances:
+            instance.close()
+        for timers in self._retiring.itervalues():
+            for timer in timers:
+                self.event_loop.remove_timer(timer)
+        self._idle.clear()
+        self._retiring.clear()
+        self._update()
+
+    def to_select(self):
+        instances = self.idle + list(self._retiring)
+        return [fd for instance in instances for fd in instance.fds], [], []
+
+    def on_select(self, rfds, wfds, xfds):
+        for instance in list(self._retiring):
+            for fd, line in instance.read_lines(rfds):
+                log.info('retiring service %d said %r' % (instance.proc.pid, line))
+            self._reap(instance)
+        for instance in self.idle:
+            for fd, line in instance.read_lines(rfds):
+                log.info('idle service %d said %r' % (instance.proc.pid, line))
+            if not instance.alive:
+                log.info('idle service %d exited' % instance.proc.pid)
+                self._idle[instance.key].remove(instance)
+                self._retire(instance)
@@ -3,5 +3,10 @@
 # This is as clean of an execution environment as we can muster for apps like
 # Maya which will execute arbitrary code in the __main__ module.
 
-from aque.worker import procjob_execute as _aque_worker_procjob_execute
-_aque_worker_procjob_execute()
+import sys as _aque_sys
+if _aque_sys.argv[1:2] == ['--serve']:
+    from aque.workersandbox.pool import serve as _aque_pool_serve
+    _aque_pool_serve()
+else:
+    from aque.worker import procjob_execute as _aque_worker_procjob_execute
+    _aque_worker_procjob_execute()
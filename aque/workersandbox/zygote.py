@@ -0,0 +1,288 @@
+"""A lean process which forks task processes on behalf of a worker.
+
+Forking tasks straight from the worker copies its whole heap (the broker's
+connection pool, event loop, pending index, etc.) into every task, and that
+heap only grows. Instead, the worker starts a :class:`Zygote` (in a fresh
+interpreter which imports little more than what the tasks need), and asks it
+to fork the tasks over a control socket.
+
+The protocol is a stream of :func:`~aque.utils.send_message` frames:
+
+- the worker first sends its pickled broker;
+- ``('spawn', token, tasks)``, followed by the tasks' stdout and stderr
+  (passed as file descriptors), to which the zygote replies
+  ``('spawned', token, pid)``;
+- ``('exited', pid, status)`` is sent by the zygote whenever one of its
+  children exits.
+
+"""
+
+import errno
+import fcntl
+import logging
+import os
+import select
+import signal
+import socket
+import subprocess
+import sys
+import traceback
+
+from _multiprocessing import sendfd, recvfd
+
+from aque.eventloop import StopSelection
+from aque.utils import send_message, recv_message
+
+
+log = logging.getLogger(__name__)
+
+
+class ZygoteProcess(object):
+    """A handle on a process forked by a :class:`Zygote`.
+
+    Quacks enough like :class:`multiprocessing.Process` for :class:`.ProcJob`.
+
+    """
+
+    def __init__(self, zygote, pid):
+        self.zygote = zygote
+        self.pid = pid
+
+    def is_alive(self):
+        return self.zygote.is_alive(self.pid)
+
+    @property
+    def exitcode(self):
+        return self.zygote.exited.get(self.pid)
+
+
+class Zygote(object):
+    """The worker's side of a zygote process.
+
+    This is added to the worker's event loop so that it hears about its
+    children exiting.
+
+    :param broker: the broker that tasks will use; it is pickled once for the
+        zygote rather than once per task.
+    :param preload: names of modules to import in the zygote before forking,
+        so that tasks don't each have to.
+
+    """
+
+    def __init__(self, broker, preload=()):
+        self.broker = broker
+        self.preload = list(preload)
+        self.proc = None
+        self.exited = {}
+        self._sock = None
+        self._next_token = 0
+
+    def start(self):
+
+        ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+
+        # The control socket is the zygote's stdin, so that nothing else of
+        # ours needs to be inherited.
+        cmd = [sys.executable, '-m', 'aque.workersandbox.zygote'] + self.preload
+        self.proc = subprocess.Popen(cmd, stdin=theirs, close_fds=True)
+        theirs.close()
+
+        self._sock = ours
+        send_message(self._sock, self.broker)
+        log.debug('zygote %d started' % self.proc.pid)
+
+    @property
+    def running(self):
+        return self._sock is not None
+
+    def close(self):
+        if self._sock is not None:
+            # The zygote exits once it sees the socket close.
+            self._sock.shutdown(socket.SHUT_RDWR)
+            self._sock.close()
+            self._sock = None
+            self.proc.wait()
+
+    def spawn(self, task, stdout, stderr, batch=()):
+        """Fork a process to execute the given task.
+
+        :param dict task: the task to execute.
+        :param int stdout: file descriptor for the process' stdout.
+        :param int stderr: file descriptor for the process' stderr.
+        :param list batch: other tasks to execute in the same process.
+        :returns: a :class:`ZygoteProcess`.
+
+        """
+
+        if self._sock is None:
+            raise RuntimeError('zygote is not running')
+
+        self._next_token += 1
+        token = self._next_token
+
+        send_message(self._sock, ('spawn', token, [task] + list(batch)))
+        sendfd(self._sock.fileno(), stdout)
+        sendfd(self._sock.fileno(), stderr)
+
+        # Children which exit in the meantime are dealt with as usual.
+        while True:
+            msg = self._recv()
+            if msg is None:
+                raise RuntimeError('zygote died while spawning')
+            if msg[0] == 'spawned' and msg[1] == token:
+                return ZygoteProcess(self, msg[2])
+
+    def is_alive(self, pid):
+        return self._sock is not None and pid not in self.exited
+
+    def forget(self, pid):
+        self.exited.pop(pid, None)
+
+    def _recv(self):
+        msg = recv_message(self._sock)
+        if msg is None:
+            # Everything it forked is as good as dead to us.
+            log.error('zygote %d died' % self.proc.pid)
+            self._sock.close()
+            self._sock = None
+            self.proc.wait()
+            return
+        if msg[0] == 'exited':
+            self.exited[msg[1]] = msg[2]
+        return msg
+
+    def to_select(self):
+        if self._sock is None:
+            raise StopSelection()
+        return [self._sock.fileno()], [], []
+
+    def on_select(self, rfds, wfds, xfds):
+        # It may have died while spawning, since we last selected.
+        if self._sock is None or (rfds and self._recv() is None):
+            raise StopSelection()
+
+
+def _retry(func, *args):
+    # Our own SIGCHLD handler may interrupt anything.
+    while True:
+        try:
+            return func(*args)
+        except (OSError, IOError) as e:
+            if e.errno != errno.EINTR:
+                raise
+
+
+def _set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+def _child_main(broker, tasks, stdout, stderr):
+
+    from aque.worker import ProcJob
+
+    null = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(null, 0)
+    os.close(null)
+    os.dup2(stdout, 1)
+    os.close(stdout)
+    os.dup2(stderr, 2)
+    os.close(stderr)
+
+    broker.after_fork()
+    job = ProcJob(broker, tasks[0], batch=tasks[1:])
+    job.bootstrap()
+    job.execute()
+
+
+def serve(sock, broker):
+    """Fork children on request until the control socket closes."""
+
+    # Children exiting wake us up via this pipe.
+    wake_r, wake_w = os.pipe()
+    _set_nonblocking(wake_r)
+    _set_nonblocking(wake_w)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+    signal.set_wakeup_fd(wake_w)
+
+    while True:
+
+        try:
+            rlist, _, _ = select.select([sock, wake_r], [], [])
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            rlist = [wake_r]
+
+        if wake_r in rlist:
+            try:
+                while os.read(wake_r, 4096):
+                    pass
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+            _reap(sock)
+
+        if sock not in rlist:
+            continue
+
+        msg = recv_message(sock)
+        if msg is None:
+            return
+
+        _, token, tasks = msg
+        stdout = _retry(recvfd, sock.fileno())
+        stderr = _retry(recvfd, sock.fileno())
+
+        pid = os.fork()
+        if not pid:
+            status = 0
+            try:
+                signal.set_wakeup_fd(-1)
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                sock.close()
+                os.close(wake_r)
+                os.close(wake_w)
+                _child_main(broker, tasks, stdout, stderr)
+            except:
+                traceback.print_exc()
+                status = 1
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(status)
+
+        os.close(stdout)
+        os.close(stderr)
+        send_message(sock, ('spawned', token, pid))
+
+
+def _reap(sock):
+    while True:
+        try:
+            pid, status = _retry(os.waitpid, -1, os.WNOHANG)
+        except OSError as e:
+            if e.errno == errno.ECHILD:
+                return
+            raise
+        if not pid:
+            return
+        send_message(sock, ('exited', pid, status))
+
+
+def main(argv=None):
+
+    argv = sys.argv[1:] if argv is None else argv
+    for name in argv:
+        __import__(name)
+
+    sock = socket.fromfd(0, socket.AF_UNIX, socket.SOCK_STREAM)
+    os.close(0)
+
+    broker = recv_message(sock)
+    if broker is not None:
+        serve(sock, broker)
+
+
+if __name__ == '__main__':
+    main()
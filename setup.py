@@ -23,6 +23,7 @@ setup(
         'aque_patterns': [
             'generic = aque.patterns.generic:do_generic_task',
             'reduce = aque.patterns.reduce:do_reduce_task',
+            'service = aque.patterns.service:do_service_task',
             'shell = aque.patterns.shell:do_shell_task',
         ],
         'aque_brokers': [
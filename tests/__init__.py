@@ -99,6 +99,7 @@ class BrokerTestCase(TestCase):
         self.worker.run_to_end()
 
     def tearDown(self):
+        self.worker.close()
         self.broker.close()
 
 
@@ -110,6 +111,6 @@ class WorkerTestCase(BrokerTestCase):
         self.worker_thread.start()
 
     def tearDown(self):
-        super(WorkerTestCase, self).tearDown()
         self.worker.stop()
         self.worker_thread.join(1.1) # Just longer than the worker sleep time.
+        super(WorkerTestCase, self).tearDown()
@@ -0,0 +1,31 @@
+from . import *
+
+
+class TestClaiming(BrokerTestCase):
+
+    def test_claim_by_priority(self):
+
+        low = self.queue.submit_ex(tuple, priority=10)
+        high = self.queue.submit_ex(tuple, priority=2000)
+        mid = self.queue.submit_ex(tuple, priority=1000)
+
+        ids = [low.id, high.id, mid.id]
+        claimed = self.broker.claim(2, {'ids': ids})
+        self.assertEqual([t['id'] for t in claimed], [high.id, mid.id])
+
+        for task in claimed:
+            self.broker.release(task['id'])
+        self.broker.delete(ids)
+
+    def test_claim_requirements(self):
+
+        small = self.queue.submit_ex(tuple, cpus=1)
+        big = self.queue.submit_ex(tuple, cpus=64)
+
+        ids = [small.id, big.id]
+        claimed = self.broker.claim(2, {'ids': ids, 'cpus': 2})
+        self.assertEqual([t['id'] for t in claimed], [small.id])
+
+        for task in claimed:
+            self.broker.release(task['id'])
+        self.broker.delete(ids)
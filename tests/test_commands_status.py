@@ -0,0 +1,52 @@
+from . import *
+
+import argparse
+
+from aque.brokers.postgres import LazyTask
+from aque.commands.status import status
+
+
+class MappingBroker(object):
+    """Hands out tasks which are mappings but not dicts (as PostgresBroker does)."""
+
+    def __init__(self, tasks):
+        self.tasks = tasks
+
+    def fetch(self, tids):
+        return dict((tid, LazyTask(None, self.tasks[tid])) for tid in tids)
+
+
+def make_task(tid, dependencies=()):
+    return {
+        'id': tid,
+        'user': 'someone',
+        'status': 'pending',
+        'pattern': None,
+        'name': 'task %d' % tid,
+        'func': None,
+        'args': (),
+        'kwargs': {},
+        'dependencies': list(dependencies),
+    }
+
+
+class TestStatusCommand(TestCase):
+
+    def test_mapping_dependencies(self):
+
+        tasks = dict((t['id'], t) for t in [make_task(1, [2, 3]), make_task(2), make_task(3)])
+        args = argparse.Namespace(
+            broker=MappingBroker(tasks),
+            tids=[1, 2, 3],
+            depth=0,
+            flat=False,
+            all_users=False,
+            filter=None,
+            csv='id,depth,num_dependencies',
+            pattern=None,
+        )
+
+        with override_stdio() as (out, _):
+            status(args)
+        rows = [(int(r['id']), int(r['depth']), int(r['num_dependencies'])) for r in DictReader(out)]
+        self.assertEqual(rows, [(1, 1, 2), (2, 2, 0), (3, 2, 0)])
@@ -1,5 +1,7 @@
 from . import *
 
+from aque.commands import xargs as xargs_module
+
 
 class TestXargsCommand(BrokerTestCase):
 
@@ -48,3 +50,58 @@ class TestXargsCommand(BrokerTestCase):
         self.worker.run_to_end()
         self.assertEqual(set(open(path).read().strip().split()), set(str(x) for x in tids[:-1]))
 
+
+    def test_chunked_submission(self):
+
+        chunks = []
+        real_submit_many = Queue.submit_many
+        def submit_many(queue, prototypes):
+            chunks.append(len(prototypes))
+            return real_submit_many(queue, prototypes)
+
+        old_size = xargs_module.SUBMIT_CHUNK_SIZE
+        xargs_module.SUBMIT_CHUNK_SIZE = 2
+        Queue.submit_many = submit_many
+        try:
+            out = self_check_output(['xargs', '-v', '-L1', 'true'], stdin='1\n2\n3\n4\n5\n')
+        finally:
+            xargs_module.SUBMIT_CHUNK_SIZE = old_size
+            Queue.submit_many = real_submit_many
+
+        tids = [int(x) for x in out.strip().split()]
+        self.assertEqual(len(tids), 6)
+        self.assertEqual(chunks, [2, 2, 1, 1]) # The last is the group.
+        self.worker.run_to_end()
+
+    def test_stalled_input(self):
+
+        chunks = []
+        real_submit_many = Queue.submit_many
+        def submit_many(queue, prototypes):
+            chunks.append(len(prototypes))
+            return real_submit_many(queue, prototypes)
+
+        # The second line doesn't come until the first has been submitted.
+        def iter_lines():
+            yield '1\n'
+            deadline = time.time() + 5
+            while not chunks and time.time() < deadline:
+                time.sleep(0.01)
+            yield '2\n'
+
+        old_interval = xargs_module.SUBMIT_CHUNK_INTERVAL
+        old_iter_lines = xargs_module.iter_lines
+        xargs_module.SUBMIT_CHUNK_INTERVAL = 0.05
+        xargs_module.iter_lines = iter_lines
+        Queue.submit_many = submit_many
+        try:
+            out = self_check_output(['xargs', '-v', '-L1', 'true'])
+        finally:
+            xargs_module.SUBMIT_CHUNK_INTERVAL = old_interval
+            xargs_module.iter_lines = old_iter_lines
+            Queue.submit_many = real_submit_many
+
+        tids = [int(x) for x in out.strip().split()]
+        self.assertEqual(len(tids), 3)
+        self.assertEqual(chunks, [1, 1, 1]) # The last is the group.
+        self.worker.run_to_end()
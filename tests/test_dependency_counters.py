@@ -0,0 +1,86 @@
+from . import *
+
+
+class TestDependencyCounters(BrokerTestCase):
+
+    def unfinished(self, future):
+        return self.broker.fetch(future.id)['unfinished_dependencies']
+
+    def test_counts_follow_status(self):
+
+        b = self.queue.submit(tuple)
+        c = self.queue.submit(tuple)
+        a = self.queue.submit_ex(tuple, dependencies=[b, c])
+        self.assertEqual(self.unfinished(a), 2)
+
+        self.broker.set_status_and_notify(b.id, 'success')
+        self.assertEqual(self.unfinished(a), 1)
+        self.assertEqual(set(self.broker.fetch_dependents([b.id])), set([a.id]))
+
+        self.broker.set_status_and_notify(c.id, 'error')
+        self.assertEqual(self.unfinished(a), 0)
+
+        # Retrying puts it back.
+        self.broker.set_status_and_notify(c.id, 'pending')
+        self.assertEqual(self.unfinished(a), 1)
+
+        self.broker.delete([a.id, b.id, c.id])
+
+    def test_finished_dependency(self):
+
+        b = self.queue.submit(tuple)
+        self.broker.set_status_and_notify(b.id, 'success')
+        a = self.queue.submit_ex(tuple, dependencies=[b])
+        self.assertEqual(self.unfinished(a), 0)
+
+        self.broker.delete([a.id, b.id])
+
+    def test_bulk_statuses(self):
+
+        b = self.queue.submit(tuple)
+        c = self.queue.submit(tuple)
+        a = self.queue.submit_ex(tuple, dependencies=[b, c])
+
+        notified = []
+        def on_status(tids, status):
+            notified.append((sorted(tids), status))
+        self.broker.bind('task_status', on_status)
+
+        self.broker.set_statuses_and_notify([
+            (b.id, 'success', 'b result'),
+            (c.id, 'error', ValueError('c error')),
+        ])
+
+        self.assertEqual(self.unfinished(a), 0)
+        self.assertEqual(b.result(0.1), 'b result')
+        self.assertRaises(ValueError, c.result, 0.1)
+        self.assertEqual(notified, [([b.id], 'success'), ([c.id], 'error')])
+
+        self.broker.unbind('task_status', on_status)
+        self.broker.delete([a.id, b.id, c.id])
+
+
+class _ProjectingBroker(object):
+    """Only returns the fields it is asked for."""
+
+    def __init__(self, tasks):
+        self.tasks = tasks
+
+    def search(self, filter=None, fields=None):
+        for task in self.tasks:
+            yield dict((k, v) for k, v in task.iteritems() if fields is None or k in fields)
+
+
+class TestBaseFetchDependents(TestCase):
+
+    def test_fields_are_honoured(self):
+
+        from aque.brokers.base import Broker
+
+        broker = _ProjectingBroker([
+            {'id': 1, 'status': 'success', 'dependencies': []},
+            {'id': 2, 'status': 'pending', 'dependencies': [1]},
+        ])
+        dependents = Broker.fetch_dependents.im_func(broker, [1], ['status'])
+        self.assertEqual(dependents.keys(), [2])
+        self.assertEqual(dependents[2]['status'], 'pending')
@@ -0,0 +1,78 @@
+from . import *
+
+from aque.brokers import postgres
+
+
+class TestEventChannels(TestCase):
+
+    def test_status_round_trip(self):
+
+        tids = range(1, 10001) + [20000, 20002]
+        events = ['task_status', 'task_status.success'] + ['task_status.%d' % tid for tid in tids]
+        encoded = list(postgres._encode_notifications(events, (tids, 'success'), {}))
+
+        self.assertEqual(len(encoded), 1)
+        channel, payload = encoded[0]
+        self.assertEqual(channel, 'task_status')
+        self.assertTrue(len(payload) < 200)
+
+        bound = set(['task_status', 'task_status.success', 'task_status.20002'])
+        events, args, kwargs = postgres._decode_notification(channel, payload, bound)
+        self.assertEqual(sorted(events), ['task_status', 'task_status.20002', 'task_status.success'])
+        self.assertEqual(args, [tids, 'success'])
+        self.assertEqual(kwargs, {})
+
+    def test_single_tid(self):
+        encoded = list(postgres._encode_notifications(['output_log', 'output_log.5'], (5, [[1, 0, 10]]), {}))
+        self.assertEqual([c for c, p in encoded], ['output_log'])
+        events, args, kwargs = postgres._decode_notification(*encoded[0])
+        self.assertEqual(events, ['output_log', 'output_log.5'])
+        self.assertEqual(args, [5, [[1, 0, 10]]])
+
+    def test_split(self):
+
+        # Every other ID, so that the ranges do not compress.
+        tids = range(0, 20000, 2)
+        events = ['task_status.pending'] + ['task_status.%d' % tid for tid in tids]
+        encoded = list(postgres._encode_notifications(events, (tids, 'pending'), {}))
+
+        self.assertTrue(len(encoded) > 1)
+        seen = []
+        for channel, payload in encoded:
+            self.assertTrue(len(payload) <= postgres.NOTIFY_MAX_PAYLOAD)
+            events, args, kwargs = postgres._decode_notification(channel, payload)
+            self.assertEqual(args[1], 'pending')
+            self.assertIn('task_status.pending', events)
+            self.assertEqual(len(events), len(args[0]) + 1)
+            seen.extend(args[0])
+        self.assertEqual(seen, tids)
+
+    def test_split_output_chunks(self):
+
+        # As from output which flips between stdout and stderr.
+        chunks = [[1 + i % 2, i * 10, 10] for i in xrange(2000)]
+        encoded = list(postgres._encode_notifications(['output_log', 'output_log.5'], (5, chunks), {}))
+        self.assertTrue(len(encoded) > 1)
+
+        seen = []
+        for channel, payload in encoded:
+            self.assertEqual(channel, 'output_log')
+            self.assertTrue(len(payload) <= postgres.NOTIFY_MAX_PAYLOAD)
+            events, args, kwargs = postgres._decode_notification(channel, payload)
+            self.assertEqual(events, ['output_log', 'output_log.5'])
+            self.assertEqual(args[0], 5)
+            seen.extend(args[1])
+        self.assertEqual(seen, chunks)
+
+    def test_unsplittable(self):
+        self.assertRaises(ValueError, list, postgres._encode_notifications(['big'], (), {'x': 'x' * 10000}))
+
+    def test_other_events(self):
+        encoded = list(postgres._encode_notifications(['task_status.3', 'worker_changed'], ([3, 4], ), {'x': 1}))
+        self.assertEqual([c for c, p in encoded], ['task_status', 'worker_changed'])
+        events, args, kwargs = postgres._decode_notification(*encoded[0])
+        self.assertEqual(events, ['task_status.3'])
+        self.assertEqual(args, [[3, 4]])
+        self.assertEqual(kwargs, {'x': 1})
+        events, args, kwargs = postgres._decode_notification(*encoded[1])
+        self.assertEqual(events, ['worker_changed'])
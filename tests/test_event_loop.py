@@ -1,5 +1,7 @@
 from . import *
 
+from aque import eventloop
+
 
 class TestTimers(TestCase):
 
@@ -43,4 +45,217 @@ class TestTimers(TestCase):
         self.assertLess(elapsed, 0.45)
         self.assertEqual(res, [1, 3, 2, 1, 2])
 
+    def test_one_shot_and_handles(self):
+
+        res = []
+        loop = EventLoop()
+        loop.add_timer(0.005, functools.partial(res.append, 1), repeat=False)
+        timer = loop.add_timer(0.005, functools.partial(res.append, 2))
+        loop.remove_timer(timer)
+
+        loop.process(0.02)
+        self.assertEqual(res, [1])
+        self.assertEqual(loop.timers, [])
+
+        # Nothing left to wait for.
+        start_time = time.time()
+        loop.process(0.02)
+        self.assertLess(time.time() - start_time, 0.01)
+        self.assertEqual(res, [1])
+
+    def test_catch_up(self):
+
+        res = []
+        loop = EventLoop()
+        loop.add_timer(0.005, functools.partial(res.append, 'skip'))
+        loop.add_timer(0.005, functools.partial(res.append, 'all'), catch_up=eventloop.CATCH_UP_ALL)
+
+        # Fall well behind; each fires once per pass, but "all" stays behind.
+        time.sleep(0.03)
+        loop.process(0)
+        self.assertEqual(res, ['skip', 'all'])
+        loop.process(0)
+        self.assertEqual(res, ['skip', 'all', 'all'])
+
+        self.assertRaises(ValueError, loop.add_timer, 1, res.append, catch_up='nope')
+
+    def test_bad_intervals(self):
+
+        loop = EventLoop()
+        self.assertRaises(ValueError, loop.add_timer, 0, lambda: None)
+        self.assertRaises(ValueError, loop.add_timer, -1, lambda: None)
+        self.assertRaises(ValueError, loop.add_timer, -1, lambda: None, repeat=False)
+
+        # A one-shot timer may fire on the very next pass.
+        res = []
+        loop.add_timer(0, functools.partial(res.append, 1), repeat=False)
+        loop.process(0)
+        self.assertEqual(res, [1])
+
+
+
+class _PipeReader(object):
+
+    def __init__(self):
+        self.rfd, self.wfd = os.pipe()
+        self.reads = []
+        self.selects = 0
+
+    def to_select(self):
+        self.selects += 1
+        return [self.rfd], [], []
+
+    def on_select(self, rfds, wfds, xfds):
+        data = os.read(self.rfd, 1024)
+        if not data:
+            os.close(self.rfd)
+            raise StopSelection()
+        self.reads.append(data)
+
+
+class _Poller(object):
+
+    def __init__(self):
+        self.calls = 0
+
+    def to_select(self):
+        return [], [], []
+
+    def on_select(self, rfds, wfds, xfds):
+        self.calls += 1
+
+
+class TestPollers(TestCase):
+
+    def _test_poller(self, poller_class):
+
+        loop = EventLoop(poller_class)
+        reader = _PipeReader()
+        idle = _PipeReader()
+        poller = _Poller()
+        loop.add(reader)
+        loop.add(idle)
+        loop.add(poller)
+
+        os.write(reader.wfd, 'hello')
+        loop.process(1)
+        self.assertEqual(reader.reads, ['hello'])
+        self.assertEqual(idle.reads, [])
+        self.assertEqual(poller.calls, 1)
+
+        os.close(reader.wfd)
+        loop.process(1)
+        self.assertIn(reader, loop.stopped)
+        self.assertNotIn(idle, loop.stopped)
+
+        os.close(idle.rfd)
+        os.close(idle.wfd)
+
+    def test_select(self):
+        self._test_poller(eventloop.SelectPoller)
+
+    def test_poll(self):
+        if not hasattr(eventloop, 'PollPoller'):
+            self.skipTest('poll is not availible')
+        self._test_poller(eventloop.PollPoller)
+
+    def test_epoll(self):
+        if not hasattr(eventloop, 'EpollPoller'):
+            self.skipTest('epoll is not availible')
+        self._test_poller(eventloop.EpollPoller)
+
+
+class _Switcher(object):
+
+    def __init__(self, *fds):
+        self.fds = list(fds)
+        self.calls = []
+
+    def to_select(self):
+        if self.fds is None:
+            raise StopSelection()
+        return self.fds, [], []
+
+    def on_select(self, rfds, wfds, xfds):
+        self.calls.append(sorted(rfds))
+
+
+class TestRegistration(TestCase):
+
+    def test_idle_objects_are_not_asked(self):
+
+        loop = EventLoop()
+        readers = [_PipeReader() for _ in xrange(10)]
+        for reader in readers:
+            loop.add(reader)
+
+        for i in xrange(3):
+            os.write(readers[0].wfd, 'x')
+            loop.process(1)
+        self.assertEqual(readers[0].reads, ['x'] * 3)
+
+        # Asked once when added, and again after each time it was dispatched.
+        self.assertEqual(readers[0].selects, 4)
+        self.assertEqual([r.selects for r in readers[1:]], [1] * 9)
+
+        for reader in readers:
+            os.close(reader.rfd)
+            os.close(reader.wfd)
+
+    def test_update(self):
+
+        a_r, a_w = os.pipe()
+        b_r, b_w = os.pipe()
+
+        loop = EventLoop()
+        obj = _Switcher(a_r)
+        loop.add(obj)
+
+        os.write(b_w, 'x')
+        loop.process(0.01)
+        self.assertEqual(obj.calls, [])
+
+        # Nothing changes until the loop is told.
+        obj.fds = [b_r]
+        loop.process(0.01)
+        self.assertEqual(obj.calls, [])
+
+        loop.update(obj)
+        loop.process(0.01)
+        self.assertEqual(obj.calls, [[b_r]])
+        os.read(b_r, 1024)
+
+        os.write(a_w, 'x')
+        loop.process(0.01)
+        self.assertEqual(obj.calls, [[b_r]])
+
+        obj.fds = None
+        loop.update(obj)
+        loop.process(0.01)
+        self.assertEqual(loop.stopped, [obj])
+        self.assertEqual(loop._registered, {})
+
+        for fd in (a_r, a_w, b_r, b_w):
+            os.close(fd)
+
+    def test_shared_fds(self):
+
+        r, w = os.pipe()
+        loop = EventLoop()
+        a = _Switcher(r)
+        b = _Switcher(r)
+        loop.add(a)
+        loop.add(b)
+
+        os.write(w, 'x')
+        loop.process(1)
+        self.assertEqual(len(a.calls + b.calls), 2)
+
+        # The other keeps it registered.
+        loop.remove(a)
+        loop.process(1)
+        self.assertEqual(len(a.calls), 1)
+        self.assertEqual(len(b.calls), 2)
 
+        os.close(r)
+        os.close(w)
@@ -0,0 +1,47 @@
+from . import *
+
+
+class TestFutureResolution(BrokerTestCase):
+
+    def test_batched_resolution(self):
+
+        self.broker.future_resolution_window = 0.05
+
+        fetches = []
+        real_fetch_many = self.broker._fetch_many
+        def _fetch_many(tids, fields):
+            if fields == ['id', 'status', 'result']:
+                fetches.append(sorted(tids))
+            return real_fetch_many(tids, fields)
+        self.broker._fetch_many = _fetch_many
+
+        a = self.queue.submit_ex(func=str, args=(1, ))
+        b = self.queue.submit_ex(func=str, args=(2, ))
+        self.worker.run_to_end()
+
+        timeout = time.time() + 1
+        while not (a.done() and b.done()) and time.time() < timeout:
+            self.broker._event_loop.process(timeout=0.01)
+
+        self.assertEqual(a.result(0), '1')
+        self.assertEqual(b.result(0), '2')
+        self.assertEqual(fetches, [sorted([a.id, b.id])])
+
+    def test_only_live_futures(self):
+
+        fetches = []
+        real_fetch_many = self.broker._fetch_many
+        def _fetch_many(tids, fields):
+            if fields == ['id', 'status', 'result']:
+                fetches.append(sorted(tids))
+            return real_fetch_many(tids, fields)
+        self.broker._fetch_many = _fetch_many
+
+        a = self.queue.submit_ex(func=str, args=(1, ))
+        tid = self.queue.submit_ex(func=str, args=(2, )).id
+        self.worker.run_to_end()
+
+        # Resolution may be batched up for a moment.
+        self.assertEqual(a.result(1), '1')
+        self.assertFalse(any(tid in tids for tids in fetches))
+        self.assertEqual(self.broker.fetch(tid)['result'], '2')
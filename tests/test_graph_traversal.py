@@ -63,6 +63,41 @@ class TestGraphTraversal(BrokerTestCase):
         self.assertRaises(DependencyResolutionError, execute, a)
 
 
+class TestGraphFetching(BrokerTestCase):
+
+    def test_fetch_graph(self):
+
+        a = {'pattern': None, 'name': 'a'}
+        b = {'pattern': None, 'name': 'b'}
+        c = {'pattern': None, 'name': 'c'}
+        d = {'pattern': None, 'name': 'd'}
+        a['dependencies'] = [b, c]
+        b['dependencies'] = [d]
+        c['dependencies'] = [d]
+        futures = self.queue.submit_many([a])
+        other = self.queue.submit_ex(pattern=None, name='other')
+
+        tasks = self.broker.fetch_graph([futures[id(a)].id], ['name'])
+        self.assertEqual(sorted(t['name'] for t in tasks.itervalues()), ['a', 'b', 'c', 'd'])
+        self.assertNotIn(other.id, tasks)
+
+        # Breadth first.
+        names = [f.task()['name'] for f in futures[id(a)].iter()]
+        self.assertEqual(names[0], 'a')
+        self.assertEqual(sorted(names[1:3]), ['b', 'c'])
+        self.assertEqual(names[3:], ['d'])
+
+    def test_deep_chain(self):
+
+        # Deeper than the recursion limit.
+        tids = self.broker.reserve_ids(2000)
+        futures = self.broker.create_pending([
+            {'id': tid, 'pattern': None, 'dependencies': tids[i - 1:i]}
+            for i, tid in enumerate(tids)
+        ])
+        self.assertEqual([f.id for f in futures[-1].iter()], tids[::-1])
+
+
 class TestGraphFlattening(BrokerTestCase):
 
     def test_simple_flattening(self):
@@ -74,7 +109,13 @@ class TestGraphFlattening(BrokerTestCase):
         a['dependencies'] = [b, c]
 
         flattened = list(self.queue._flatten_prototypes([a, d]))
-        self.assertEqual(flattened, [b, c, a, d])
+        self.assertEqual([pid for pid, _ in flattened], [id(b), id(c), id(a), id(d)])
+        self.assertEqual([t['name'] for _, t in flattened], ['b', 'c', 'a', 'd'])
+        self.assertEqual(flattened[2][1]['dependencies'], [id(b), id(c)])
+
+        # The prototypes themselves are left alone.
+        self.assertEqual(a, {'name': 'a', 'dependencies': [b, c]})
+        self.assertEqual(b, {'name': 'b'})
 
     def test_loop(self):
         a = {}
@@ -0,0 +1,99 @@
+import grp
+import pwd
+
+from . import *
+from .test_zygote import EchoBroker
+
+from aque.local import _local
+from aque.workersandbox.pool import InterpreterPool
+
+
+def task_pid():
+    return os.getpid()
+
+def leak_local():
+    leaked = getattr(_local, 'leaked', None)
+    _local.leaked = True
+    return leaked
+
+
+class TestInterpreterPool(TestCase):
+
+    def run_task(self, pool, loop, func):
+
+        user = pwd.getpwuid(os.getuid())
+        r, w = os.pipe()
+        proc = pool.run({
+            'id': 123,
+            'func': func,
+            'interpreter': sys.executable,
+            'user': user.pw_name,
+            'group': grp.getgrgid(user.pw_gid).gr_name,
+            'cwd': os.getcwd(),
+        }, w, w)
+        os.close(w)
+
+        output = []
+        while True:
+            chunk = os.read(r, 4096)
+            if not chunk:
+                break
+            output.append(chunk)
+        os.close(r)
+
+        timeout = time.time() + 5
+        while proc.is_alive() and time.time() < timeout:
+            loop.process(0.1)
+        self.assertFalse(proc.is_alive())
+
+        return proc, ''.join(output)
+
+    def test_reuse_and_recycle(self):
+
+        loop = EventLoop()
+        pool = InterpreterPool(EchoBroker(), max_tasks_per_child=3, event_loop=loop)
+        loop.add(pool)
+        try:
+
+            a, out = self.run_task(pool, loop, task_pid)
+            self.assertEqual(out, 'task 123 success: %d\n' % a.pid)
+
+            # State from one task does not leak into the next.
+            b, out = self.run_task(pool, loop, leak_local)
+            self.assertEqual(b.pid, a.pid)
+            self.assertEqual(out, 'task 123 success: None\n')
+            c, out = self.run_task(pool, loop, leak_local)
+            self.assertEqual(c.pid, a.pid)
+            self.assertEqual(out, 'task 123 success: None\n')
+
+            # That was its last task.
+            d, out = self.run_task(pool, loop, task_pid)
+            self.assertNotEqual(d.pid, a.pid)
+            self.assertEqual(out, 'task 123 success: %d\n' % d.pid)
+
+        finally:
+            pool.close()
+
+        self.assertEqual(pool.sandboxes, [])
+
+    def test_retirement_does_not_block(self):
+
+        loop = EventLoop()
+        pool = InterpreterPool(EchoBroker(), max_tasks_per_child=1, event_loop=loop)
+        loop.add(pool)
+        try:
+
+            a, out = self.run_task(pool, loop, task_pid)
+            self.assertEqual(out, 'task 123 success: %d\n' % a.pid)
+
+            # It was retired as soon as it was done, and is reaped later.
+            self.assertEqual(pool.sandboxes, [])
+            sandbox, = pool._retiring
+            deadline = time.time() + 5
+            while pool._retiring and time.time() < deadline:
+                loop.process(0.1)
+            self.assertEqual(pool._retiring, {})
+            self.assertIsNotNone(sandbox.proc.returncode)
+
+        finally:
+            pool.close()
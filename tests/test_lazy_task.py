@@ -0,0 +1,57 @@
+from . import *
+
+import pickle
+
+from aque.brokers.postgres import LazyTask
+
+
+class TestLazyTask(TestCase):
+
+    def test_decode_on_access(self):
+
+        decoded = []
+        def decode(field, value):
+            decoded.append(field)
+            return pickle.loads(str(value))
+
+        task = LazyTask(decode, id=1, args=buffer(pickle.dumps((1, 2))), result=buffer(pickle.dumps('done')))
+        self.assertEqual(task['id'], 1)
+        self.assertEqual(decoded, [])
+
+        self.assertEqual(task.get('args'), (1, 2))
+        self.assertEqual(task['args'], (1, 2))
+        self.assertEqual(decoded, ['args'])
+
+        self.assertEqual(task, {'id': 1, 'args': (1, 2), 'result': 'done'})
+        self.assertEqual(sorted(decoded), ['args', 'result'])
+
+    def test_copies_are_plain(self):
+
+        task = LazyTask(lambda f, v: pickle.loads(str(v)), id=1, args=buffer(pickle.dumps((1, 2))))
+
+        copied = task.copy()
+        self.assertIs(type(copied), dict)
+        self.assertEqual(copied, {'id': 1, 'args': (1, 2)})
+
+        task = LazyTask(lambda f, v: pickle.loads(str(v)), id=1, args=buffer(pickle.dumps((1, 2))))
+        unpickled = pickle.loads(pickle.dumps(task, protocol=-1))
+        self.assertIs(type(unpickled), dict)
+        self.assertEqual(unpickled, {'id': 1, 'args': (1, 2)})
+
+    def test_plain_dict_conversions(self):
+
+        def make():
+            return LazyTask(lambda f, v: pickle.loads(str(v)), id=1, args=buffer(pickle.dumps((1, 2))))
+
+        self.assertEqual(dict(make()), {'id': 1, 'args': (1, 2)})
+
+        other = {}
+        other.update(make())
+        self.assertEqual(other, {'id': 1, 'args': (1, 2)})
+
+        def func(**kwargs):
+            return kwargs
+        self.assertEqual(func(**make()), {'id': 1, 'args': (1, 2)})
+
+        self.assertEqual(sorted(make().items()), [('args', (1, 2)), ('id', 1)])
+        self.assertIn((1, 2), make().values())
@@ -0,0 +1,80 @@
+from . import *
+
+from aque.worker import OutputBuffer
+
+
+class TestOutputBuffer(BrokerTestCase):
+
+    def setUp(self):
+        super(TestOutputBuffer, self).setUp()
+        # Clear out anything from previous runs.
+        self.broker.delete([1234, 1235])
+
+    def test_coalesce_and_flush(self):
+
+        flushes = []
+        self.broker.bind('output_log.1234', lambda tid, chunks: flushes.append(chunks))
+
+        buf = OutputBuffer(self.broker, 1234, max_size=12)
+        buf.write(1, 0, 'one\n')
+        buf.write(1, 4, 'two\n')
+        buf.write(2, 0, 'err')
+        self.assertEqual(flushes, [])
+        self.assertEqual(len(buf), 11)
+
+        # This one reaches the limit.
+        buf.write(1, 8, 'x')
+        self.assertEqual(flushes, [[(1, 0, 8), (2, 0, 3), (1, 8, 1)]])
+        self.assertEqual(sorted(x[2:] for x in self.broker.get_output([1234])), [
+            (1, 0, 'one\ntwo\n'), (1, 8, 'x'), (2, 0, 'err'),
+        ])
+        self.assertEqual(sorted(x[2:] for x in self.broker.get_output([1234], {1234: {1: 8}})), [
+            (1, 8, 'x'), (2, 0, 'err'),
+        ])
+
+        buf.flush()
+        self.assertEqual(len(flushes), 1)
+
+    def test_tasks_are_interleaved_in_time(self):
+
+        self.broker.log_output_and_notify(1235, 1, 0, 'b1\n')
+        time.sleep(0.01)
+        self.broker.log_output_and_notify(1234, 1, 0, 'a1\n')
+        time.sleep(0.01)
+        self.broker.log_output_and_notify(1235, 1, 3, 'b2\n')
+
+        output = [(tid, content) for tid, _, _, _, content in self.broker.get_output([1234, 1235])]
+        self.assertEqual(output, [(1235, 'b1\n'), (1234, 'a1\n'), (1235, 'b2\n')])
+
+    def test_many_interleaved_chunks(self):
+
+        flushes = []
+        self.broker.bind('output_log.1234', lambda tid, chunks: flushes.append(chunks))
+
+        # Flipping between stdout and stderr makes a chunk for every write,
+        # which is more than fits in a single notification.
+        buf = OutputBuffer(self.broker, 1234)
+        offsets = {1: 0, 2: 0}
+        for i in xrange(2000):
+            fd = 1 + i % 2
+            buf.write(fd, offsets[fd], 'line %d\n' % i)
+            offsets[fd] += len('line %d\n' % i)
+        buf.flush()
+
+        chunks = [c for chunks in flushes for c in chunks]
+        self.assertEqual(len(chunks), 2000)
+        self.assertEqual(len(list(self.broker.get_output([1234]))), 2000)
+
+    def test_flush_on_timer(self):
+
+        flushes = []
+        self.broker.bind('output_log.1234', lambda tid, chunks: flushes.append(chunks))
+
+        loop = EventLoop()
+        buf = OutputBuffer(self.broker, 1234, loop, max_delay=0.01)
+        buf.write(1, 0, 'hello')
+        self.assertEqual(flushes, [])
+
+        loop.process(0.1)
+        self.assertEqual(flushes, [[(1, 0, 5)]])
+        self.assertEqual(loop.timers, [])
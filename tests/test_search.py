@@ -0,0 +1,41 @@
+from . import *
+
+from aque.brokers import postgres
+
+
+class TestPostgresSearch(BrokerTestCase):
+
+    def setUp(self):
+        super(TestPostgresSearch, self).setUp()
+        if not isinstance(self.broker, postgres.PostgresBroker):
+            self.skipTest('broker does not stream searches')
+        self.broker.search_itersize = 2
+        self.futures = [self.queue.submit_ex(str, args=(i, )) for i in xrange(5)]
+        self.ids = set(f.id for f in self.futures)
+
+    def tearDown(self):
+        self.broker.delete(list(self.ids))
+        super(TestPostgresSearch, self).tearDown()
+
+    def connections_in_use(self):
+        # Beyond the one listening for notifications.
+        return len(self.broker._pool._used) - (1 if self.broker._notify_conn else 0)
+
+    def test_more_than_itersize(self):
+        found = [t for t in self.broker.search(fields=['id', 'args']) if t['id'] in self.ids]
+        self.assertEqual(sorted(t['args'] for t in found), [(i, ) for i in xrange(5)])
+        self.assertEqual(self.connections_in_use(), 0)
+
+    def test_stop_early(self):
+
+        results = self.broker.search(fields=['id'])
+        next(results)
+        self.assertEqual(self.connections_in_use(), 1)
+        results.close()
+        self.assertEqual(self.connections_in_use(), 0)
+
+        # Abandoned ones are cleaned up once collected.
+        results = self.broker.search(fields=['id'])
+        next(results)
+        del results
+        self.assertEqual(self.connections_in_use(), 0)
@@ -0,0 +1,149 @@
+from . import *
+
+import signal
+
+from aque.exceptions import ServiceError
+from aque.patterns.service import do_service_task
+
+
+SERVICE_SOURCE = r'''
+import json
+import os
+import sys
+
+for line in iter(sys.stdin.readline, ''):
+    args = json.loads(line)
+    sys.stdout.write('working on %s\n' % ' '.join(args))
+    if args == ['fail']:
+        sys.stdout.write('error bad request\n')
+    else:
+        sys.stdout.write('ok %d\n' % os.getpid())
+    sys.stdout.flush()
+    # Some go quiet without exiting.
+    if '--hang-up' in sys.argv:
+        import time
+        os.close(1)
+        os.close(2)
+        time.sleep(60)
+
+# Some services don't take the hint.
+if '--linger' in sys.argv:
+    import time
+    time.sleep(60)
+'''
+
+
+class TestServicePattern(BrokerTestCase):
+
+    def setUp(self):
+        super(TestServicePattern, self).setUp()
+        path = os.path.join(self.sandbox, 'service.py')
+        with open(path, 'w') as fh:
+            fh.write(SERVICE_SOURCE)
+        self.service = [sys.executable, path]
+
+    def submit(self, *args):
+        return self.queue.submit_ex(pattern='service', service=self.service, args=args)
+
+    def test_reuse_and_recycle(self):
+
+        a = self.submit('a')
+        self.worker.run_to_end()
+        b = self.submit('b')
+        self.worker.run_one()
+
+        # The same instance handled both.
+        self.assertEqual(a.result(0.1), b.result(0.1))
+
+        c = self.submit('fail')
+        self.worker.run_one()
+        self.assertRaises(ServiceError, c.result, 0.1)
+        self.assertEqual(self.broker.fetch(c.id)['status'], 'error')
+
+        # An error retires the instance.
+        d = self.submit('d')
+        self.worker.run_one()
+        self.assertNotEqual(d.result(0.1), a.result(0.1))
+
+        output = ''.join(x[-1] for x in self.broker.get_output([d.id]))
+        self.assertEqual(output, 'working on d\n')
+
+    def test_retirement_does_not_block(self):
+
+        from aque.workersandbox import service as service_module
+
+        self.service.append('--linger')
+        old_timeout = service_module.CLOSE_TIMEOUT
+        service_module.CLOSE_TIMEOUT = 0.2
+        try:
+
+            a = self.submit('fail')
+            start_time = time.time()
+            self.worker.run_one()
+            self.assertLess(time.time() - start_time, 0.2)
+            self.assertRaises(ServiceError, a.result, 0.1)
+
+            # It is killed once it has had its chance.
+            pool = self.worker._services
+            instance, = pool._retiring
+            deadline = time.time() + 2
+            while (pool._retiring or instance.proc.returncode is None) and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(pool._retiring, {})
+            self.assertEqual(instance.proc.returncode, -signal.SIGKILL)
+
+        finally:
+            service_module.CLOSE_TIMEOUT = old_timeout
+
+    def test_idle_exit_does_not_block(self):
+
+        from aque.workersandbox import service as service_module
+
+        self.service.append('--hang-up')
+        old_timeout = service_module.CLOSE_TIMEOUT
+        service_module.CLOSE_TIMEOUT = 0.2
+        try:
+
+            a = self.submit('a')
+            self.worker.run_one()
+            a.result(0.1)
+
+            # Drive the loop ourselves, to see how long each pass takes.
+            loop = self.worker._event_loop
+            loop.stop_thread()
+
+            # It looks to have exited once its output closes, but is only
+            # killed (without waiting on it) once it has had its chance.
+            pool = self.worker._services
+            deadline = time.time() + 2
+            while not pool._retiring and time.time() < deadline:
+                start_time = time.time()
+                loop.process(0.01)
+                self.assertLess(time.time() - start_time, 0.1)
+            instance, = pool._retiring
+            self.assertEqual(pool.idle, [])
+
+            while pool._retiring and time.time() < deadline:
+                loop.process(0.01)
+            self.assertEqual(instance.proc.returncode, -signal.SIGKILL)
+
+        finally:
+            service_module.CLOSE_TIMEOUT = old_timeout
+            self.worker._event_loop.resume_thread()
+
+    def test_bad_command(self):
+        self.service = [os.path.join(self.sandbox, 'does-not-exist')]
+        a = self.submit('a')
+        self.worker.run_one()
+        self.assertRaises(ServiceError, a.result, 0.1)
+        self.assertEqual(self.broker.fetch(a.id)['status'], 'error')
+
+    def test_one_off(self):
+        task = {'id': 1, 'service': self.service, 'args': ['x']}
+        with override_stdio() as (out, _):
+            res = do_service_task(task)
+        self.assertTrue(res.isdigit())
+        self.assertEqual(out.getvalue(), 'working on x\n')
+        task['args'] = ['fail']
+        with override_stdio():
+            self.assertRaises(ServiceError, do_service_task, task)
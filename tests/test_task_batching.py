@@ -0,0 +1,135 @@
+from . import *
+
+import signal
+
+from aque.worker import ProcJob
+
+
+def ex_square(x):
+    return x * x
+
+
+class TestTaskBatching(BrokerTestCase):
+
+    def setUp(self):
+        super(TestTaskBatching, self).setUp()
+        self.updates = []
+        real = self.broker.set_statuses_and_notify
+        def set_statuses_and_notify(updates):
+            updates = list(updates)
+            self.updates.append(sorted(tid for tid, _, _ in updates))
+            return real(updates)
+        self.broker.set_statuses_and_notify = set_statuses_and_notify
+
+    def test_batches(self):
+
+        futures = [self.queue.submit_ex(ex_square, args=(i, ), batch_key='squares', max_batch=3) for i in xrange(5)]
+        other = self.queue.submit_ex(ex_square, args=(10, ))
+        self.worker.run_to_end()
+
+        self.assertEqual([f.result(0.1) for f in futures], [0, 1, 4, 9, 16])
+        self.assertEqual(other.result(0.1), 100)
+
+        ids = [f.id for f in futures]
+        self.assertEqual(sorted(self.updates), sorted([ids[:3], ids[3:], [other.id]]))
+
+    def test_errors_are_per_task(self):
+
+        a = self.queue.submit_ex(ex_square, args=(2, ), batch_key='x')
+        b = self.queue.submit_ex(ex_square, args=('not a number', ), batch_key='x')
+        self.worker.run_to_end()
+
+        self.assertEqual(a.result(0.1), 4)
+        self.assertRaises(TypeError, b.result, 0.1)
+        self.assertEqual(self.updates, [sorted([a.id, b.id])])
+
+    def test_count(self):
+
+        futures = [self.queue.submit_ex(ex_square, args=(i, ), batch_key='squares') for i in xrange(3)]
+        self.worker.run_one()
+        self.assertEqual(sum(1 for f in futures if f.done()), 1)
+        self.worker.run_to_end()
+        self.assertEqual([f.result(0.1) for f in futures], [0, 1, 4])
+
+    def test_batch_search_is_bounded(self):
+
+        self.worker.close()
+        self.worker = Worker(self.broker, max_cpus=1)
+
+        first = self.queue.submit_ex(ex_square, args=(1, ), batch_key='squares', max_batch=2)
+        others = [self.queue.submit_ex(ex_square, args=(i, )) for i in xrange(20)]
+
+        seen = []
+        real = self.worker.iter_open_tasks
+        def iter_open_tasks():
+            for task in real():
+                seen.append(task['id'])
+                yield task
+        self.worker.iter_open_tasks = iter_open_tasks
+
+        # Out of CPUs after the first, and then only one more (the room left
+        # in its batch) is looked at for batch-mates, before the one which
+        # ends the search.
+        self.worker._spawn_jobs(None)
+        self.assertEqual(len(seen), 3)
+        self.assertEqual(seen[0], first.id)
+
+        self.worker.run_to_end()
+        self.assertEqual([f.result(0.1) for f in others], [i * i for i in xrange(20)])
+
+
+def ex_print(x):
+    # Straight to the fd, as the test runner may have replaced sys.stdout.
+    os.write(1, 'task %s\n' % x)
+    return x
+
+
+class TestProcJobBatches(BrokerTestCase):
+
+    def submit_batch(self, func, *args):
+        futures = [self.queue.submit_ex(func, args=(x, ), batch_key='procs') for x in args]
+        tasks = self.broker.fetch([f.id for f in futures])
+        return [tasks[f.id] for f in futures]
+
+    def run_job(self, job):
+        loop = EventLoop()
+        job.start()
+        loop.add(job)
+        deadline = time.time() + 5
+        while job in loop.active and time.time() < deadline:
+            loop.process(0.1)
+        job.close()
+
+    def test_signal_any_member(self):
+
+        tasks = self.submit_batch(time.sleep, 10, 10, 10)
+        job = ProcJob(self.broker, tasks[0], batch=tasks[1:])
+
+        job.start()
+        try:
+
+            # Don't signal until it is in its own process group.
+            deadline = time.time() + 2
+            while os.getpgid(job.proc.pid) != job.proc.pid and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(os.getpgid(job.proc.pid), job.proc.pid)
+
+            self.broker.trigger(['signal_task.%d' % tasks[2]['id']], [tasks[2]['id']], signal.SIGKILL)
+            deadline = time.time() + 2
+            while job.is_alive() and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertFalse(job.is_alive())
+        finally:
+            job.close()
+
+        # Nothing is listening once it is closed.
+        self.assertFalse(any(self.broker._bound_callbacks.get('signal_task.%d' % t['id']) for t in tasks))
+
+    def test_output_is_logged_under_first(self):
+
+        tasks = self.submit_batch(ex_print, 1, 2)
+        self.run_job(ProcJob(self.broker, tasks[0], batch=tasks[1:]))
+
+        output = ''.join(x[-1] for x in self.broker.get_output([tasks[0]['id']]) if x[2] == 1)
+        self.assertEqual(output, 'task 1\ntask 2\n')
+        self.assertEqual(list(self.broker.get_output([tasks[1]['id']])), [])
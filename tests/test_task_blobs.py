@@ -0,0 +1,131 @@
+from . import *
+
+import contextlib
+import pickle
+
+from aque.brokers import postgres
+from aque.utils import LRUCache
+
+
+class OfflineBroker(postgres.PostgresBroker):
+    """Just enough of a broker to encode tasks, and load cached blobs."""
+
+    def __init__(self):
+        self._blob_cache = LRUCache(postgres.BLOB_CACHE_SIZE)
+        self._blobs_swept_at = None
+        self._task_field_types = {'kwargs': 'bytea', 'environ': 'bytea', 'args': 'bytea'}
+        self.queries = []
+
+    def close(self):
+        pass
+
+    @contextlib.contextmanager
+    def _cursor(self):
+        yield self
+
+    # Just enough of a cursor to record what is run.
+    def execute(self, query, params=None):
+        self.queries.append(' '.join(query.split()))
+
+    def __iter__(self):
+        return iter(())
+
+    def _adjust_dependents(self, cur, tids, delta):
+        pass
+
+
+def big_kwargs():
+    return {'data': ['x' * postgres.BLOB_MIN_SIZE], 'nested': [[1, 2], [3]]}
+
+
+class TestTaskBlobEncoding(TestCase):
+
+    def test_equal_values_stored_once(self):
+
+        broker = OfflineBroker()
+        blobs = {}
+
+        # Distinct (but equal) objects, as tasks each get their own kwargs.
+        a = broker._encode_task({'kwargs': big_kwargs(), 'args': (1, )}, blobs)
+        b = broker._encode_task({'kwargs': big_kwargs(), 'args': (2, )}, blobs)
+        self.assertEqual(len(blobs), 1)
+        self.assertIs(a['kwargs'], b['kwargs'])
+
+        # Small values, and other fields, are stored inline.
+        broker._encode_task({'kwargs': {'small': 1}, 'args': (['x' * postgres.BLOB_MIN_SIZE], )}, blobs)
+        self.assertEqual(len(blobs), 1)
+
+    def test_loads_are_independent(self):
+
+        broker = OfflineBroker()
+        blobs = {}
+        reference = broker._encode('kwargs', big_kwargs(), blobs)
+        digest, = blobs
+        broker._blob_cache.put(digest, blobs[digest][0])
+
+        value = broker._decode('kwargs', buffer(reference.adapted))
+        self.assertEqual(value, big_kwargs())
+        value['nested'][0].append('oops')
+        value['extra'] = True
+
+        self.assertEqual(broker._load_blob(digest), big_kwargs())
+
+    def test_sweeps_are_throttled(self):
+
+        broker = OfflineBroker()
+        sweeps = lambda: sum(1 for q in broker.queries if q.startswith('DELETE FROM task_blobs'))
+
+        broker._delete_many([1])
+        broker._delete_many([2])
+        self.assertEqual(sweeps(), 1)
+
+        broker._blobs_swept_at -= broker.blob_grace_period
+        broker._delete_many([3])
+        self.assertEqual(sweeps(), 2)
+
+
+class TestTaskBlobs(BrokerTestCase):
+
+    def setUp(self):
+        super(TestTaskBlobs, self).setUp()
+        if not isinstance(self.broker, postgres.PostgresBroker):
+            self.skipTest('broker does not store blobs')
+
+    def blob_count(self):
+        with self.broker._cursor() as cur:
+            cur.execute('SELECT count(*) FROM task_blobs')
+            return cur.fetchone()[0]
+
+    def test_round_trip(self):
+
+        before = self.blob_count()
+        futures = [self.queue.submit_ex(str, kwargs=big_kwargs()) for _ in xrange(3)]
+        self.assertEqual(self.blob_count(), before + 1)
+
+        tasks = self.broker.fetch([f.id for f in futures])
+        for f in futures:
+            self.assertEqual(tasks[f.id]['kwargs'], big_kwargs())
+
+        # What one task does to its kwargs is not seen by the next.
+        tasks[futures[0].id]['kwargs']['nested'][0].append('oops')
+        self.assertEqual(self.broker.fetch(futures[1].id)['kwargs'], big_kwargs())
+
+        self.broker.delete([f.id for f in futures])
+
+    def test_unused_blobs_are_deleted(self):
+
+        self.broker.blob_grace_period = 0
+        kwargs = big_kwargs()
+        kwargs['unique'] = self.id()
+
+        before = self.blob_count()
+        a = self.queue.submit_ex(str, kwargs=kwargs)
+        b = self.queue.submit_ex(str, kwargs=kwargs)
+        self.assertEqual(self.blob_count(), before + 1)
+
+        self.broker.delete([a.id])
+        self.assertEqual(self.blob_count(), before + 1)
+        self.assertEqual(self.broker.fetch(b.id)['kwargs'], kwargs)
+
+        self.broker.delete([b.id])
+        self.assertEqual(self.blob_count(), before)
@@ -0,0 +1,37 @@
+from . import *
+
+from aque.brokers import postgres
+
+
+class OfflineBroker(postgres.PostgresBroker):
+    """Just enough of a broker to decide between COPY and INSERT."""
+
+    def __init__(self):
+        self._task_field_udts = {'id': 'int4', 'name': 'text', 'host': '_text', 'ctime': 'timestamp'}
+
+    def close(self):
+        pass
+
+
+class TestTaskCopy(TestCase):
+
+    def test_text_must_be_strings(self):
+        self.assertEqual(postgres._copy_text('abc'), 'abc')
+        self.assertEqual(postgres._copy_text(u'\xe9'), '\xc3\xa9')
+        self.assertRaises(TypeError, postgres._copy_text, 5)
+        self.assertRaises(TypeError, postgres._copy_text, ['a', 'b'])
+
+    def test_can_copy(self):
+
+        broker = OfflineBroker()
+        self.assertTrue(broker._can_copy(['id', 'name', 'host'], [
+            {'id': 1, 'name': 'a', 'host': ['x', u'y']},
+            {'id': 2, 'name': None, 'host': None},
+        ]))
+
+        # Anything which INSERT would have to adapt (or reject) goes that way.
+        self.assertFalse(broker._can_copy(['name'], [{'name': 'a'}, {'name': 5}]))
+        self.assertFalse(broker._can_copy(['name'], [{'name': ['a', 'b']}]))
+        self.assertFalse(broker._can_copy(['host'], [{'host': 'x'}]))
+        self.assertFalse(broker._can_copy(['host'], [{'host': ['x', 5]}]))
+        self.assertFalse(broker._can_copy(['ctime'], [{'ctime': None}]))
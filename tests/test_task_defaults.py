@@ -26,3 +26,86 @@ class TestDefaults(BrokerTestCase):
             'pattern': None,
         }])
         self.assertTrue(f.id > list(f.iter())[1].id, 1)
+
+    def test_bulk_submit_is_pending(self):
+
+        notified = []
+        self.broker.bind('task_status.pending', lambda tids, status: notified.append(list(tids)))
+
+        prototypes = [{'name': '%s.%d' % (self.id(), i), 'pattern': None} for i in xrange(10)]
+        futures = self.queue.submit_many(prototypes)
+
+        tids = [futures[id(p)].id for p in prototypes]
+        self.assertEqual(tids, sorted(tids))
+        self.assertEqual(notified, [tids])
+
+        tasks = self.broker.fetch(tids)
+        self.assertEqual([tasks[tid]['name'] for tid in tids], [p['name'] for p in prototypes])
+        self.assertTrue(all(t['status'] == 'pending' for t in tasks.itervalues()))
+
+    def test_heterogeneous_submit(self):
+
+        prototypes = [
+            {'name': self.id() + '.0', 'pattern': None},
+            {'name': self.id() + '.1', 'pattern': None, 'cpus': 2},
+            {'name': self.id() + '.2', 'pattern': None, 'host': 'nowhere', 'custom': 'value'},
+            {'name': self.id() + '.3', 'pattern': None, 'cpus': 3},
+        ]
+        futures = self.queue.submit_many(prototypes)
+
+        tids = [futures[id(p)].id for p in prototypes]
+        self.assertEqual(tids, sorted(tids))
+
+        tasks = self.broker.fetch(tids)
+        self.assertEqual([tasks[tid]['name'] for tid in tids], [p['name'] for p in prototypes])
+        self.assertEqual([tasks[tid].get('cpus') for tid in tids], [None, 2, None, 3])
+        self.assertEqual(tasks[tids[2]]['host'], 'nowhere')
+        self.assertEqual(tasks[tids[2]]['custom'], 'value')
+        self.assertEqual(tasks[tids[0]]['priority'], 1000)
+
+    def test_deep_graph_submit(self):
+
+        leaf = {'name': self.id() + '.0', 'pattern': None}
+        proto = leaf
+        for i in xrange(1, 50):
+            proto = {'name': '%s.%d' % (self.id(), i), 'pattern': None, 'dependencies': [proto]}
+        futures = self.queue.submit_many([proto])
+
+        chain = sorted(futures.itervalues(), key=lambda f: f.id)
+        self.assertEqual(len(chain), 50)
+        self.assertEqual(futures[id(leaf)], chain[0])
+
+        tasks = self.broker.fetch([f.id for f in chain])
+        for prev, future in zip(chain, chain[1:]):
+            task = tasks[future.id]
+            self.assertEqual(task['status'], 'pending')
+            self.assertEqual(task['dependencies'], [prev.id])
+            self.assertEqual(task['unfinished_dependencies'], 1)
+        self.assertEqual(tasks[chain[0].id]['unfinished_dependencies'], 0)
+
+    def test_deeper_than_recursion_limit(self):
+
+        depth = sys.getrecursionlimit() + 100
+        leaf = proto = {'name': self.id() + '.0', 'pattern': None}
+        for i in xrange(1, depth):
+            proto = {'name': '%s.%d' % (self.id(), i), 'pattern': None, 'dependencies': [proto]}
+        futures = self.queue.submit_many([proto])
+
+        self.assertEqual(len(futures), depth)
+        tasks = self.broker.fetch([futures[id(proto)].id, futures[id(leaf)].id])
+        self.assertEqual(tasks[futures[id(proto)].id]['name'], proto['name'])
+        self.assertEqual(tasks[futures[id(leaf)].id]['dependencies'], [])
+
+    def test_prototypes_are_not_modified(self):
+
+        dep = {'name': 'dep', 'pattern': None}
+        proto = {'name': 'proto', 'pattern': None, 'dependencies': [dep]}
+        futures = self.queue.submit_many([proto])
+
+        self.assertEqual(dep, {'name': 'dep', 'pattern': None})
+        self.assertEqual(proto, {'name': 'proto', 'pattern': None, 'dependencies': [dep]})
+        self.assertEqual(self.broker.fetch(futures[id(proto)].id)['dependencies'], [futures[id(dep)].id])
+
+        # So they may be submitted again.
+        again = self.queue.submit_many([proto])
+        self.assertNotEqual(again[id(proto)].id, futures[id(proto)].id)
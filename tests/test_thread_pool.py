@@ -0,0 +1,56 @@
+from . import *
+
+from aque.worker import ThreadJob, ThreadPool
+
+
+def ex_thread(x):
+    return x, threading.current_thread().ident
+
+
+class TestThreadPool(BrokerTestCase):
+
+    def setUp(self):
+        super(TestThreadPool, self).setUp()
+        self.worker.close()
+        self.worker = Worker(self.broker, max_cpus=2)
+
+    def test_bounded_threads(self):
+
+        if self.broker.can_fork:
+            self.skipTest('broker forks tasks')
+
+        futures = [self.queue.submit_ex(ex_thread, args=(i, )) for i in xrange(20)]
+        self.worker.run_to_end()
+
+        results = [f.result(0.1) for f in futures]
+        self.assertEqual([x for x, _ in results], range(20))
+        self.assertTrue(len(set(ident for _, ident in results)) <= 2)
+        self.assertEqual(self.worker._threads.size, 2)
+
+        # Threads are kept around between runs.
+        threads = list(self.worker._threads._threads)
+        future = self.queue.submit_ex(ex_thread, args=(20, ))
+        self.worker.run_to_end()
+        self.assertIn(future.result(0.1)[1], [t.ident for t in threads])
+
+    def test_shared_fd(self):
+
+        loop = EventLoop()
+        pool = ThreadPool(0, event_loop=loop)
+        self.assertEqual(pool.size, 1)
+        loop.add(pool)
+
+        # The jobs have nothing to select on, and aren't polled either.
+        jobs = [ThreadJob(self.broker, {'id': i}, pool) for i in xrange(3)]
+        for job in jobs:
+            self.assertIs(job.to_select(), None)
+            loop.add(job)
+        self.assertEqual(pool.to_select(), ([pool.finished.fileno()], [], []))
+
+        pool._done.put(jobs[0])
+        pool.finished.set()
+        loop.process(1)
+
+        self.assertFalse(pool.finished.is_set())
+        self.assertEqual(loop.stopped, [jobs[0]])
+        self.assertIs(jobs[1].to_select(), None)
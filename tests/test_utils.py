@@ -74,3 +74,26 @@ proc on /proc type proc (rw,noexec,nosuid,nodev)
         self.assertIs(remote, utils.get_mount('/Volumes/remote/lower', mounts))
 
 
+
+
+class TestLRUCache(TestCase):
+
+    def test_eviction(self):
+        cache = utils.LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1) # Now "b" is the oldest.
+        cache.put('c', 3)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+
+
+class TestRanges(TestCase):
+
+    def test_round_trip(self):
+        self.assertEqual(utils.compress_ranges([]), [])
+        self.assertEqual(utils.compress_ranges([5, 1, 2, 3, 7, 6, 3]), [[1, 3], [5, 7]])
+        self.assertEqual(utils.compress_ranges([10]), [[10, 10]])
+        self.assertEqual(utils.expand_ranges([[1, 3], [5, 7]]), [1, 2, 3, 5, 6, 7])
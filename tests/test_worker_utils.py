@@ -28,3 +28,111 @@ class TestWorkerBasics(BrokerTestCase):
         self.worker.run_one()
         self.assertEqual(open_names(), set(['a']))
 
+
+    def test_open_task_priorities(self):
+
+        self.queue.submit_ex(tuple, name='x', priority=10)
+        self.queue.submit_ex(tuple, name='y', priority=3000)
+        self.queue.submit_ex(tuple, name='z', priority=1000)
+
+        open_names = [t['name'] for t in self.worker.iter_open_tasks()]
+        open_names = [n for n in open_names if n in ('x', 'y', 'z')]
+        self.assertEqual(open_names, ['y', 'z', 'x'])
+
+        self.worker.run_one()
+        open_names = [t['name'] for t in self.worker.iter_open_tasks()]
+        open_names = [n for n in open_names if n in ('x', 'y', 'z')]
+        self.assertEqual(open_names, ['z', 'x'])
+
+    def test_rejected_tasks(self):
+
+        a = self.queue.submit_ex(tuple, name='a', host='not-a-real-host.example.com')
+        b = self.queue.submit_ex(tuple, name='b', host='not-a-real-host.example.com')
+
+        self.worker.run_to_end()
+        self.assertNotIn(a.id, self.worker._pending)
+        self.assertNotIn(b.id, self.worker._pending)
+        self.assertEqual(self.broker.fetch(a.id)['status'], 'pending')
+
+        # Both were judged by the same verdict.
+        self.assertEqual(self.worker._requirement_verdicts.values().count(False), 1)
+
+        # Changing the status brings it back.
+        self.broker.set_status_and_notify(a.id, 'pending')
+        self.worker._pending.sync()
+        self.assertIn(a.id, self.worker._pending)
+        self.assertNotIn(b.id, self.worker._pending)
+
+        self.broker.delete([a.id, b.id])
+
+    def test_rejections_forgotten_by_reconcile(self):
+
+        index = self.worker._pending
+        a = self.queue.submit_ex(tuple, name='a')
+        index.sync()
+        index.reject(a.id)
+
+        # The task leaves the pending state while we aren't listening.
+        self.broker.set_status_and_notify(a.id, 'killed')
+        index.reconcile()
+        self.assertNotIn(a.id, index._rejected)
+
+        self.broker.set_status_and_notify(a.id, 'pending')
+        index.reconcile()
+        self.assertIn(a.id, index)
+
+        self.broker.delete([a.id])
+
+
+class _Output(object):
+
+    def __init__(self):
+        self.flushes = 0
+
+    def flush(self):
+        self.flushes += 1
+
+
+class _Exiter(object):
+    """Reports a process exiting once its pipe is readable (like the zygote)."""
+
+    def __init__(self, alive):
+        self.rfd, self.wfd = os.pipe()
+        self.alive = alive
+
+    def to_select(self):
+        return [self.rfd], [], []
+
+    def on_select(self, rfds, wfds, xfds):
+        os.read(self.rfd, 1024)
+        self.alive[0] = False
+
+
+class TestProcJobJoining(TestCase):
+
+    def test_exit_reported_after_output_closed(self):
+
+        from aque.worker import ProcJob
+
+        alive = [True]
+        job = ProcJob(None, {'id': 1})
+        job.proc = type('proc', (object, ), {'pid': 0})()
+        job.is_alive = lambda: alive[0]
+        job.fd_map = {}
+        job.output = _Output()
+
+        exiter = _Exiter(alive)
+        loop = EventLoop()
+        loop.add(job)
+        loop.add(exiter)
+        loop.process(0)
+        self.assertIn(job, loop.active)
+
+        # However they are dispatched, the job is joined on the same pass.
+        os.write(exiter.wfd, 'x')
+        loop.process(1)
+        self.assertEqual(loop.stopped, [job])
+        self.assertEqual(job.output.flushes, 1)
+
+        os.close(exiter.rfd)
+        os.close(exiter.wfd)
@@ -0,0 +1,16 @@
+from . import *
+
+from aque.worker import POLL_INTERVAL
+
+
+class TestWorkerWakeup(WorkerTestCase):
+
+    def test_wakes_on_submit(self):
+
+        # Let the worker settle into waiting for more work.
+        time.sleep(0.1)
+
+        start_time = time.time()
+        f = self.queue.submit_ex(func=str, args=(1, ))
+        self.assertEqual(f.result(POLL_INTERVAL / 10), '1')
+        self.assertLess(time.time() - start_time, 1)
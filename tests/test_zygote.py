@@ -0,0 +1,68 @@
+import grp
+import pwd
+
+from . import *
+
+from aque.workersandbox.zygote import Zygote
+
+
+class EchoBroker(object):
+    """Just enough of a broker for a forked task to report its result."""
+
+    def after_fork(self):
+        pass
+
+    def set_statuses_and_notify(self, updates):
+        for tid, status, result in updates:
+            print 'task %d %s: %r' % (tid, status, result)
+
+
+def task_pid():
+    return os.getpid()
+
+
+class TestZygote(TestCase):
+
+    def test_spawn(self):
+
+        zygote = Zygote(EchoBroker(), preload=['json'])
+        zygote.start()
+        try:
+
+            loop = EventLoop()
+            loop.add(zygote)
+
+            user = pwd.getpwuid(os.getuid())
+            r, w = os.pipe()
+            proc = zygote.spawn({
+                'id': 123,
+                'func': task_pid,
+                'user': user.pw_name,
+                'group': grp.getgrgid(user.pw_gid).gr_name,
+                'cwd': os.getcwd(),
+            }, w, w)
+            os.close(w)
+
+            self.assertNotEqual(proc.pid, os.getpid())
+            self.assertNotEqual(proc.pid, zygote.proc.pid)
+
+            output = []
+            while True:
+                chunk = os.read(r, 4096)
+                if not chunk:
+                    break
+                output.append(chunk)
+            os.close(r)
+            self.assertEqual(''.join(output), 'task 123 success: %d\n' % proc.pid)
+
+            timeout = time.time() + 5
+            while proc.is_alive() and time.time() < timeout:
+                loop.process(0.1)
+            self.assertFalse(proc.is_alive())
+            self.assertEqual(proc.exitcode, 0)
+
+        finally:
+            zygote.close()
+
+        self.assertFalse(zygote.running)
+        self.assertEqual(zygote.proc.returncode, 0)